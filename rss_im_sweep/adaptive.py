@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive refinement of the tone spacing axis.
+
+A coarse sweep is searched for regions where the IM3 level has a large curvature, such as memory effect resonances
+and bias network dips, or where the lower and upper IM3 products differ. Only those regions are measured again,
+with a segmented sweep, and the results are merged into one array with non-uniform tone spacing. See
+ZVAIMController.measure_adaptive().
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+from rss_im_sweep.analysis import power_dbm
+from rss_im_sweep.readout import TraceData
+
+
+def refinement_scores(im3l_dbm, im3u_dbm, curvature=1.0, asymmetry=3.0):
+    """
+    Score each point of a coarse sweep. A score of 1 or more means that the point should be refined.
+
+    :param im3l_dbm: The lower IM3 level of the coarse sweep
+    :param im3u_dbm: The upper IM3 level
+    :param float curvature: The second difference of the mean IM3 level, in dB, which gives score 1
+    :param float asymmetry: The difference between the lower and upper IM3 level, in dB, which gives score 1
+    :rtype: numpy.ndarray
+    """
+    im3l_dbm = numpy.asarray(im3l_dbm, dtype=float)
+    im3u_dbm = numpy.asarray(im3u_dbm, dtype=float)
+    mean = (im3l_dbm + im3u_dbm) / 2
+    curv = numpy.zeros(len(mean))
+    curv[1:-1] = numpy.abs(numpy.diff(mean, 2))
+    return numpy.maximum(curv / curvature, numpy.abs(im3l_dbm - im3u_dbm) / asymmetry)
+
+
+def refinement_regions(spacing, scores, max_fraction=0.5):
+    """
+    The tone spacing regions around the points with a score of at least 1. At most max_fraction of the coarse
+    intervals are refined, the points with the highest scores first.
+
+    :param spacing: The tone spacing of the coarse sweep, in increasing order
+    :param scores: See refinement_scores()
+    :return: [(start, stop)], in increasing order and not overlapping
+    :rtype: list
+    """
+    spacing = numpy.asarray(spacing)
+    n = len(spacing)
+    flagged = [i for i in numpy.argsort(scores)[::-1] if scores[i] >= 1]
+    flagged = sorted(flagged[:max(1, int(max_fraction * (n - 1) / 2))])
+    ret = []
+    for i in flagged:
+        lo, hi = max(i - 1, 0), min(i + 1, n - 1)
+        if ret and lo <= ret[-1][1]:
+            ret[-1][1] = hi
+        else:
+            ret.append([lo, hi])
+    return [(float(spacing[lo]), float(spacing[hi])) for lo, hi in ret if hi > lo]
+
+
+def allocate_points(regions, points, min_points=3):
+    """
+    Distribute the points of the refinement sweep between the regions, in proportion to their width.
+
+    :param regions: See refinement_regions()
+    :param int points: The total number of points
+    :return: [(start, stop, points)]
+    :rtype: list
+    """
+    width = numpy.array([stop - start for start, stop in regions])
+    n = numpy.maximum(numpy.floor(points * width / width.sum()), min_points).astype(int)
+    return [(start, stop, int(k)) for (start, stop), k in zip(regions, n)]
+
+
+def merge_traces(coarse, fine):
+    """
+    Merge the traces of the coarse sweep and the refinement sweep into one non-uniform sweep, sorted by tone
+    spacing. Where both sweeps have a point at the same tone spacing, the refinement point is used.
+
+    :param TraceData coarse:
+    :param TraceData fine:
+    :rtype: TraceData
+    """
+    spacing = numpy.concatenate([fine.spacing, coarse.spacing])
+    _, idx = numpy.unique(spacing, return_index=True)  # The first occurrence, from the refinement sweep
+    return TraceData(((name, numpy.concatenate([fine[name], coarse[name]])[idx]) for name in coarse if name in fine),
+                     spacing=spacing[idx])
+
+
+def refine(coarse, points, curvature=1.0, asymmetry=3.0, max_fraction=0.5):
+    """
+    The refinement sweep ranges for a coarse sweep.
+
+    :param TraceData coarse: The traces read with ZVAIMController.read_traces()
+    :param int points: The number of points of the refinement sweep
+    :return: [(start, stop, points)], empty if nothing needs to be refined
+    :rtype: list
+    """
+    scores = refinement_scores(power_dbm(coarse["IM3L_O"]), power_dbm(coarse["IM3U_O"]), curvature, asymmetry)
+    regions = refinement_regions(coarse.spacing, scores, max_fraction)
+    if not regions:
+        return []
+    return allocate_points(regions, points)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Host side analysis of two-tone intermodulation measurements.
+
+The input waves are the normalized wave quantities measured by the VNA, |a|^2 and |b|^2 are powers in W.
+All functions are vectorized, and accept arrays of any shape, e.g. one row per sweep.
+
+@author: Lukas Sandström
+"""
+
+from collections import namedtuple
+
+import numpy
+
+IM3Result = namedtuple("IM3Result", [
+    "p_tl_i", "p_tu_i", "p_tl_o", "p_tu_o", "p_im3l_o", "p_im3u_o",  # Powers, dBm
+    "im3l_dbc", "im3u_dbc",  # IM3 relative to the adjacent tone, dBc
+    "oip3_l", "oip3_u", "iip3_l", "iip3_u",  # Third order intercept points, dBm
+    "gain_l", "gain_u",  # Tone gain, dB
+    "asymmetry",  # IM3U - IM3L, dB
+    "tone_imbalance_i", "tone_imbalance_o",  # TU - TL, dB
+])
+
+
+def power_dbm(wave):
+    """
+    Convert wave quantities to power in dBm.
+
+    :param numpy.ndarray wave: Complex or real wave quantities, in sqrt(W)
+    :rtype: numpy.ndarray
+    """
+    p = numpy.abs(wave) ** 2
+    with numpy.errstate(divide="ignore"):
+        return 10 * numpy.log10(p) + 30
+
+
+def im3_analysis(tl_i, tu_i, tl_o, tu_o, im3l_o, im3u_o):
+    """
+    Compute IM3 ratios, intercept points, asymmetry and tone imbalance from the measured waves.
+
+    The lower IM3 product, 2*f_L - f_U, is proportional to P_L^2 * P_U, so the intercept points are calculated
+    with the powers of both tones. This reduces to the usual OIP3 = P_tone + (P_tone - P_IM3) / 2 for equal tones.
+
+    :param tl_i: The lower tone at the DUT input
+    :param tu_i: The upper tone at the DUT input
+    :param tl_o: The lower tone at the DUT output
+    :param tu_o: The upper tone at the DUT output
+    :param im3l_o: The lower IM3 product at the DUT output
+    :param im3u_o: The upper IM3 product at the DUT output
+    :rtype: IM3Result
+    """
+    p_tl_i, p_tu_i, p_tl_o, p_tu_o, p_im3l_o, p_im3u_o = (
+        power_dbm(x) for x in (tl_i, tu_i, tl_o, tu_o, im3l_o, im3u_o))
+
+    im3l_dbc = p_im3l_o - p_tl_o
+    im3u_dbc = p_im3u_o - p_tu_o
+    oip3_l = (2 * p_tl_o + p_tu_o - p_im3l_o) / 2
+    oip3_u = (2 * p_tu_o + p_tl_o - p_im3u_o) / 2
+    gain_l = p_tl_o - p_tl_i
+    gain_u = p_tu_o - p_tu_i
+
+    return IM3Result(p_tl_i=p_tl_i, p_tu_i=p_tu_i, p_tl_o=p_tl_o, p_tu_o=p_tu_o,
+                     p_im3l_o=p_im3l_o, p_im3u_o=p_im3u_o,
+                     im3l_dbc=im3l_dbc, im3u_dbc=im3u_dbc,
+                     oip3_l=oip3_l, oip3_u=oip3_u,
+                     iip3_l=oip3_l - gain_l, iip3_u=oip3_u - gain_u,
+                     gain_l=gain_l, gain_u=gain_u,
+                     asymmetry=p_im3u_o - p_im3l_o,
+                     tone_imbalance_i=p_tu_i - p_tl_i, tone_imbalance_o=p_tu_o - p_tl_o)
+
+
+def analyse_traces(traces):
+    """
+    Run im3_analysis() on the traces read with ZVAIMController.read_traces(), or on a dict of stacked traces.
+
+    :param dict traces: Trace data keyed by trace name
+    :rtype: IM3Result
+    """
+    return im3_analysis(*(traces[x] for x in ("TL_I", "TU_I", "TL_O", "TU_O", "IM3L_O", "IM3U_O")))
+
+
+def stack_traces(sweeps):
+    """
+    Stack the traces from several sweeps into 2-D arrays, one row per sweep.
+
+    :param list of dict sweeps:
+    :rtype: dict
+    """
+    return {k: numpy.stack([s[k] for s in sweeps]) for k in sweeps[0]}
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the instrument communication.
+
+Run the benchmark suite against the simulated ZVA with
+
+    python -m rss_im_sweep.bench --output bench.json [--baseline old_bench.json]
+
+The exit status is 1 if any benchmark has regressed compared to the baseline.
+
+@author: Lukas Sandström
+"""
+
+import argparse
+import io
+import json
+import logging
+import math
+import platform
+import sys
+import time
+import timeit
+
+DEFAULT_ADDRESS = "sim:latency=0.002,time_scale=0"
+
+
+def sim_counters(ctrl):
+    """
+    :return: The round trips and bytes transferred by the simulated instrument of the controller
+    :rtype: (int, int)
+    """
+    if ctrl is None or ctrl.zva is None:
+        return 0, 0
+    res = ctrl.zva._visa_res
+    return res.round_trips, res.bytes_written + res.bytes_read
+
+
+def measure(ctrl, func, *args, repeat=3, setup=None):
+    """
+    Call func(*args) repeat times, with an optional untimed setup() before each call.
+
+    :param ctrl: The controller of the simulated instrument, or a callable returning it, or None
+    :return: {"time": best wall time, "round_trips": n, "bytes": n}, counted for the last call
+    :rtype: dict
+    """
+    get_ctrl = ctrl if callable(ctrl) else (lambda: ctrl)
+    best = None
+    rt = n_bytes = 0
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        rt0, bytes0 = sim_counters(get_ctrl())
+        start = timeit.default_timer()
+        func(*args)
+        t = timeit.default_timer() - start
+        rt1, bytes1 = sim_counters(get_ctrl())
+        rt, n_bytes = rt1 - rt0, bytes1 - bytes0
+        best = t if best is None else min(best, t)
+    return {"time": best, "round_trips": rt, "bytes": n_bytes}
+
+
+def sim_sweep_time(ctrl):
+    """
+    :return: The simulated time of a single sweep of all channels, in seconds
+    :rtype: float
+    """
+    res = ctrl.zva._visa_res
+    return sum(res.sweep_time(ch) for ch in res.channels.values())
+
+
+def bench_model(repeat=3):
+    from rss_im_sweep.main import Model
+    model = Model()
+    buf = io.StringIO()
+    model.store_json(buf)
+    stored = buf.getvalue()
+    return {
+        "model_store_json": measure(None, lambda: model.store_json(io.StringIO()), repeat=repeat),
+        "model_load_json": measure(None, lambda: model.load_json(io.StringIO(stored)), repeat=repeat),
+    }
+
+
+def run_suite(address=DEFAULT_ADDRESS, repeat=3):
+    """
+    Run all benchmarks against the simulated instrument.
+
+    :return: The results, keyed by benchmark name
+    :rtype: dict
+    """
+    from rss_im_sweep.main import Model, ZVAIMController
+    results = {}
+
+    model = Model()
+    model.zva_adress.set(address)
+    ctrl = ZVAIMController(model)
+    results["connect"] = measure(lambda: ctrl, ctrl.connect_vna, repeat=repeat)
+
+    results["configure_sweep"] = measure(ctrl, ctrl.configure_sweep, True, repeat=repeat)
+    results["configure_sweep_unchanged"] = measure(ctrl, ctrl.configure_sweep, repeat=repeat)
+    results["query_zva_settings"] = measure(ctrl, ctrl.query_zva_settings, repeat=repeat)
+
+    def delete_traces():
+        ctrl.zva._visa_res.write(":CALCulate:PARameter:DELete:ALL")
+    results["create_traces"] = measure(ctrl, ctrl.create_traces, repeat=repeat, setup=delete_traces)
+
+    ifbw = [model.if_bandwidth.get()]
+
+    def toggle_ifbw():
+        ifbw[0] = 1e3 if ifbw[0] != 1e3 else 10e3
+        ctrl.set_ifbw(ifbw[0])
+    results["set_ifbw"] = measure(ctrl, toggle_ifbw, repeat=repeat)
+
+    for mode, bulk in (("trace_by_trace", False), ("bulk", True)):
+        results["read_traces_" + mode] = measure(ctrl, ctrl.read_traces, None, "REAL,32", False, bulk,
+                                                 repeat=repeat)
+
+    results["create_cal_channel"] = measure(ctrl, ctrl.create_cal_channel, model.ch_cal.get(), repeat=repeat)
+
+    def switch_modes():
+        ctrl.switch_mode("cal")
+        ctrl.switch_mode("im")
+    switch_modes()  # Store the setups
+    results["switch_mode_recall"] = measure(ctrl, switch_modes, repeat=repeat)
+    results["apply_calibration"] = measure(ctrl, ctrl.apply_calibration, repeat=repeat)
+
+    for mode in ("channels", "segmented"):
+        model.meas_mode.set(mode)
+        ctrl.configure_sweep()
+        results["measure_" + mode] = measure(ctrl, ctrl.read_traces, repeat=repeat)
+        results["measure_" + mode]["sweep_time"] = sim_sweep_time(ctrl)
+    model.meas_mode.set("channels")
+    ctrl.configure_sweep()
+    results["measure_adaptive"] = measure(ctrl, ctrl.measure_adaptive, repeat=repeat)
+    results.update(bench_model(repeat))
+    return results
+
+
+def find_regressions(results, baseline, threshold=0.25, min_time=1e-3):
+    """
+    Compare benchmark results with a baseline.
+    The round trip and byte counts, and the simulated sweep times, are deterministic, any increase is a regression.
+    The wall time may increase by the threshold fraction, or by min_time seconds, whichever is larger.
+
+    :return: A description of each regression
+    :rtype: list of str
+    """
+    ret = []
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if b is None:
+            continue
+        for key in ("round_trips", "bytes"):
+            if r[key] > b[key]:
+                ret.append("%s: %s increased from %d to %d" % (name, key, b[key], r[key]))
+        if r.get("sweep_time", 0) > b.get("sweep_time", math.inf):
+            ret.append("%s: sweep time increased from %.2f ms to %.2f ms" % (
+                name, b["sweep_time"] * 1e3, r["sweep_time"] * 1e3))
+        if r["time"] > b["time"] + max(threshold * b["time"], min_time):
+            ret.append("%s: time increased from %.2f ms to %.2f ms" % (name, b["time"] * 1e3, r["time"] * 1e3))
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the instrument communication against a simulated ZVA")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="simulator address, default %(default)s")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="store the results in this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative time increase")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run_suite(args.address, args.repeat)
+    for name, r in results.items():
+        print("%-28s %9.2f ms %6d round trips %9d bytes" % (name, r["time"] * 1e3, r["round_trips"], r["bytes"]) +
+              (" %9.2f ms sweep" % (r["sweep_time"] * 1e3) if "sweep_time" in r else ""))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({"address": args.address, "python": platform.python_version(), "time": time.time(),
+                       "results": results}, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)["results"]
+        regressions = find_regressions(results, baseline, args.threshold)
+        for r in regressions:
+            print("REGRESSION " + r)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+The frequency plan of the IM channels, computed on the host.
+
+All tone, IM product, receiver, source and image frequencies are computed from the sweep settings, and checked
+against the frequency range of the instrument before anything is sent. write_order() finds the shortest sequence
+of frequency writes which takes a channel from its current frequency configuration to the planned one, without
+passing through a configuration which the instrument rejects with "frequency out of range".
+
+The stimulus of the IM channels is the tone spacing fb, and all frequencies are linear functions of it,
+f = numerator / denominator * fb + offset, so checking the ends of the sweep is enough.
+
+Only the VNA ports are planned. Power sensors and external generators keep the frequency configuration they have
+on the instrument.
+
+@author: Lukas Sandström
+"""
+
+import math
+from collections import deque, namedtuple
+
+import numpy
+
+# (name, fb multiplier of the ARB frequency conversion, LO above RF)
+IM_CHANNELS = (("TL", -1, False), ("TU", 1, True), ("IM3L", -3, False), ("IM3U", 3, True))
+
+RECEIVER_IF = 21e6
+"""The IF of the receivers, used for the image frequencies"""
+
+FreqState = namedtuple("FreqState", [
+    "start", "stop",  # The stimulus range, None if unknown
+    "arb",  # (numerator, denominator, offset) of the receiver ARB frequency conversion, None for fundamental
+    "src_arb",  # ((port, (numerator, denominator, offset)), ...), sorted by port
+])
+
+
+# The frequency configuration of a channel in the segmented measurement mode
+SegmentedState = namedtuple("SegmentedState", [
+    "segments",  # ((start, stop, points), ...), the receiver frequencies of the segments, in increasing order
+    "src_arb",  # ((port, (numerator, denominator, offset)), ...), sorted by port
+])
+
+SEGMENTED_CHANNELS = ("TONE", "IM3")
+
+
+class FrequencyPlanError(ValueError):
+    pass
+
+
+def _in_range(arb, x, min_freq, max_freq):
+    num, den, off = arb
+    f = num / den * x + off
+    return min_freq <= f <= max_freq
+
+
+def _valid_interval(maps, min_freq, max_freq):
+    """
+    :return: The stimulus interval for which all maps are within the frequency range, or None if it is empty
+    :rtype: (float, float)
+    """
+    lo, hi = -math.inf, math.inf
+    for num, den, off in maps:
+        k = num / den
+        if k == 0:
+            if not min_freq <= off <= max_freq:
+                return None
+            continue
+        a, b = (min_freq - off) / k, (max_freq - off) / k
+        lo, hi = max(lo, min(a, b)), min(hi, max(a, b))
+    lo, hi = math.ceil(lo), math.floor(hi)  # Keep the placeholders clear of the limits
+    return (lo, hi) if lo <= hi else None
+
+
+def write_order(current, target, min_freq, max_freq):
+    """
+    Find the shortest sequence of writes which changes the frequency configuration of a channel from current to
+    target, such that every intermediate configuration is within the frequency range of the instrument. Like the
+    ZVA, setting the start above the stop frequency moves the stop frequency, and vice versa.
+
+    Placeholder stimulus ranges are only used if there is no valid order of the target writes.
+
+    :param FreqState current: The current configuration. None, or a FreqState with unknown start and stop,
+                              means a fundamental sweep somewhere within the frequency range.
+    :param FreqState target: The configuration to write, with an ARB receiver conversion
+    :return: [(field, value)], with field "start", "stop", "arb" or "src_arb", and the value of "src_arb" being
+             (port, (numerator, denominator, offset))
+    :rtype: list
+    """
+    if current is None:
+        current = FreqState(None, None, None, ())
+    start = (min_freq, max_freq) if current.start is None else (current.start, current.start)
+    stop = (min_freq, max_freq) if current.stop is None else (current.stop, current.stop)
+    src = dict(current.src_arb)
+    target_src = dict(target.src_arb)
+
+    fund = (1, 1, 0)
+    maps = [current.arb or fund, target.arb] + list(src.values()) + list(target_src.values())
+    candidates = {target.start, target.stop}
+    interval = _valid_interval(maps, min_freq, max_freq)
+    if interval is not None:
+        candidates.update(interval)
+
+    def valid(state):
+        (start_lo, _), (_, stop_hi), arb, src_arb = state
+        for a in (arb or fund,) + tuple(x for _, x in src_arb):
+            if not (_in_range(a, start_lo, min_freq, max_freq) and _in_range(a, stop_hi, min_freq, max_freq)):
+                return False
+        return True
+
+    def step(state, field, value):
+        start, stop, arb, src_arb = state
+        if field == "start":
+            return (value, value), (max(stop[0], value), max(stop[1], value)), arb, src_arb
+        if field == "stop":
+            return (min(start[0], value), min(start[1], value)), (value, value), arb, src_arb
+        if field == "arb":
+            return start, stop, value, src_arb
+        d = dict(src_arb)
+        d[value[0]] = value[1]
+        return start, stop, arb, tuple(sorted(d.items()))
+
+    goal_src = set(target_src.items())
+    initial = (start, stop, current.arb, tuple(sorted(src.items())))
+    prev = {initial: None}
+    queue = deque([initial])
+    while queue:
+        state = queue.popleft()
+        if (state[0] == (target.start, target.start) and state[1] == (target.stop, target.stop) and
+                state[2] == target.arb and goal_src <= set(state[3])):
+            steps = []
+            while prev[state] is not None:
+                state, w = prev[state]
+                steps.append(w)
+            return steps[::-1]
+        writes = [("start", x) for x in candidates] + [("stop", x) for x in candidates]
+        if state[2] != target.arb:
+            writes.append(("arb", target.arb))
+        missing = sorted(goal_src - set(state[3]))
+        if missing:  # The validity of a source write doesn't depend on the other sources, so the order is fixed
+            writes.append(("src_arb", missing[0]))
+        for w in writes:
+            nxt = step(state, *w)
+            if nxt not in prev and valid(nxt):
+                prev[nxt] = (state, w)
+                queue.append(nxt)
+    raise FrequencyPlanError("No valid write order to %s within %g - %g Hz" % (target, min_freq, max_freq))
+
+
+class FrequencyPlan(object):
+    """
+    The frequencies of the IM channels at every sweep point, with the tone spacing as stimulus.
+    All arrays have one value per sweep point.
+    """
+    def __init__(self, center_freq, spacing_start, spacing_stop, sweep_points, src_tl=1, src_tu=3, port_dut_out=2,
+                 ports=(1, 2, 3, 4), receiver_if=RECEIVER_IF, channels=IM_CHANNELS):
+        """
+        :param ports: All ports of the instrument. The ports which don't generate a tone are set to the
+                      center frequency, since the tone spacing is usually below the frequency range.
+        """
+        if not 0 < spacing_start <= spacing_stop:
+            raise FrequencyPlanError("Invalid tone spacing %g - %g Hz" % (spacing_start, spacing_stop))
+        if sweep_points < 1:
+            raise FrequencyPlanError("Invalid number of sweep points %d" % sweep_points)
+        if src_tl == src_tu:
+            raise FrequencyPlanError("The tones must be generated by different ports")
+        cf = center_freq
+        self.center_freq = cf
+        self._ports = (src_tl, src_tu, port_dut_out, ports)
+        self.spacing = numpy.linspace(spacing_start, spacing_stop, int(sweep_points))
+        self.tones = cf + numpy.outer([-0.5, 0.5], self.spacing)
+        """The lower and upper tone"""
+        self.im3 = cf + numpy.outer([-1.5, 1.5], self.spacing)
+        """The lower and upper third order IM products"""
+
+        src = {p: (0, 1, cf) for p in ports}
+        src[src_tl] = (-1, 2, cf)
+        src[src_tu] = (1, 2, cf)
+        src[port_dut_out] = (0, 1, cf)
+        self.src_arb = tuple(sorted(src.items()))
+        """The source frequency conversion of each port in the TL channel"""
+        self.sources = {p: num / den * self.spacing + off for p, (num, den, off) in self.src_arb}
+
+        self.receiver = {}
+        self.images = {}
+        self.states = {}  # type: {str: FreqState}
+        self.segmented = self._segmented_states(((spacing_start, spacing_stop, int(sweep_points)),))
+        """The SegmentedState of the TONE and IM3 channels of the segmented measurement mode"""
+        for name, fb_mult, lo_high in channels:
+            arb = (fb_mult, 2, cf)
+            self.receiver[name] = fb_mult / 2 * self.spacing + cf
+            self.images[name] = self.receiver[name] + (2 if lo_high else -2) * receiver_if
+            self.states[name] = FreqState(spacing_start, spacing_stop, arb, self.src_arb if name == "TL" else ())
+
+    def refined(self, ranges):
+        """
+        The SegmentedState of the TONE and IM3 channels which measure only the given tone spacing ranges, used by
+        the adaptive refinement. The ranges must be within the planned tone spacing, so no new validation is needed.
+
+        :param ranges: ((spacing start, spacing stop, points), ...), in increasing order and not overlapping
+        :rtype: dict
+        """
+        return self._segmented_states(ranges)
+
+    def _segmented_states(self, ranges):
+        """
+        In the segmented mode the stimulus is the receiver frequency. The first half of the segments of each
+        channel measures the lower tone or IM3 product, the second half the upper one. The source ports are mirrored
+        around the center frequency, so the first half sweeps the tone spacing downwards.
+
+        TONE: f_rx = fb, src_tl = fb, src_tu = 2 cf - fb
+        IM3:  f_rx = fb, src_tl = (fb + 2 cf) / 3, src_tu = (4 cf - fb) / 3
+        """
+        cf = self.center_freq
+        src_tl, src_tu, port_dut_out, ports = self._ports
+        ret = {}
+        for name, k, tl, tu in (("TONE", 0.5, (1, 1, 0), (-1, 1, 2 * cf)),
+                                ("IM3", 1.5, (1, 3, 2 * cf / 3), (-1, 3, 4 * cf / 3))):
+            src = {p: (0, 1, cf) for p in ports}
+            src[src_tl] = tl
+            src[src_tu] = tu
+            src[port_dut_out] = (0, 1, cf)
+            lower = tuple((cf - k * d2, cf - k * d1, n) for d1, d2, n in reversed(ranges))
+            upper = tuple((cf + k * d1, cf + k * d2, n) for d1, d2, n in ranges)
+            segments = lower + upper
+            ret[name] = SegmentedState(segments, tuple(sorted(src.items())))
+        return ret
+
+    def validate(self, min_freq, max_freq, image_tolerance=0.0):
+        """
+        Check that all receiver and source frequencies are within the frequency range of the instrument, and that
+        no receiver image is within image_tolerance of a tone.
+
+        :raises FrequencyPlanError:
+        """
+        checks = [("%s receiver" % name, f) for name, f in self.receiver.items()]
+        checks += [("port %d source" % p, f) for p, f in sorted(self.sources.items())]
+        for what, f in checks:
+            bad = (f < min_freq) | (f > max_freq)
+            if numpy.any(bad):
+                i = int(numpy.argmax(bad))
+                raise FrequencyPlanError("The %s frequency %.6g MHz at %.6g MHz tone spacing is outside the "
+                                         "instrument range %.6g - %.6g MHz" % (
+                                             what, f[i] / 1e6, self.spacing[i] / 1e6, min_freq / 1e6, max_freq / 1e6))
+        if image_tolerance > 0:
+            for name, f in self.images.items():
+                dist = numpy.min(numpy.abs(self.tones - f), axis=0)
+                if numpy.any(dist < image_tolerance):
+                    i = int(numpy.argmax(dist < image_tolerance))
+                    raise FrequencyPlanError("The image of the %s receiver is on a tone at %.6g MHz tone spacing" % (
+                        name, self.spacing[i] / 1e6))
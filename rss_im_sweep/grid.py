@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Measurement of the IM traces over a grid of tone powers and tone spacing blocks, for IP3 extraction.
+
+Changing the tone spacing range means rewriting the frequency conversions of all IM channels, while changing the
+tone power is a single setting, so the grid is measured with the spacing blocks in the outer loop and the powers in
+the inner loop. In the four channel mode, several powers are measured in one sweep by repeating the spacing range
+as segments with per-segment power.
+
+Every completed (block, power) slice is stored in its own .npz file as soon as it has been measured, and recorded
+in a JSON manifest, so an interrupted grid can be resumed by running it again with the same directory:
+
+    store = GridStore("grid_run", GridScheduler.definition(ctrl.model, blocks, powers))
+    GridScheduler(ctrl, store, blocks, powers).run()
+
+@author: Lukas Sandström
+"""
+
+import json
+import logging
+import os
+from collections import namedtuple
+
+import numpy
+
+from rss_im_sweep.readout import TraceData
+
+MAX_POINTS = 60001
+"""The maximum number of points in a channel"""
+
+GridBlock = namedtuple("GridBlock", ["spacing_start", "spacing_stop", "points"])
+
+
+def grid_order(blocks, powers):
+    """
+    The order in which to measure the grid. The blocks are measured one after another, and the power direction is
+    reversed for every other block, so that there is never a large power step.
+
+    :param blocks: The spacing blocks
+    :param powers: The tone powers
+    :return: [(block index, [power index, ...])]
+    :rtype: list
+    """
+    ret = []
+    for b in range(len(blocks)):
+        p = list(range(len(powers)))
+        ret.append((b, p[::-1] if b % 2 else p))
+    return ret
+
+
+def power_groups(indices, points, segment_power=True):
+    """
+    Split the power indices of a block into the groups which are measured with one sweep.
+
+    :param list indices: The power indices, in measurement order
+    :param int points: The number of points of the block
+    :param bool segment_power: Measure several powers per sweep, with one segment per power
+    :rtype: list of list
+    """
+    n = max(1, MAX_POINTS // points) if segment_power else 1
+    return [indices[i:i + n] for i in range(0, len(indices), n)]
+
+
+def slice_name(block, power):
+    return "b%03d_p%03d" % (block, power)
+
+
+class GridStore(object):
+    """
+    The measured slices of a grid, in a directory with one .npz file per slice and a manifest.json.
+    """
+    manifest_name = "manifest.json"
+
+    def __init__(self, path, definition):
+        """
+        Create the directory, or open it to resume the grid.
+
+        :param str path: The directory
+        :param dict definition: The grid and the instrument settings, JSON serializable. A stored grid can only be
+                                resumed with the same definition.
+        :raises ValueError: If the directory contains a grid with a different definition
+        """
+        self.path = path
+        self.definition = json.loads(json.dumps(definition))  # Compare as stored, with lists instead of tuples
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, self.manifest_name)
+        self.completed = []
+        if os.path.exists(manifest):
+            with open(manifest) as fp:
+                stored = json.load(fp)
+            if stored["definition"] != self.definition:
+                raise ValueError("%s contains a different grid" % path)
+            self.completed = stored["completed"]
+        else:
+            self._write_manifest()
+
+    def _write_manifest(self):
+        tmp = os.path.join(self.path, self.manifest_name + ".tmp")
+        with open(tmp, "w") as fp:
+            json.dump({"definition": self.definition, "completed": self.completed}, fp, indent=2)
+        os.replace(tmp, os.path.join(self.path, self.manifest_name))  # Never leave a partial manifest
+
+    def is_done(self, block, power):
+        return slice_name(block, power) in self.completed
+
+    def save(self, block, power, data, power_dbm):
+        """
+        Store a measured slice, and mark it completed.
+
+        :param TraceData data: The traces of the slice
+        :param float power_dbm: The tone power
+        """
+        name = slice_name(block, power)
+        numpy.savez(os.path.join(self.path, name + ".npz"), spacing=data.spacing, power=power_dbm, **data)
+        self.completed.append(name)
+        self._write_manifest()
+
+    def load(self, block, power):
+        """
+        :rtype: TraceData
+        """
+        with numpy.load(os.path.join(self.path, slice_name(block, power) + ".npz")) as f:
+            return TraceData(((k, f[k]) for k in f.files if k not in ("spacing", "power")), spacing=f["spacing"])
+
+    def load_block(self, block):
+        """
+        The completed slices of a block, stacked with one row per power, in the order of the grid powers.
+
+        :return: The stacked traces and the powers, or None if no slice of the block is completed
+        :rtype: (TraceData, numpy.ndarray)
+        """
+        powers = [i for i, _ in enumerate(self.definition["powers"]) if self.is_done(block, i)]
+        if not powers:
+            return None
+        slices = [self.load(block, i) for i in powers]
+        ret = TraceData(((k, numpy.stack([s[k] for s in slices])) for k in slices[0]), spacing=slices[0].spacing)
+        return ret, numpy.array(self.definition["powers"])[powers]
+
+
+class GridScheduler(object):
+    """
+    Measure a grid with a connected ZVAIMController, without changing the model.
+    """
+    def __init__(self, ctrl, store, blocks, powers, segment_power=True):
+        """
+        :param rss_im_sweep.main.ZVAIMController ctrl:
+        :param GridStore store:
+        :param blocks: [GridBlock]
+        :param powers: The tone powers, dBm
+        :param bool segment_power: Use one segment per power in the four channel mode
+        """
+        self.ctrl = ctrl
+        self.store = store
+        self.blocks = [GridBlock(*b) for b in blocks]
+        self.powers = list(powers)
+        self.segment_power = segment_power
+
+    @staticmethod
+    def definition(model, blocks, powers):
+        """
+        The grid definition for GridStore, with the model settings which affect the measurement.
+        """
+        keys = ("center_freq", "if_bandwidth", "if_selectivity", "meas_mode", "src_tl", "src_tu", "port_dut_out")
+        d = {k: model.vars[k].get() for k in keys}
+        d.update(blocks=[list(b) for b in blocks], powers=list(powers))
+        return d
+
+    def remaining(self):
+        """
+        :return: The number of slices which are not completed
+        """
+        return sum(not self.store.is_done(b, p) for b in range(len(self.blocks)) for p in range(len(self.powers)))
+
+    def run(self, progress=None):
+        """
+        Measure all slices which aren't already completed. Run this in the instrument worker thread, e.g. with
+        Controller.run_job(). Each block and power is applied with ZVAIMController.overrides and configure_sweep(),
+        so the model isn't changed, and the previous sweep settings are applied again when the grid is done or fails.
+
+        :param progress: Called in the calling thread with (block index, power index) after each stored slice
+        """
+        ctrl = self.ctrl
+        saved = dict(ctrl.overrides)
+        segment_power = self.segment_power and ctrl.setting("meas_mode") != "segmented"
+        try:
+            for b, order in grid_order(self.blocks, self.powers):
+                todo = [p for p in order if not self.store.is_done(b, p)]
+                if not todo:
+                    continue
+                block = self.blocks[b]
+                ctrl.overrides.update(spacing_start=block.spacing_start, spacing_stop=block.spacing_stop,
+                                      sweep_points=block.points)
+                ctrl.configure_sweep()
+                logging.info("Grid block %d, %g - %g Hz, %d powers", b, block.spacing_start, block.spacing_stop,
+                             len(todo))
+                for group in power_groups(todo, block.points, segment_power):
+                    self._measure(b, group, segment_power, progress)
+        finally:
+            ctrl.overrides = saved
+            ctrl.configure_sweep()  # Also removes the power segments
+
+    def _measure(self, block, group, segment_power, progress):
+        ctrl = self.ctrl
+        if segment_power:
+            b = self.blocks[block]
+            ctrl.set_segments(tuple((b.spacing_start, b.spacing_stop, b.points, self.powers[p]) for p in group))
+            data = ctrl.read_traces()
+            slices = [TraceData(((k, v[i * b.points:(i + 1) * b.points]) for k, v in data.items()),
+                                spacing=data.spacing[i * b.points:(i + 1) * b.points]) for i in range(len(group))]
+        else:
+            ctrl.overrides["base_power"] = self.powers[group[0]]
+            ctrl.configure_sweep()  # Only writes the power
+            slices = [ctrl.read_traces()]
+        for p, data in zip(group, slices):
+            self.store.save(block, p, data, self.powers[p])
+            if progress is not None:
+                progress(block, p)
@@ -6,9 +6,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 
-from tk_zva import FreqEntry, IFFreqSpinbox, PowerEntry, PowerSpinbox, IntEntry, ZVASoftkeys
+from tk_zva import FreqEntry, IFFreqSpinbox, PowerEntry, PowerSpinbox, IntEntry, TimeEntry, DBEntry, ZVASoftkeys
 from .tkSimpleDialog import Dialog
 
 
@@ -49,6 +49,72 @@ class ConfigDialog(Dialog):
                         onvalue=True, offvalue=False).grid(row=0, column=0, columnspan=2)
 
 
+class DiagnosticsDialog(Dialog):
+    """
+    Shows the VISA call statistics per controller operation, see rss_im_sweep.instrumentation.VisaStats.
+    """
+    def __init__(self, parent, stats, tk_latency=None, subscriber_counts=None):
+        """
+        :param rss_im_sweep.instrumentation.VisaStats stats:
+        :param rss_im_sweep.instrumentation.LatencyHistogram tk_latency: The event latency of the Tk thread
+        :param subscriber_counts: Returns the number of observers of each model variable
+        """
+        self.stats = stats
+        self.tk_latency = tk_latency
+        self.subscriber_counts = subscriber_counts
+        super().__init__(parent, title="VISA diagnostics")
+
+    def body(self, frame):
+        columns = (("op", "Operation", 160), ("calls", "Calls", 60), ("total", "Total [ms]", 80),
+                   ("mean", "Mean [ms]", 80), ("max", "Max [ms]", 80), ("bytes", "Bytes", 80))
+        t = self.tree = ttk.Treeview(frame, columns=[c[0] for c in columns], height=12)
+        t.column("#0", minwidth=0, width=0)
+        for name, text, width in columns:
+            t.heading(name, text=text)
+            t.column(name, width=width, anchor="w" if name == "op" else "e")
+        t.grid(row=0, column=0, sticky="news")
+        self.latency_label = ttk.Label(frame)
+        self.latency_label.grid(row=1, column=0, sticky="w")
+        self.observers_label = ttk.Label(frame)
+        self.observers_label.grid(row=2, column=0, sticky="w")
+        self.refresh()
+
+    def buttonbox(self):
+        box = ttk.Frame(self)
+        ttk.Button(box, text="Refresh", command=self.refresh).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(box, text="Reset", command=self.reset).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(box, text="Save JSON...", command=self.save_json).pack(side=tk.LEFT, padx=5, pady=5)
+        ttk.Button(box, text="Close", command=self.cancel).pack(side=tk.LEFT, padx=5, pady=5)
+        self.bind("<Escape>", self.cancel)
+        box.pack()
+
+    def refresh(self):
+        self.tree.delete(*self.tree.get_children())
+        for op, n, total, mean, max_, n_bytes in self.stats.summary():
+            self.tree.insert("", "end", values=(op, n, "%.1f" % (total * 1e3), "%.2f" % (mean * 1e3),
+                                                "%.2f" % (max_ * 1e3), n_bytes))
+        if self.tk_latency is not None:
+            h = self.tk_latency
+            self.latency_label["text"] = "Tk event latency: mean %.1f ms, 95%% < %.1f ms, max %.1f ms (%d events)" % (
+                h.mean * 1e3, h.percentile(95) * 1e3, h.max * 1e3, h.n)
+        if self.subscriber_counts is not None:
+            counts = self.subscriber_counts()
+            name = max(counts, key=counts.get)
+            self.observers_label["text"] = "Model observers: %d, most on %s (%d)" % (
+                sum(counts.values()), name, counts[name])
+
+    def reset(self):
+        self.stats.reset()
+        self.refresh()
+
+    def save_json(self):
+        filename = filedialog.asksaveasfilename(parent=self, defaultextension=".json",
+                                                filetypes=[("JSON", "*.json")])
+        if filename:
+            with open(filename, "w") as fp:
+                self.stats.dump_json(fp)
+
+
 class IMSweepSoftkeys(ZVASoftkeys):
     def __init__(self, main_window, **kwargs):
         super().__init__(**kwargs)
@@ -78,6 +144,8 @@ class CalibrationFrame(ttk.Labelframe):
         ttk.Label(self, text="Cal group name").grid(row=0, column=0, sticky="e")
         self.calgroup_select = ttk.Combobox(self)
         self.calgroup_select.grid(row=0, column=1, sticky="w")
+        self.refresh_calpool_button = ttk.Button(self, text="Refresh")
+        self.refresh_calpool_button.grid(row=0, column=2, sticky="w")
 
         ttk.Label(self, text="Cal base power").grid(row=1, column=0, sticky="e")
         self.power_level = PowerEntry(self, valuevar=master.add_var("cal_power", -10, type_=tk.DoubleVar))
@@ -121,6 +189,11 @@ class ZVAControlFrame(ttk.Labelframe):
         ttk.Label(self, text="IF bandwidth").grid(column=0, row=row, sticky="e")
         IFFreqSpinbox(self, valuevar=master.add_var("if_bandwidth", type_=tk.DoubleVar), width=10).grid(row=row, **grid_c1)
 
+        row += 1
+        ttk.Label(self, text="Tone IF bandwidth, segmented").grid(column=0, row=row, sticky="e")
+        IFFreqSpinbox(self, valuevar=master.add_var("tone_if_bandwidth", type_=tk.DoubleVar), width=10)\
+            .grid(row=row, **grid_c1)
+
         row += 1
         fr_selectivity = ttk.Frame(self)
         fr_selectivity.grid(column=1, row=row, sticky="w")
@@ -133,6 +206,32 @@ class ZVAControlFrame(ttk.Labelframe):
         ttk.Combobox(self, textvariable=master.add_var("trigger_source"), width=10,
                      values=("Free run", "Pulse"), state="readonly").grid(row=row, **grid_c1)
 
+        row += 1
+        ttk.Label(self, text="Measurement time").grid(column=0, row=row, sticky="e")
+        ttk.Label(self, textvariable=master.add_var("sweep_estimate")).grid(row=row, columnspan=2, **grid_c1)
+
+        row += 1
+        ttk.Label(self, text="Time budget").grid(column=0, row=row, sticky="e")
+        TimeEntry(self, valuevar=master.add_var("time_budget", type_=tk.DoubleVar), width=10).grid(row=row, **grid_c1)
+        self.fit_time_budget = ttk.Button(self, text="Fit")
+        self.fit_time_budget.grid(row=row, column=2)
+
+        row += 1
+        ttk.Label(self, text="IM3 dynamic range").grid(column=0, row=row, sticky="e")
+        DBEntry(self, valuevar=master.add_var("required_dynamic_range", type_=tk.DoubleVar), width=10)\
+            .grid(row=row, **grid_c1)
+        self.fit_dynamic_range = ttk.Button(self, text="Fit")
+        self.fit_dynamic_range.grid(row=row, column=2)
+
+        row += 1
+        ttk.Label(self, text="Output level per tone").grid(column=0, row=row, sticky="e")
+        PowerEntry(self, valuevar=master.add_var("output_level", type_=tk.DoubleVar), width=10).grid(row=row, **grid_c1)
+        self.level_output = ttk.Button(self, text="Level")
+        self.level_output.grid(row=row, column=2)
+        row += 1
+        ttk.Checkbutton(self, text="Per tone spacing point", onvalue=True, offvalue=False,
+                        variable=master.add_var("level_per_point", type_=tk.BooleanVar)).grid(row=row, **grid_c1)
+
 
 class TraceConfigDialog(Dialog):
     def body(self, master):
@@ -186,6 +285,7 @@ class MainMenubar(tk.Menu):
         file.add_command(label="Exit", command=self.set_command("exit"))
 
         self.add_command(label="Settings...", command=self.set_command("settings"))
+        self.add_command(label="Diagnostics...", command=self.set_command("diagnostics"))
 
         help = tk.Menu(self)
         self.add_cascade(menu=help, label="Help")
@@ -246,11 +346,14 @@ class MainWindow(ttk.Frame):
         ttk.Label(fr_sweep, text="Spacing start").grid(column=0, row=1, sticky="e")
         ttk.Label(fr_sweep, text="Spacing stop").grid(column=0, row=2, sticky="e")
         ttk.Label(fr_sweep, text="Sweep points").grid(column=0, row=3, sticky="e")
+        ttk.Label(fr_sweep, text="Measurement mode").grid(column=0, row=4, sticky="e")
 
         FreqEntry(fr_sweep, valuevar=self.add_var("center_freq", type_=tk.DoubleVar), prefix="g").grid(column=1, row=0)
         FreqEntry(fr_sweep, valuevar=self.add_var("spacing_start", type_=tk.DoubleVar), prefix="m").grid(column=1, row=1)
         FreqEntry(fr_sweep, valuevar=self.add_var("spacing_stop", type_=tk.DoubleVar), prefix="m").grid(column=1, row=2)
         IntEntry(fr_sweep, intvar=self.add_var("sweep_points", type_=tk.IntVar)).grid(column=1, row=3)
+        ttk.Combobox(fr_sweep, textvariable=self.add_var("meas_mode"), values=("channels", "segmented"),
+                     width=10, state="readonly").grid(column=1, row=4, sticky="w")
 
         self.apply_sweep = ttk.Button(fr_sweep, text="Apply")
         self.apply_sweep.grid(column=1, row=10, sticky="e")
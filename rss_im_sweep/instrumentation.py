@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Counting and timing of the VISA traffic, per controller operation.
+
+InstrumentedResource wraps the pyvisa resource of an instrument, and records each write, query and read in a
+VisaStats instance. The calls are attributed to the outermost operation() active in the calling thread, e.g. the
+name of the instrument worker job, or to UNATTRIBUTED.
+
+@author: Lukas Sandström
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import timeit
+
+UNATTRIBUTED = "(other)"
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def operation(name):
+    """
+    Attribute the VISA calls made by the current thread within the context to the named operation.
+    Nested operations are attributed to the outermost operation.
+    """
+    stack = _context.__dict__.setdefault("stack", [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def current_operation():
+    stack = getattr(_context, "stack", None)
+    return stack[0] if stack else UNATTRIBUTED
+
+
+class LatencyHistogram(object):
+    """
+    A histogram with logarithmic bins, from 100 us to 10 s.
+    """
+    edges = [1e-4 * 10 ** (i / 4) for i in range(21)]  # Four bins per decade
+
+    def __init__(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, t):
+        self.counts[bisect.bisect_right(self.edges, t)] += 1
+        self.n += 1
+        self.total += t
+        self.max = max(self.max, t)
+
+    @property
+    def mean(self):
+        return self.total / self.n if self.n else 0.0
+
+    def percentile(self, p):
+        """
+        :return: The upper edge of the bin containing the p:th percentile
+        """
+        if not self.n:
+            return 0.0
+        limit = p / 100 * self.n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= limit:
+                return self.edges[i] if i < len(self.edges) else self.max
+        return self.max
+
+    def as_dict(self):
+        return {"n": self.n, "total": self.total, "mean": self.mean, "max": self.max,
+                "p50": self.percentile(50), "p95": self.percentile(95),
+                "bins": [[self.edges[i] if i < len(self.edges) else None, c]
+                         for i, c in enumerate(self.counts) if c]}
+
+
+class VisaStats(object):
+    """
+    The VISA call statistics, by operation and call kind ("write", "query" or "read"). Thread safe.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops = {}  # type: {str: {str: LatencyHistogram}}
+        self.bytes = {}  # type: {str: int}
+
+    def record(self, kind, t, n_bytes=0, op=None):
+        op = current_operation() if op is None else op
+        with self._lock:
+            hist = self._ops.setdefault(op, {}).get(kind)
+            if hist is None:
+                hist = self._ops[op][kind] = LatencyHistogram()
+            hist.add(t)
+            self.bytes[op] = self.bytes.get(op, 0) + n_bytes
+
+    def reset(self):
+        with self._lock:
+            self._ops.clear()
+            self.bytes.clear()
+
+    def summary(self):
+        """
+        :return: One row per operation: (operation, calls, total time, mean time, max time, bytes),
+                 sorted by the total time
+        :rtype: list of tuple
+        """
+        rows = []
+        with self._lock:
+            for op, kinds in self._ops.items():
+                n = sum(h.n for h in kinds.values())
+                total = sum(h.total for h in kinds.values())
+                rows.append((op, n, total, total / n, max(h.max for h in kinds.values()), self.bytes.get(op, 0)))
+        return sorted(rows, key=lambda r: r[2], reverse=True)
+
+    def as_dict(self):
+        with self._lock:
+            return {op: {"bytes": self.bytes.get(op, 0), "calls": {k: h.as_dict() for k, h in kinds.items()}}
+                    for op, kinds in self._ops.items()}
+
+    def dump_json(self, fp):
+        json.dump(self.as_dict(), fp, indent=2)
+
+
+class InstrumentedResource(object):
+    """
+    A proxy for a pyvisa resource, recording each call in a VisaStats instance.
+    All other attributes, e.g. timeout and read_termination, are forwarded to the resource.
+    """
+    def __init__(self, resource, stats):
+        object.__setattr__(self, "_resource", resource)
+        object.__setattr__(self, "stats", stats)
+
+    def __getattr__(self, item):
+        return getattr(self._resource, item)
+
+    def __setattr__(self, key, value):
+        setattr(self._resource, key, value)
+
+    def write(self, message, *args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return self._resource.write(message, *args, **kwargs)
+        finally:
+            self.stats.record("write", timeit.default_timer() - start, len(message))
+
+    def query(self, message, *args, **kwargs):
+        start = timeit.default_timer()
+        ret = ""
+        try:
+            ret = self._resource.query(message, *args, **kwargs)
+            return ret
+        finally:
+            self.stats.record("query", timeit.default_timer() - start, len(message) + len(ret))
+
+    def read(self, *args, **kwargs):
+        return self._read(self._resource.read, *args, **kwargs)
+
+    def read_raw(self, *args, **kwargs):
+        return self._read(self._resource.read_raw, *args, **kwargs)
+
+    def _read(self, func, *args, **kwargs):
+        start = timeit.default_timer()
+        ret = b""
+        try:
+            ret = func(*args, **kwargs)
+            return ret
+        finally:
+            self.stats.record("read", timeit.default_timer() - start, len(ret))
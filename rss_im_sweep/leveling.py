@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Closed loop leveling of the tone powers at the DUT output.
+
+The output power of each tone is a smooth, increasing function of its source power, with a slope close to 1 dB/dB
+below compression. The source power is updated with the secant method, starting with a slope of 1, so a DUT
+which is linear converges in one or two sweeps and a compressing DUT in a few more.
+
+Both tones can be leveled globally, with the source power offset of each tone port, or per tone spacing point,
+with one segment per point in the four channel mode. Since the offsets apply to the whole sweep, the per point
+leveling can only set the mean level of the two tones at each point; any per point imbalance remains and is
+reported in the achieved levels. See ZVAIMController.level_output().
+
+Each tone is leveled with the port which generates it, so the leveling needs the four channel mode, where TL_O is
+always the output of the lower tone port and TU_O of the upper tone port. In the segmented mode the tone ports swap
+roles between the halves of the sweep.
+
+@author: Lukas Sandström
+"""
+
+from collections import namedtuple
+
+import numpy
+
+LevelingResult = namedtuple("LevelingResult", [
+    "converged", "iterations",
+    "tl_o", "tu_o",  # The achieved output power of the lower and upper tone, dBm
+    "offsets",  # {port: source power offset, dB}
+    "segment_power",  # The source power of each point in the per point leveling, otherwise None
+])
+
+
+class SecantLeveler(object):
+    """
+    The secant iteration for any number of independent levels.
+    """
+    def __init__(self, target, tolerance=0.1, max_iterations=6, min_slope=0.2, max_slope=2.0, max_step=10.0):
+        """
+        :param target: The target output level, dBm, scalar or array
+        :param float tolerance: The allowed deviation from the target, dB
+        :param int max_iterations: The maximum number of updates
+        :param float min_slope: The slope estimate is limited to min_slope - max_slope dB/dB, so that noise in a
+                                measurement or a DUT in hard compression doesn't cause a huge step
+        :param float max_step: The largest change of a source power in one update, dB
+        """
+        self.target = target
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.min_slope = min_slope
+        self.max_slope = max_slope
+        self.max_step = max_step
+        self.iterations = 0
+        self._last = None  # (x, y) of the previous measurement
+
+    def error(self, y):
+        return numpy.asarray(self.target) - y
+
+    def is_done(self, y):
+        """
+        :return: True if the levels are within the tolerance, or the iterations are exhausted
+        """
+        return bool(numpy.all(numpy.abs(self.error(y)) <= self.tolerance)) or self.iterations >= self.max_iterations
+
+    def update(self, x, y):
+        """
+        :param x: The source power of the measurement, dBm
+        :param y: The measured output power, dBm
+        :return: The next source power
+        """
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        slope = numpy.ones_like(y)
+        if self._last is not None:
+            dx = x - self._last[0]
+            moved = numpy.abs(dx) > 1e-6
+            slope = numpy.where(moved, (y - self._last[1]) / numpy.where(moved, dx, 1), slope)
+        slope = numpy.clip(slope, self.min_slope, self.max_slope)
+        self._last = x, y
+        self.iterations += 1
+        return x + numpy.clip(self.error(y) / slope, -self.max_step, self.max_step)
+
+
+def split_tone_powers(x_l, x_u):
+    """
+    Split the wanted source powers of the two tones at each point into a common power per point and one
+    offset per tone, which is what the instrument can set.
+
+    :return: The power of each point, the offset of the lower tone and the offset of the upper tone
+    :rtype: (numpy.ndarray, float, float)
+    """
+    half = float(numpy.mean(x_u - x_l)) / 2
+    return (x_l + x_u) / 2, -half, half
+
+
+def level_tones(measure, x_l, x_u, leveler, per_point=False):
+    """
+    The leveling loop for the two tones. The power of each tone port is only updated from the measured output of
+    the tone it generates, so the ports may have different gain to the DUT output.
+
+    :param measure: Called with the source power of the lower and the upper tone port, dBm, applies them and
+                    returns the measured output power of the lower and the upper tone, dBm, one value per point
+    :param x_l: The initial source power of the lower tone port, scalar, or one value per point if per_point
+    :param x_u: The initial source power of the upper tone port
+    :param SecantLeveler leveler:
+    :param bool per_point: Level each point, with split_tone_powers() applied before each measurement.
+                           Otherwise the median output power of each tone is leveled.
+    :return: The source powers and the output powers of the last measurement, (x_l, x_u, y_l, y_u)
+    """
+    while True:
+        if per_point:
+            common, o_l, o_u = split_tone_powers(x_l, x_u)
+            x_l, x_u = common + o_l, common + o_u
+        y_l, y_u = measure(x_l, x_u)
+        y = numpy.concatenate([y_l, y_u]) if per_point else numpy.array([numpy.median(y_l), numpy.median(y_u)])
+        if leveler.is_done(y):
+            return x_l, x_u, y_l, y_u
+        x_l, x_u = numpy.split(leveler.update(numpy.hstack([x_l, x_u]), y), 2)
+        if not per_point:
+            x_l, x_u = float(x_l[0]), float(x_u[0])
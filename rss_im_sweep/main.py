@@ -7,16 +7,38 @@
 import tkinter as tk
 from tkinter import messagebox
 
+import contextlib
+import copy
 import logging
 import queue
+import timeit
+import weakref
 from collections import namedtuple
 
+import numpy
 import RSSscpi.zva
 from RSSscpi.zva import Trace
-import threading
 import pyvisa
 
-from rss_im_sweep.gui import MainWindow, ConfigDialog, MinimizedWindow, IMSweepSoftkeys
+from rss_im_sweep.adaptive import merge_traces, refine
+from rss_im_sweep.analysis import power_dbm
+
+from rss_im_sweep.freq_plan import FrequencyPlan, FrequencyPlanError, FreqState, IM_CHANNELS, SEGMENTED_CHANNELS, \
+    SegmentedState, write_order
+from rss_im_sweep.gui import MainWindow, ConfigDialog, DiagnosticsDialog, MinimizedWindow, IMSweepSoftkeys
+from rss_im_sweep.scpi_batch import SCPIBatch, check_errors
+from rss_im_sweep.segmented import segmented_traces, unfold_segments
+from rss_im_sweep.readback import read_snapshots
+from rss_im_sweep.readout import TraceData, real_formats, block_to_array, demux, query_block, split_response
+from rss_im_sweep.instrumentation import InstrumentedResource, VisaStats
+from rss_im_sweep.observers import ObserverRegistry
+from rss_im_sweep.leveling import LevelingResult, SecantLeveler, level_tones, split_tone_powers
+from rss_im_sweep.setups import SetupStore, setup_key
+from rss_im_sweep.sweep_time import SweepTimeModel, optimize
+from rss_im_sweep.tk_bridge import TkDispatcher
+from rss_im_sweep.visa_log import VisaLog
+from rss_im_sweep.worker import InstrumentWorker, CoalescingDispatcher
+from rss_im_sweep.zva_sim import connect_simulated, parse_sim_address
 
 
 class VISAFilter(logging.Filter):
@@ -46,6 +68,48 @@ class ZVAIMController(object):
         self.zva = None  # type: RSSscpi.zva.ZVA
 
         self.ch = {}  # type: {str: RSSscpi.zva.Channel}
+        self.batching = True  # Send the configuration commands as semicolon joined messages
+
+        self._applied = {}  # type: {str: dict}
+        """The settings last sent to each IM channel, by channel name"""
+        self._applied_topology = None
+        """The ports and channel numbers used when the IM channels were last built, None forces a rebuild"""
+        self._cal_channel_on = False
+        self._cal_points = 0
+        self.sweep_timeout = 60  # seconds
+        self.check_abort = None
+        """Called before each sweep, so that long measurements can be aborted, see InstrumentWorker.check_abort()"""
+        self.overrides = {}
+        """Sweep settings which replace the model variables with the same name, see setting()"""
+        self.bulk_readout = True  # Read all traces with a single query in read_traces()
+        self.trace_catalog = dict(self.wave_traces)
+        """The traces to read in read_traces(), and the name of the channel they belong to"""
+        self.visa_stats = VisaStats()
+        """The number and duration of the VISA calls, by controller operation"""
+        self.visa_log = None  # type: VisaLog
+        self._calpool = None  # type: list
+        """The cached cal pool list, None if it must be read from the instrument"""
+        self.setups = SetupStore()
+        self.use_setup_recall = True  # Recall stored instrument setups when switching mode
+        self.mode = None
+        """The measurement mode of the instrument setup, see switch_mode()"""
+        self.freq_limits = (10e6, 24e9)
+        """The frequency range of the instrument, read when connecting"""
+        self.ports = (1, 2, 3, 4)
+        self.image_tolerance = 10  # Minimum distance between a receiver image and a tone, in IF bandwidths
+        self.sweep_model = SweepTimeModel()
+        """The measurement time model, calibrated with the sweep times reported by the instrument"""
+        self.sweep_time = None  # The sum of the channel sweep times reported by the instrument, s
+        self.tone_power = None  # The median output tone power in the last readout, dBm
+
+    def batch(self, name):
+        """
+        Returns a context manager which collects the SCPI writes into as few messages as possible.
+
+        :param str name: The name of the operation, used for logging the number of saved round trips
+        :rtype: SCPIBatch
+        """
+        return SCPIBatch(self.zva, name=name, enabled=self.batching)
 
     def setup_trace_model(self):
         t = self.model.traces.get()  # type: TraceModel
@@ -53,120 +117,736 @@ class ZVAIMController(object):
 
     def connect_vna(self):
         """
-        This method is run in a diffrent thread than the mainloop.
+        This method, like all methods which communicate with the instrument, is run in the instrument worker thread.
         Do not set variables in the model here, since the callbacks would be invoked in this thread
         """
-        self.zva = RSSscpi.zva.connect_ethernet(self.model.zva_adress.get())  # type: RSSscpi.zva.ZVA
+        address = self.model.zva_adress.get()
+        sim_args = parse_sim_address(address)
+        if sim_args is not None:
+            self.zva = connect_simulated(**sim_args)  # type: RSSscpi.zva.ZVA
+        else:
+            self.zva = RSSscpi.zva.connect_ethernet(address)  # type: RSSscpi.zva.ZVA
+        self.zva._visa_res = InstrumentedResource(self.zva._visa_res, self.visa_stats)
         self.zva.exception_on_error = False
         self.zva.visa_logger.setLevel(logging.INFO)
-        self.zva.visa_logger.addHandler(logging.FileHandler(filename=__file__[:-3] + "_visa_log.txt", mode="w"))
+        if self.visa_log is not None:
+            self.visa_log.close()
+        self.visa_log = VisaLog(self.zva.visa_logger, filename=__file__[:-3] + "_visa_log.txt")
         self.zva.update_display(True)
+        self._read_instrument_limits()
+        self._map_channels()
+        self.calpool(refresh=True)
+        self.setups.discard()
+        self.mode = None
+
+    def _read_instrument_limits(self):
+        with self.zva._visa_lock:
+            response = str(self.zva._query(
+                "SYSTem:FREQuency? MINimum;:SYSTem:FREQuency? MAXimum;:INSTrument:PORT:COUNt?"))
+        min_freq, max_freq, n_ports = response.strip().split(";")
+        self.freq_limits = (float(min_freq), float(max_freq))
+        self.ports = tuple(range(1, int(float(n_ports)) + 1))
+
+    # The model variables which affect the instrument setup of each mode
+    _im_setup_vars = ("center_freq", "spacing_start", "spacing_stop", "sweep_points", "if_bandwidth",
+                      "if_selectivity", "base_power", "trigger_source", "calgroup", "src_tl", "src_tu",
+                      "port_dut_out", "combiner_mode", "math_traces", "ch_tl", "ch_tu", "ch_im3l", "ch_im3u",
+                      "meas_mode", "tone_if_bandwidth")
+    setup_vars = {
+        "im": _im_setup_vars,
+        "cal": _im_setup_vars + ("cal_power", "ch_cal"),
+    }
+
+    def switch_mode(self, mode):
+        """
+        Set up the instrument for a measurement mode, "im" for the IM measurement, or "cal" for the IM channels and
+        the cal channel. The first time a mode is set up with the current settings, the channels are configured
+        and the setup is stored on the instrument. Later switches recall the stored setup with one command.
+        An IM setup which is already active is updated with configure_sweep().
 
+        :param str mode: "im" or "cal"
+        """
+        if not self.is_connected:
+            return
+        if mode not in self.setup_vars:
+            raise ValueError("Unknown mode '%s'" % mode)
+        if mode == "im" and self.mode == "im":
+            self.configure_sweep()
+            return
+        key = setup_key(mode, {k: self.model.vars[k].get() for k in self.setup_vars[mode]})
+        setup = self.setups.get(mode, key) if self.use_setup_recall else None
+        if setup is not None and self._recall_setup(mode, setup):
+            return
+        if mode == "im":
+            self.delete_cal_channel()
+            self.configure_sweep(force=True)
+        else:
+            self.configure_sweep()  # The cal setup includes the IM channels
+            self.create_cal_channel(self.model.ch_cal.get())
+        self.mode = mode
+        self._store_setup(mode, key)
+
+    def _controller_state(self):
+        return {"applied": self._applied, "topology": self._applied_topology, "cal_channel_on": self._cal_channel_on,
+                "cal_points": self._cal_points, "trace_catalog": self.trace_catalog}
+
+    def _store_setup(self, mode, key):
+        if not self.use_setup_recall:
+            return
+        setup = self.setups.add(mode, key, self._controller_state())
+        with self.batch("store setup") as batch:
+            self.zva._write("MMEMory:STORe:STATe 1,'%s'" % setup.filename)
+        if batch.errors:
+            self.setups.discard(mode)
+
+    def _recall_setup(self, mode, setup):
+        """
+        :return: True if the setup was recalled
+        """
+        with self.batch("recall setup") as batch:
+            self.zva._write("MMEMory:LOAD:STATe 1,'%s'" % setup.filename)
+        if batch.errors:
+            logging.warning("Recalling the %s setup failed, configuring the channels", mode)
+            self.setups.discard(mode)
+            return False
+        state = copy.deepcopy(setup.state)
+        self._applied = state["applied"]
+        self._applied_topology = state["topology"]
+        self._cal_channel_on = state["cal_channel_on"]
+        self._cal_points = state["cal_points"]
+        self.trace_catalog = state["trace_catalog"]
+        self.setups.recalls += 1
+        self.mode = mode
+        return True
+
+    def _map_channels(self):
+        """
+        Create the channel objects from the channel numbers in the model, and forget the applied settings.
+        """
         def mk_ch(model_param):
             return self.zva.get_channel(self.model.vars[model_param].get())
         self.ch["TL"] = mk_ch("ch_tl")
         self.ch["TU"] = mk_ch("ch_tu")
         self.ch["IM3L"] = mk_ch("ch_im3l")
         self.ch["IM3U"] = mk_ch("ch_im3u")
+        self.ch["TONE"] = mk_ch("ch_tl")  # The channels of the segmented mode
+        self.ch["IM3"] = mk_ch("ch_im3l")
         self.ch["cal"] = mk_ch("ch_cal")
+        self._applied.clear()
+        self._applied_topology = None
 
     @property
     def is_connected(self):
         return self.zva is not None
 
     def query_zva_settings(self):
+        """
+        Read the sweep settings from the TL channel of the instrument.
+
+        :return: The settings, keyed by model variable name, or None if the IM channels aren't set up
+        :rtype: dict
+        """
         if not self.is_connected:
-            return
-        zva = self.zva
-        ch = self.ch["TL"]  # type: RSSscpi.zva.Channel
-        if not ch.state or not ch.name == "TL":
-            return
-        try:
-            self.zva = None  # remove the zva instance from self to prevent model callbacks
-
-            self.model.spacing_start.set(ch.freq_start)
-            self.model.spacing_stop.set(ch.freq_stop)
-            a, b, fc, mode = ch.SENSe.FREQuency.CONVersion.ARBitrary.q().split_comma()
-            self.model.center_freq.set(float(fc))
-            self.model.sweep_points.set(ch.sweep.points)
-            self.model.if_bandwidth.set(ch.ifbw)
-            self.model.if_selectivity.set(ch.if_selectivity.lower())
-            self.model.base_power.set(ch.power_level)
-            c = ch.calibration.query_calgroup()
-            if c:
-                self.model.calgroup.set(c)
-
-            x = {"IMM": "Free run", "PGEN": "Pulse"}
-            a = str(ch.TRIGger.SEQuence.SOURce.q())
-            self.model.trigger_source.set(x[a])
-        finally:
-            self.zva = zva
+            return None
+        tl = self.read_channel_snapshots().get("TL")
+        if tl is None:
+            return None
+        settings = {
+            "spacing_start": tl.start,
+            "spacing_stop": tl.stop,
+            "center_freq": tl.arb[2],
+            "sweep_points": tl.points,
+            "if_bandwidth": tl.ifbw,
+            "if_selectivity": tl.selectivity,
+            "base_power": tl.power,
+        }
+        if tl.calgroup:
+            settings["calgroup"] = tl.calgroup
+        x = {v: k for k, v in self.trigger_sources.items()}
+        if tl.trigger in x:
+            settings["trigger_source"] = x[tl.trigger]
+        return settings
 
-    def configure_sweep(self):
+    @property
+    def segmented(self):
+        """True if the channels are set up for the segmented measurement mode"""
+        return "TONE" in self._applied
+
+    def channel_names(self, segmented=None):
+        """
+        The names of the measurement channels.
+
+        :param bool segmented: The measurement mode, defaults to the meas_mode model variable
+        :rtype: list of str
+        """
+        if segmented is None:
+            segmented = self.model.meas_mode.get() == "segmented"
+        if segmented:
+            return list(SEGMENTED_CHANNELS)
+        return [name for name, _, _ in self.im_channels]
+
+    def read_sweep_times(self):
+        """
+        Read the sweep time of each measurement channel with one query, and calibrate the sweep time model.
+
+        :return: {channel name: sweep time in s}
+        :rtype: dict
+        """
+        if not self.is_connected or self._applied_topology is None:
+            return {}
+        names = self.channel_names(self.segmented)
+        with self.zva._visa_lock:
+            response = str(self.zva._query(";:".join("SENSe%d:SWEep:TIME?" % self.ch[name].n for name in names)))
+        times = {name: float(t) for name, t in zip(names, response.strip().split(";"))}
+        self.sweep_time = sum(times.values())
+        m = self.model
+        if self.segmented:  # The IM3 channel uses if_bandwidth
+            self.sweep_model.calibrate(times["IM3"], 2 * m.sweep_points.get(), m.if_bandwidth.get(),
+                                       m.if_selectivity.get())
+        else:
+            self.sweep_model.calibrate(self.sweep_time / len(times), m.sweep_points.get(), m.if_bandwidth.get(),
+                                       m.if_selectivity.get())
+        return times
+
+    def read_channel_snapshots(self):
+        """
+        Read the settings of all IM channels, in two round trips.
+
+        :return: {channel name: ChannelSnapshot}, for the IM channels which exist on the instrument
+        :rtype: dict
+        """
+        return read_snapshots(self.zva, [name for name, _, _ in self.im_channels])
+
+    def collect_errors(self):
+        """
+        Return the instrument errors reported since the last call. Run by the instrument worker after each job.
+        The status byte is only read if commands have been sent since the errors were last read out.
+
+        :rtype: list of RSSscpi.Instrument.Error
+        """
         if not self.is_connected:
-            return
+            return []
+        with self.zva._visa_lock:
+            check_errors(self.zva)
+        errors = []
+        while True:
+            try:
+                errors.append(self.zva.error_queue.get_nowait())
+            except queue.Empty:
+                return errors
 
-        src_tl = self.model.src_tl.get()
-        src_tu = self.model.src_tu.get()
-        dut_out = self.model.port_dut_out.get()
-        cf = self.model.center_freq.get()
+    def calpool(self, refresh=False):
+        """
+        The names of the cal groups in the cal pool. The list is read from the instrument after connecting, and
+        then cached until the cache is invalidated, or refresh is True.
 
-        self.zva.scpi.INITiate.CONTinuous.w(False)
-        ch = self._configure_channel('TL', -1, False, clear=False)
-        ch.sweep.points = self.model.sweep_points.get()
+        :rtype: list of str
+        """
+        if not self.is_connected:
+            return []
+        if self._calpool is None or refresh:
+            self._calpool = list(self.zva.cal_manager.get_calpool_list())
+        return self._calpool
 
-        cg = self.model.calgroup.get()
-        if cg in ch.calibration.query_calpool_list():
-            ch.calibration.load_calibration(cg)
+    @property
+    def cached_calpool(self):
+        """
+        The cached cal pool list, without reading from the instrument. None if there is no cached list.
+        Can be read from any thread.
+        """
+        return self._calpool
 
-        # FIXME: the other sources need to get a valid frequency config as well, since fb is usually out of range
-        # port 4 could be set to not measured
-        # also, power sensors need to be considered
-        ch.SOURce.FREQuency(src_tl).CONVersion.ARBitrary.IFRequency.w(-1, 2, cf, "SWEep")
-        ch.SOURce.FREQuency(src_tu).CONVersion.ARBitrary.IFRequency.w(1, 2, cf, "SWEep")
-        ch.SOURce.FREQuency(dut_out).CONVersion.ARBitrary.IFRequency.w(0, 1, cf, "SWEep")
-        ch.SOURce.POWer(self.source_low).PERManent.STATe.w(True)
-        ch.SOURce.POWer(src_tu).PERManent.STATe.w(True)
-        ch.SENSe.FREQuency.CONVersion.AWReceiver.STATe.w(False)  # Measure the a-waves at the source frequency
-        ch.SENSe.FREQuency.SBANd.w("NEGative")  # select LO < RF, so that the image is below the lower tone
+    def invalidate_calpool(self):
+        """
+        Call when a cal group has been stored or deleted.
+        """
+        self._calpool = None
+
+    def rf_output(self, state):
+        self.zva.OUTPut.STATe.w(state)
 
-        self._configure_channel('TU', 1, True)
-        self._configure_channel('IM3L', -3, False)
-        self._configure_channel('IM3U', 3, True)
+    im_channels = IM_CHANNELS
 
-        self.create_traces()
+    trigger_sources = {"Free run": "IMM", "Pulse": "PGEN"}
 
-        self.zva.INITiate.CONTinuous.w(True)
+    def _topology(self):
+        return tuple(self.model.vars[x].get() for x in
+                     ("src_tl", "src_tu", "port_dut_out", "ch_tl", "ch_tu", "ch_im3l", "ch_im3u", "math_traces",
+                      "meas_mode"))
+
+    def setting(self, name):
+        """
+        The value of a sweep setting. Measurements which step through other settings than the ones in the model,
+        such as the grid scheduler, put them in self.overrides, since the model must not be changed from the
+        instrument thread.
+
+        :param str name: The name of the model variable
+        """
+        if name in self.overrides:
+            return self.overrides[name]
+        return self.model.vars[name].get()
+
+    def frequency_plan(self):
+        """
+        The frequency plan of the IM channels, according to the model, checked against the instrument limits.
+
+        :rtype: FrequencyPlan
+        :raises rss_im_sweep.freq_plan.FrequencyPlanError:
+        """
+        m = self.model
+        plan = FrequencyPlan(m.center_freq.get(), self.setting("spacing_start"), self.setting("spacing_stop"),
+                             self.setting("sweep_points"), m.src_tl.get(), m.src_tu.get(), m.port_dut_out.get(),
+                             self.ports)
+        plan.validate(*self.freq_limits, image_tolerance=self.image_tolerance * m.if_bandwidth.get())
+        return plan
+
+    def _channel_settings(self, name, lo_high, plan):
+        """
+        The settings of an IM channel, according to the model. The order of the dict is the write order.
+        """
+        m = self.model
+        x = {"freq": plan.states[name],
+             "sband": "POSitive" if lo_high else "NEGative",
+             "points": self.setting("sweep_points"),
+             "segments": None,  # Undo set_segments()
+             "ifbw": m.if_bandwidth.get(),
+             "selectivity": m.if_selectivity.get(),
+             "power": self.setting("base_power"),
+             "trigger": m.trigger_source.get(),
+             }
+        if name == "TL":
+            cg = m.calgroup.get()
+            if cg in self.calpool():
+                x["calgroup"] = cg
+        return x
+
+    def _segmented_settings(self, name, plan):
+        """
+        The settings of a channel of the segmented mode. The tones are measured with a separate IF bandwidth,
+        since they are much stronger than the IM3 products.
+        """
+        m = self.model
+        x = {"freq": plan.segmented[name]}
+        if name == "TONE":
+            x["tone_ifbw"] = m.tone_if_bandwidth.get()
+        else:
+            x["ifbw"] = m.if_bandwidth.get()
+        x.update(selectivity=m.if_selectivity.get(), power=self.setting("base_power"),
+                 trigger=m.trigger_source.get())
+        if name == "TONE":
+            cg = m.calgroup.get()
+            if cg in self.calpool():
+                x["calgroup"] = cg
+        return x
+
+    def _write_setting(self, ch, field, value):
+        # type: (RSSscpi.zva.Channel, str, object) -> None
+        if field == "arb":
+            ch.SENSe.FREQuency.CONVersion.ARBitrary.w(*value, "SWEep")
+        elif field == "start":
+            ch.freq_start = value
+        elif field == "stop":
+            ch.freq_stop = value
+        elif field == "sband":
+            ch.SENSe.FREQuency.SBANd.w(value)
+        elif field == "points":
+            ch.sweep.points = value
+        elif field in ("ifbw", "tone_ifbw"):
+            ch.ifbw = value
+        elif field == "selectivity":
+            ch.if_selectivity = value
+        elif field == "power":
+            ch.power_level = value
+        elif field == "trigger":
+            ch.TRIGger.SEQuence.SOURce.w(self.trigger_sources[value])
+        elif field == "calgroup":
+            ch.calibration.load_calibration(value)
+        elif field == "src_arb":
+            port, arb = value
+            ch.SOURce.FREQuency(port).CONVersion.ARBitrary.IFRequency.w(*arb, "SWEep")
+        elif field == "power_offsets":
+            for port, offset in value:
+                ch.SOURce.POWer(port).OFFSet.w(offset, "CPADd")
+        else:
+            raise KeyError("Unknown channel setting '%s'" % field)
 
-    def _configure_channel(self, name, fb_mult, lo_high, clear=True):
-        # type: (str, int, bool, bool) -> RSSscpi.zva.Channel
+    def configure_sweep(self, force=False):
+        """
+        Apply the sweep settings in the model to the IM channels. Only the settings which differ from what was
+        last sent to the instrument are written, unless the ports or channel numbers have changed, or force is True,
+        in which case the channels and traces are rebuilt from scratch.
+
+        :param bool force: Rebuild the channels even if the topology is unchanged
+        """
+        if not self.is_connected:
+            return
+
+        plan = self.frequency_plan()  # Reject invalid settings before anything is sent
+        topology = self._topology()
+        rebuild = force or topology != self._applied_topology
+        segmented = self.model.meas_mode.get() == "segmented"
+        names = self.channel_names(segmented)
+        with self.batch("configure_sweep") as batch:
+            try:
+                if rebuild:
+                    self._map_channels()
+                    self.zva.scpi.INITiate.CONTinuous.w(False)
+                    self.zva._write("CALCulate:PARameter:DELete:ALL")  # The TL channel isn't cleared
+                    self._disable_unused_channels(names)
+                if segmented:
+                    for name in names:
+                        self._apply_channel(name, self._segmented_settings(name, plan), rebuild)
+                else:
+                    for name, _, lo_high in self.im_channels:
+                        self._apply_channel(name, self._channel_settings(name, lo_high, plan), rebuild)
+                if rebuild:
+                    self._create_traces()
+                    self.zva.INITiate.CONTinuous.w(True)
+                    self._applied_topology = topology
+            except:
+                self._applied_topology = None  # The instrument state is unknown, rebuild on the next apply
+                raise
+        return batch
+
+    def _disable_unused_channels(self, names):
+        """
+        Turn off the measurement channels of the other measurement mode.
+        """
+        used = {self.ch[name].n for name in names}
+        for name in self.channel_names(False) + self.channel_names(True):
+            ch = self.ch[name]
+            if ch.n not in used and ch.state:
+                ch.state = False
+                used.add(ch.n)
+
+    def _apply_channel(self, name, settings, rebuild):
+        ch = self.ch[name]  # type: RSSscpi.zva.Channel
+        if rebuild:
+            self._build_channel(name, clear=(name not in ("TL", "TONE")))
+        applied = self._applied.setdefault(name, {})
+        for field, value in settings.items():
+            if field in applied and applied[field] == value:
+                continue
+            if field == "freq" and isinstance(value, SegmentedState):
+                self._write_segments(ch, value)
+            elif field == "segments":
+                self._write_spacing_segments(ch, value, applied["sband"])
+            elif field == "freq":
+                for step in write_order(applied.get("freq"), value, *self.freq_limits):
+                    self._write_setting(ch, *step)
+            else:
+                self._write_setting(ch, field, value)
+            applied[field] = value
+
+    def _write_segments(self, ch, state):
+        """
+        Write the segment list and the source frequency conversions of a channel in the segmented mode.
+        The source conversions are removed first, so that every intermediate configuration is valid.
+
+        :param SegmentedState state:
+        """
+        ch.SENSe.FREQuency.CONVersion.w("FUNDamental")
+        ch.sweep.segments.remove_all_segments()
+        ifbw = self.model.if_bandwidth.get()
+        power = self.setting("base_power")
+        half = len(state.segments) // 2  # The lower tone or IM3 product, then the upper one
+        for i, (start, stop, points) in enumerate(state.segments):
+            ch.sweep.segments.insert_segment(start, stop, points, ifbw, power,
+                                             lo_sideband="POSitive" if i >= half else "NEGative", position=i)
+        ch.sweep.segments.disable_per_segment_power()
+        ch.sweep.segments.disable_per_segment_ifbw()
+        ch.sweep.type = ch.sweep.SEGMENT
+        ch.SENSe.FREQuency.CONVersion.ARBitrary.w(1, 1, 0, "SWEep")
+        for port_arb in state.src_arb:
+            self._write_setting(ch, "src_arb", port_arb)
+
+    def _write_spacing_segments(self, ch, ranges, sband):
+        """
+        Write tone spacing ranges as the segment list of an IM channel, see set_segments().
+
+        :param ranges: ((start, stop, points[, power]), ...), or None to go back to the linear sweep
+        :param str sband: The LO sideband of the channel
+        """
+        if ranges is None:
+            ch.sweep.type = "LIN"
+            return
+        ch.sweep.segments.remove_all_segments()
+        ifbw = self.model.if_bandwidth.get()
+        power = self.setting("base_power")
+        for i, r in enumerate(ranges):
+            start, stop, points = r[:3]
+            ch.sweep.segments.insert_segment(start, stop, points, ifbw, r[3] if len(r) > 3 else power,
+                                             lo_sideband=sband, position=i)
+        if len(ranges[0]) > 3:
+            ch.SENSe.SEGMent.POWer.LEVel.CONTrol().w(True)  # Per segment power
+        else:
+            ch.sweep.segments.disable_per_segment_power()
+        ch.sweep.segments.disable_per_segment_ifbw()
+        ch.sweep.type = ch.sweep.SEGMENT
+
+    def _build_channel(self, name, clear=True):
+        # type: (str, bool) -> RSSscpi.zva.Channel
         ch = self.ch[name]  # type: RSSscpi.zva.Channel
         if clear and ch.state:
             ch.state = False
         ch.state = True
+        if clear:
+            freq = FreqState(*self.freq_limits, None, ())  # A new channel sweeps the full range
+        else:
+            ch.SENSe.FREQuency.CONVersion.w("FUNDamental")
+            freq = FreqState(None, None, None, ())  # Somewhere within the range, see write_order()
         ch.name = name
         ch.sweep.type = "LIN"
-        ch.freq_start = 10e6  # This is supported by all ZVAs, set this before the arb
-        ch.freq_stop = 30e6   # freq config to avoid "freq out of range" errors
-        ch.SENSe.FREQuency.CONVersion.ARBitrary.w(fb_mult, 2, self.model.center_freq.get(), "SWEep")
-        ch.freq_start = self.model.spacing_start.get()
-        ch.freq_stop = self.model.spacing_stop.get()
-        if lo_high:
-            ch.SENSe.FREQuency.SBANd.w("POSitive")
-        else:
-            ch.SENSe.FREQuency.SBANd.w("NEGative")
+        if name in ("TL", "TONE"):
+            src_tu = self.model.src_tu.get()
+            ch.SOURce.POWer(self.model.src_tl.get()).PERManent.STATe.w(True)
+            ch.SOURce.POWer(src_tu).PERManent.STATe.w(True)
+            ch.SENSe.FREQuency.CONVersion.AWReceiver.STATe.w(False)  # Measure the a-waves at the source frequency
+        self._applied[name] = {"freq": freq}
         return ch
 
+    wave_traces = {"TL_I": "TL", "TU_I": "TL", "TL_O": "TL", "TU_O": "TU", "IM3L_O": "IM3L", "IM3U_O": "IM3U"}
+    """The wave traces created by create_traces(), and the name of the channel they belong to"""
+    math_traces = {"IM3L_OR": "TL", "IM3U_OR": "TL"}
+    """The math traces created by create_traces() if the math_traces model variable is True"""
+
+    def acquire(self, timeout=None):
+        """
+        Start a single sweep in all channels, and wait for it to complete. Continuous sweep mode is turned off.
+
+        :param float timeout: The time to wait for the sweep, in seconds. Defaults to self.sweep_timeout.
+        :raises rss_im_sweep.worker.JobAborted: If an urgent job is waiting, e.g. RF OFF
+        """
+        if self.check_abort is not None:
+            self.check_abort()
+        zva = self.zva
+        res = zva._visa_res
+        with zva._visa_lock:
+            visa_timeout = res.timeout
+            res.timeout = (timeout or self.sweep_timeout) * 1e3
+            try:
+                zva._query("INITiate:CONTinuous OFF;:INITiate:IMMediate:ALL;*OPC?")
+            finally:
+                res.timeout = visa_timeout
+
+    def read_traces(self, names=None, fmt="REAL,32", sweep=True, bulk=None):
+        """
+        Read the IM traces from the instrument as complex numpy arrays, using binary block transfers.
+
+        :param names: The traces to read, defaults to all traces in trace_catalog. Use analysis.analyse_traces()
+                      to calculate the IM3 levels and intercept points from the result.
+        :param str fmt: REAL,32 or REAL,64
+        :param bool sweep: Run a single sweep, and wait for it to complete, before reading the traces
+        :param bool bulk: Read all traces with one compound query, defaults to self.bulk_readout
+        :rtype: TraceData
+        """
+        if not self.is_connected:
+            return None
+        if fmt not in real_formats:
+            raise ValueError("Unsupported data format '%s'" % fmt)
+        segmented = self.segmented
+        read_names = list(self.trace_catalog) if segmented or names is None else names
+        if bulk is None:
+            bulk = self.bulk_readout
+        start = timeit.default_timer()
+        if sweep:
+            self.acquire()
+        zva = self.zva
+        with zva._visa_lock:
+            zva._write("FORMat:DATA %s;:FORMat:BORDer SWAPped" % fmt)
+        try:
+            data = self._read_all_traces(fmt) if bulk else None
+            if data is None or not all(name in data for name in read_names):
+                data = self._read_traces(read_names, fmt)
+        finally:
+            with zva._visa_lock:
+                zva._write("FORMat:DATA ASCii")
+        if segmented:
+            data = unfold_segments(data, self._trace_points("IM3_B") // 2, ratios=self.model.math_traces.get())
+        if sweep and self.sweep_time is not None:
+            self.sweep_model.observe(timeit.default_timer() - start, self.sweep_time)
+        if "TL_O" in data:
+            self.tone_power = float(numpy.median(power_dbm(data["TL_O"])))
+        if names is None:
+            names = list(data) if segmented else read_names
+        return TraceData(((name, data[name]) for name in names), spacing=data.spacing)
+
+    def measure_adaptive(self, points=200, curvature=1.0, asymmetry=3.0, max_fraction=0.5):
+        """
+        Measure with a coarse sweep, with the sweep settings of the model, and measure the tone spacing regions
+        with a large IM3 curvature or asymmetry again with a segmented sweep, see the adaptive module.
+
+        :param int points: The number of points of the refinement sweep
+        :param float curvature: See adaptive.refinement_scores()
+        :param float asymmetry:
+        :param float max_fraction: See adaptive.refinement_regions()
+        :return: The merged traces, with non-uniform tone spacing
+        :rtype: TraceData
+        """
+        if not self.is_connected:
+            return None
+        coarse = self.read_traces()
+        ranges = refine(coarse, points, curvature, asymmetry, max_fraction)
+        if not ranges:
+            return coarse
+        if not self.segmented:
+            try:
+                self.set_segments(tuple(ranges))
+                fine = self.read_traces()
+            finally:
+                self.set_segments(None)
+            return merge_traces(coarse, fine)
+
+        plan = self.frequency_plan()
+        refined = plan.refined(ranges)
+        try:
+            with self.batch("refine_sweep"):
+                for name in SEGMENTED_CHANNELS:
+                    self._apply_channel(name, {"freq": refined[name]}, False)
+            fine = self.read_traces()
+        finally:
+            with self.batch("restore_sweep"):
+                for name in SEGMENTED_CHANNELS:
+                    self._apply_channel(name, {"freq": plan.segmented[name]}, False)
+        return merge_traces(coarse, fine)
+
+    def level_output(self, target, per_point=False, tolerance=0.1, max_iterations=6):
+        """
+        Level the output power of both tones at the DUT output, with the source power offsets of the tone ports,
+        and with the source power of each tone spacing point if per_point is True. See the leveling module.
+        The offsets are kept, and the per point powers are kept until the sweep is applied again.
+
+        :param float target: The output power of each tone, dBm
+        :param bool per_point: Level each tone spacing point
+        :param float tolerance: The allowed deviation from the target, dB
+        :param int max_iterations: The maximum number of power updates, each followed by one sweep
+        :raises ValueError: In the segmented mode, where the tone ports swap between the halves of the sweep
+        :rtype: LevelingResult
+        """
+        if not self.is_connected:
+            return None
+        if self.segmented:
+            raise ValueError("Output leveling needs the four channel measurement mode")
+        m = self.model
+        src_tl, src_tu = m.src_tl.get(), m.src_tu.get()
+        base = self.setting("base_power")
+        names = self.channel_names(False)
+        offsets = dict(self._applied.get(names[0], {}).get("power_offsets", ()))
+        x_l = base + offsets.get(src_tl, 0.0)
+        x_u = base + offsets.get(src_tu, 0.0)
+        if per_point:
+            x_l = numpy.full(self.setting("sweep_points"), x_l)
+            x_u = numpy.full(self.setting("sweep_points"), x_u)
+        spacing = self.frequency_plan().spacing
+        applied = {"segment_power": None}
+
+        def measure(x_l, x_u):
+            if per_point:
+                segment_power, o_l, o_u = split_tone_powers(x_l, x_u)
+                applied.update(offsets={src_tl: o_l, src_tu: o_u}, segment_power=segment_power)
+            else:
+                applied.update(offsets={src_tl: x_l - base, src_tu: x_u - base})
+            with self.batch("level_output"):
+                for name in names:
+                    self._apply_channel(name, {"power_offsets": tuple(sorted(applied["offsets"].items()))}, False)
+                if per_point:  # One segment per point, with its own power
+                    self.set_segments(tuple((f, f, 1, p) for f, p in zip(spacing, applied["segment_power"])))
+            data = self.read_traces(["TL_O", "TU_O"])  # The outputs of the src_tl and the src_tu port
+            return power_dbm(data["TL_O"]), power_dbm(data["TU_O"])
+
+        leveler = SecantLeveler(target, tolerance, max_iterations)
+        _, _, y_l, y_u = level_tones(measure, x_l, x_u, leveler, per_point)
+        error = numpy.abs(leveler.error(numpy.concatenate([y_l, y_u]) if per_point else
+                                        numpy.array([numpy.median(y_l), numpy.median(y_u)])))
+        logging.info("Output leveling: max error %.2f dB after %d iterations", error.max(), leveler.iterations)
+        return LevelingResult(converged=bool(numpy.all(error <= tolerance)), iterations=leveler.iterations,
+                              tl_o=y_l, tu_o=y_u, offsets=applied["offsets"], segment_power=applied["segment_power"])
+
+    def set_segments(self, ranges):
+        """
+        Replace the linear sweep of the IM channels of the four channel mode with a list of tone spacing segments,
+        optionally with a tone power per segment. Used by the adaptive refinement and the power grid.
+
+        :param ranges: ((spacing start, spacing stop, points[, power]), ...), or None to go back to the linear sweep
+        """
+        if not self.is_connected:
+            return
+        with self.batch("set_segments"):
+            for name, _, _ in self.im_channels:
+                self._apply_channel(name, {"segments": ranges}, False)
+
+    def _read_traces(self, names, fmt):
+        """
+        Read the traces one at a time.
+        """
+        data = TraceData()
+        for name in names:
+            ch = self.ch[self.trace_catalog[name]]
+            raw = query_block(self.zva, "CALCulate%d:DATA:TRACe? '%s', SDATa" % (ch.n, name))
+            data[name] = block_to_array(raw, fmt, complex_=True)
+        raw = query_block(self.zva, "CALCulate%d:DATA:STIMulus?" % self.ch["TL"].n)
+        data.spacing = block_to_array(raw, fmt)
+        return data
+
+    def _read_all_traces(self, fmt):
+        """
+        Read the trace catalog, the data of all displayed traces in all channels, and the stimulus values,
+        in a single round trip. The data is split into the traces according to the catalog, using the known
+        number of points in each channel.
+
+        :return: The trace data, or None if the data couldn't be split into traces
+        :rtype: TraceData
+        """
+        raw = query_block(self.zva, "CONFigure:TRACe:CATalog?;:CALCulate:DATA:DALL? SDATa;:CALCulate%d:DATA:STIMulus?"
+                          % self.ch["TL"].n)
+        catalog, block, stimulus = split_response(raw)
+        names = catalog.strip("'\"").split(",")[1::2]  # The catalog is a list of trace number, trace name pairs
+        lengths = [self._trace_points(name) for name in names]
+        if None in lengths:
+            logging.warning("Unknown number of points in trace %s, can't use bulk readout",
+                            names[lengths.index(None)])
+            return None
+        try:
+            traces = demux(block_to_array(block, fmt, complex_=True), lengths)
+        except ValueError:
+            logging.exception("Bulk trace readout failed")
+            return None
+        return TraceData(zip(names, traces), spacing=block_to_array(stimulus, fmt))
+
+    def _trace_points(self, name):
+        if name in self.trace_catalog:
+            applied = self._applied.get(self.trace_catalog[name], {})
+            if isinstance(applied.get("freq"), SegmentedState):
+                return sum(points for _, _, points in applied["freq"].segments)
+            if applied.get("segments"):
+                return sum(r[2] for r in applied["segments"])
+            return applied.get("points")
+        if name == "Cal" and self._cal_channel_on:
+            return self._cal_points
+        return None
+
     def create_traces(self):
         if not self.is_connected:
             return
+        with self.batch("create_traces"):
+            self._create_traces()
 
+    def _create_traces(self):
         ch = self.ch['TL']  # type: RSSscpi.zva.Channel
         dia1 = self.zva.get_diagram(1)
         src_tl = self.model.src_tl.get()
         src_tu = self.model.src_tu.get()
         port_dut_out = self.model.port_dut_out.get()
 
+        if self.segmented:  # The IM3 ratios are calculated by unfold_segments()
+            tone = self.ch["TONE"]
+            tone.create_trace("TONE_A_TL", Trace.MeasParam.Wave('A', src_tl, src_tl), dia1)
+            tone.create_trace("TONE_A_TU", Trace.MeasParam.Wave('A', src_tu, src_tu), dia1)
+            tone.create_trace("TONE_B", Trace.MeasParam.Wave("B", port_dut_out, src_tl), dia1)
+            self.ch["IM3"].create_trace("IM3_B", Trace.MeasParam.Wave("B", port_dut_out, src_tl), dia1)
+            self.trace_catalog = dict(segmented_traces)
+            return
+
         tr = ch.create_trace("TL_I", Trace.MeasParam.Wave('A', src_tl, src_tl), dia1)
         ch.create_trace("TU_I", Trace.MeasParam.Wave('A', src_tu, src_tu), dia1)
         ch.create_trace("TL_O", Trace.MeasParam.Wave('B', port_dut_out, src_tl), dia1)
@@ -175,16 +855,25 @@ class ZVAIMController(object):
         self.ch['IM3L'].create_trace("IM3L_O", Trace.MeasParam.Wave("B", port_dut_out, src_tl), dia1)
         self.ch['IM3U'].create_trace("IM3U_O", Trace.MeasParam.Wave("B", port_dut_out, src_tl), dia1)
 
+        self.trace_catalog = dict(self.wave_traces)
+        if not self.model.math_traces.get():
+            return  # The IM3 ratios are calculated on the host, see the analysis module
         dia2 = self.zva.get_diagram(2)
         tr.copy_assign_math("IM3L_OR", "IM3L_O / TL_O", dia2)
         tr.copy_assign_math("IM3U_OR", "IM3U_O / TU_O", dia2)
+        self.trace_catalog.update(self.math_traces)
 
     def create_cal_channel(self, ch_no):
+        with self.batch("create_cal_channel"):
+            self._create_cal_channel()
+
+    def _create_cal_channel(self):
         ch = self.ch["cal"]
         if ch.state:
             ch.state = False
         self.zva.active_channel = 1
         ch.state = True
+        self._cal_channel_on = True
         ch.name = "cal"
         ch.SENSe.FREQuency.CONVersion.w("FUNDamental")
         d1 = self.model.spacing_start.get()
@@ -197,6 +886,7 @@ class ZVAIMController(object):
         ch.sweep.segments.insert_segment(fc+d1/2, fc+d2/2, pts, ifbw, power)  # TH
         ch.sweep.segments.insert_segment(fc-d2/2, fc-d1/2, pts, ifbw, power)  # TL
         ch.sweep.segments.insert_segment(fc-3*d2/2, fc-3*d1/2, pts, ifbw, power)  # IM3 low
+        self._cal_points = 4 * pts
         ch.sweep.segments.disable_per_segment_power()
         ch.sweep.segments.disable_per_segment_ifbw()
         ch.sweep.type = ch.sweep.SEGMENT
@@ -206,7 +896,7 @@ class ZVAIMController(object):
         ch.create_trace("Cal", Trace.MeasParam.S(2, 1), cal_dia)
         # ch.create_trace("Cal", zva.Trace.MeasParam.S(3,1), cal_dia)
         cg = self.model.calgroup.get()
-        if cg in ch.calibration.get_calpool_list():
+        if cg in self.calpool():
             ch.calibration.load_calibration(cg)
 
     def delete_cal_channel(self):
@@ -214,6 +904,9 @@ class ZVAIMController(object):
             return
         if self.ch["cal"].state:
             self.ch["cal"].state = False
+        self._cal_channel_on = False
+        if self.mode == "cal":
+            self.mode = "im"
 
     def check_if_cal_in_calgroup(self):
         if "cal" not in self.ch or not self.is_connected:
@@ -230,37 +923,103 @@ class ZVAIMController(object):
                 func(ch)
 
     def apply_calibration(self):
+        """
+        Store the calibration of the cal channel, if active, in the cal group of the model, and load the cal group
+        into the IM channels and the cal channel. All channels are loaded in one batch, and the loaded cal group of
+        each channel is read back in the same message, so the whole operation takes two round trips.
+
+        :return: {channel name: True if the cal group was loaded}
+        :rtype: dict
+        """
+        if not self.is_connected:
+            return {}
         calgroup = self.model.calgroup.get()
-        if "cal" in self.ch and self.ch["cal"].state:
-            self.ch["cal"].calibration.store_calibration(calgroup)
-        if calgroup not in self.zva.cal_manager.get_calpool_list():
-            logger.error("No calibration named %s in the cal pool" % calgroup)
-        self.for_all_channels(lambda ch: ch.calibration.load_calibration(calgroup) )
+        names = self.channel_names(self.segmented if self._applied_topology is not None else None)
+        if self._applied_topology is None:  # The IM channels may not exist
+            names = [name for name in names if self.ch[name].state]
+        if self._cal_channel_on:
+            names.append("cal")
+
+        with self.batch("apply_calibration"):
+            if self._cal_channel_on:
+                self.ch["cal"].calibration.store_calibration(calgroup)
+                self.invalidate_calpool()
+            if calgroup not in self.calpool():
+                logging.error("No calibration named %s in the cal pool", calgroup)
+                return {name: False for name in names}
+            for name in names:
+                self.ch[name].calibration.load_calibration(calgroup)
+            loaded = str(self.zva._query(";:".join("MMEMory:LOAD:CORRection? %d" % self.ch[name].n
+                                                   for name in names))).split(";")
+
+        ret = {}
+        for name, cg in zip(names, loaded):
+            ret[name] = cg.strip().strip("'\"") == calgroup
+            if ret[name] and name in self._applied:
+                self._applied[name]["calgroup"] = calgroup
+        return ret
+
+    setting_vars = {"if_bandwidth": "ifbw", "if_selectivity": "selectivity", "base_power": "power",
+                    "trigger_source": "trigger", "tone_if_bandwidth": "tone_ifbw"}
+    """The model variables written to the IM channels which use them, and the corresponding channel setting"""
+    cal_settings = ("ifbw", "selectivity", "power", "trigger")
+    """The channel settings which are also written to the cal channel"""
+
+    def apply_settings(self, changes):
+        """
+        Write the changed model variables in setting_vars to the instrument, in a single batch.
+
+        :param dict changes: {model variable name: value}, e.g. ChangeSet.changes
+        """
+        if not self.is_connected:
+            return
+        with self.batch("apply_settings"):
+            for var, value in changes.items():
+                if var in self.setting_vars:
+                    self._set_all(self.setting_vars[var], value)
+
+    def _set_all(self, field, value):
+        """
+        Write a setting to the IM channels which use it, and to the cal channel if it is active.
+        Channels where the setting is already applied are skipped.
+        """
+        if not self.is_connected:
+            return
+        if self._applied_topology is None:  # The IM channels haven't been configured in this session
+            if field in self.cal_settings:
+                self.for_all_channels(lambda ch: self._write_setting(ch, field, value))
+            return
+        with self.batch("set " + field):
+            for name, applied in self._applied.items():
+                if field in applied and applied[field] != value:
+                    self._write_setting(self.ch[name], field, value)
+                    applied[field] = value
+            if self._cal_channel_on and field in self.cal_settings:
+                self._write_setting(self.ch["cal"], field, value)
 
     def set_ifbw(self, ifbw):
-        def set_ifbw(ch):
-            ch.ifbw = ifbw
-        self.for_all_channels(set_ifbw)
+        self._set_all("ifbw", ifbw)
 
     def set_selectivity(self, mode):
-        def set_sel(ch):
-            ch.if_selectivity = mode
-        self.for_all_channels(set_sel)
+        self._set_all("selectivity", mode)
 
     def set_power(self, power):
-        def pwr(ch):
-            ch.power_level = power
-        self.for_all_channels(pwr)
+        self._set_all("power", power)
 
     def set_trigger_source(self, src):
-        x = {"Free run": "IMM", "Pulse": "PGEN"}
-        self.for_all_channels(lambda ch: ch.TRIGger.SEQuence.SOURce.w(x[src]))
+        self._set_all("trigger", src)
+
+    def set_tone_ifbw(self, ifbw):
+        self._set_all("tone_ifbw", ifbw)
 
 
 class Observable:
     def __init__(self, value=None):
         self._value = value
-        self._observers = {}
+        self._observers = ObserverRegistry()
+        self._tk_links = {}
+        self._held = False
+        self._pending = False
 
     def get(self):
         return self._value
@@ -272,19 +1031,61 @@ class Observable:
         self.emit(value)
 
     def emit(self, value):
-        for o in self._observers:
+        if self._held:
+            self._pending = True
+            return
+        for o in self._observers.observers():
             o(value)
 
-    def add_observer(self, func):
-        self._observers[func] = 1
+    def hold(self):
+        """
+        Defer the notifications until release() is called.
+        """
+        self._held = True
+
+    def release(self):
+        """
+        Stop deferring notifications. The observers are not notified, that is done by the caller.
+
+        :return: True if any notification was deferred
+        :rtype: bool
+        """
+        pending = self._pending
+        self._held = self._pending = False
+        return pending
+
+    def add_observer(self, func, owner=None):
+        """
+        Bound methods are held by weak references. Other callables are held until removed, or until owner is
+        garbage collected, see ObserverRegistry.
+
+        :rtype: rss_im_sweep.observers.Subscription
+        """
+        return self._observers.add(func, owner)
 
     def remove_observer(self, func):
-        del self._observers[func]
+        self._observers.remove(func)
+
+    @property
+    def subscriber_count(self):
+        return len(self._observers)
 
     def link_tk_var(self, var):
+        """
+        Keep a Tk variable in sync with the observable. Linking a variable which is already linked does nothing.
+        """
+        if str(var) in self._tk_links and self._tk_links[str(var)]() is var:
+            return
+        var_ref = self._tk_links[str(var)] = weakref.ref(var)  # The callbacks must not keep var alive
+
+        def update_var(value):
+            v = var_ref()
+            if v is not None:
+                v.set(value)
+
         var.set(self._value)
-        var.trace_add("write", lambda n1, n2, op: self.set(var.get()))
-        self.add_observer(lambda val: var.set(val))
+        var.trace_add("write", lambda n1, n2, op: self.set(var_ref().get()))
+        self.add_observer(update_var, owner=var)
 
 
 MeasQtyModel = namedtuple("MQMT", ["receiver", "src_port", "dst_port"])
@@ -316,10 +1117,20 @@ class TraceModel(Observable):
         raise NotImplementedError()
 
 
+ChangeSet = namedtuple("ChangeSet", ["changes", "source"])
+"""The variables changed in a Model transaction, {name: new value}, and the source of the changes"""
+
+
 class Model:
     def __init__(self):
         self.vars = {}
         self._persist = {}
+        self._tx_source = None
+        self._tx_before = None
+        self.committing = None  # type: ChangeSet
+        """The change set being committed, while the variable observers are notified"""
+        self.changes = Observable()
+        """Emits a ChangeSet when a transaction with changes is committed"""
 
         self.add_variable("zva_adress", "192.168.56.102")
         self.add_variable("center_freq", 1e9)
@@ -328,6 +1139,13 @@ class Model:
         self.add_variable("sweep_points", 101)
         self.add_variable("if_bandwidth", 1e3, persistent=True)
         self.add_variable("if_selectivity", "high", persistent=True)
+        self.add_variable("tone_if_bandwidth", 10e3)  # The IF bandwidth of the tones in the segmented mode
+        self.add_variable("meas_mode", "channels")  # "channels" or "segmented", see the segmented module
+        self.add_variable("time_budget", 1.0)  # s, for the sweep optimizer
+        self.add_variable("required_dynamic_range", 80.0)  # dB, for the sweep optimizer
+        self.add_variable("sweep_estimate", "", persistent=False)
+        self.add_variable("output_level", 0.0)  # dBm per tone, for the output leveling
+        self.add_variable("level_per_point", False)
         self.add_variable("base_power", -10, persistent=False)
 
         self.add_variable("calgroup", "RSS_im_sweep.cal")
@@ -337,6 +1155,7 @@ class Model:
         self.add_variable("src_tu", 3)
         self.add_variable("port_dut_out", 2)
         self.add_variable("combiner_mode", "external")
+        self.add_variable("math_traces", True)  # Create the IM3 ratio math traces on the instrument
 
         self.add_variable("ch_tl", 1)
         self.add_variable("ch_tu", 2)
@@ -344,6 +1163,8 @@ class Model:
         self.add_variable("ch_im3u", 4)
         self.add_variable("ch_cal", 5)
 
+        self.add_variable("write_coalesce_ms", 50)  # Collect GUI changes for this long before writing to the VNA
+
         self.add_variable("trigger_source", "Free run", persistent=False)
         self.add_variable("zva_is_connected", False, persistent=False)
         self.add_variable("connection_status", "Not connected", persistent=False)
@@ -355,6 +1176,39 @@ class Model:
         self.vars["traces"] = TraceModel()
         self._persist["traces"] = True
 
+    @contextlib.contextmanager
+    def transaction(self, source=None):
+        """
+        Set several variables, and notify the observers once at the end of the transaction. Each changed variable
+        notifies its observers once, with the final value, after which a ChangeSet with all changed variables is
+        emitted by the changes observable. Nested transactions are merged into the outermost transaction.
+
+        :param str source: Where the changes come from, e.g. "file" or "instrument"
+        """
+        if self._tx_before is not None:
+            yield
+            return
+        self._tx_source = source
+        self._tx_before = {k: v.get() for k, v in self.vars.items()}
+        for v in self.vars.values():
+            v.hold()
+        try:
+            yield
+        finally:
+            before = self._tx_before
+            self._tx_before = None
+            changed = [k for k, v in self.vars.items() if v.release()]
+            changes = {k: self.vars[k].get() for k in changed
+                       if isinstance(self.vars[k], TraceModel) or self.vars[k].get() != before[k]}
+            if changes:
+                self.committing = ChangeSet(changes, source)
+                try:
+                    for k, value in changes.items():
+                        self.vars[k].emit(value)
+                    self.changes.emit(self.committing)
+                finally:
+                    self.committing = None
+
     def load_json(self, fp):
         import json
         try:
@@ -362,11 +1216,21 @@ class Model:
         except json.JSONDecodeError:
             logging.exception("Error loading stored settings")
             return
-        for k in data:
-            try:
-                self.vars[k].set(data[k])
-            except KeyError:
-                logging.error("Unexpected key in JSON data: '%s'", k)
+        with self.transaction(source="file"):
+            for k in data:
+                try:
+                    self.vars[k].set(data[k])
+                except KeyError:
+                    logging.error("Unexpected key in JSON data: '%s'", k)
+
+    def subscriber_counts(self):
+        """
+        :return: The number of observers of each variable, for diagnostics
+        :rtype: dict
+        """
+        ret = {k: v.subscriber_count for k, v in self.vars.items()}
+        ret["(changes)"] = self.changes.subscriber_count
+        return ret
 
     def store_json(self, fp):
         import json
@@ -511,27 +1375,75 @@ class Controller:
         self.minimized = None
 
         self.vna_ctrl = ZVAIMController(self.model)
-        self._vna_thread = None
+        self.tk_dispatcher = TkDispatcher(self.tk_root)
+        self.worker = InstrumentWorker(error_check=self.vna_ctrl.collect_errors,
+                                       notify=lambda: self.tk_dispatcher.post(self.worker.deliver_results))
+        self.worker.error_handler = self.show_instrument_errors
+        self.vna_ctrl.check_abort = self.worker.check_abort
+        self.dispatcher = CoalescingDispatcher(self.tk_root, self.worker, self.model.write_coalesce_ms.get())
+        self._connecting = False
         self.connect_vna()
 
         self._connect_events()
 
+    def run_job(self, func, *args, **kwargs):
+        """
+        Execute func(*args) in the instrument worker thread. See InstrumentWorker.submit() for the kwargs.
+
+        :rtype: concurrent.futures.Future
+        """
+        return self.worker.submit(func, *args, **kwargs)
+
+    def _instrument_observer(self, func):
+        """
+        Create a model observer which runs func in the instrument worker thread, except when the model is being
+        updated from the instrument. Rapid changes are coalesced, so that only the latest value is written.
+        """
+        def observer(value):
+            if self.model.committing is None:  # Transactions are handled by apply_model_changes()
+                self.dispatcher.post(func.__name__, func, value)
+        return observer
+
+    def apply_model_changes(self, changeset):
+        """
+        Write the settings changed in a model transaction to the instrument, as one job.
+        Changes read from the instrument are not written back.
+
+        :param ChangeSet changeset:
+        """
+        if changeset.source == "instrument":
+            return
+        changes = {k: v for k, v in changeset.changes.items() if k in ZVAIMController.setting_vars}
+        if changes:
+            self.run_job(self.vna_ctrl.apply_settings, changes)
+
     def _connect_events(self):
         self.main_view.menu.set_command("exit", self.tk_root.destroy)
         self.main_view.menu.set_command("settings", self.show_config_dialog)
+        self.main_view.menu.set_command("diagnostics", self.show_diagnostics)
 
         self.main_view.connect_button["command"] = self.connect_vna
         self.main_view.minimize_btn["command"] = self.minimize_main_window
 
-        self.main_view.apply_sweep["command"] = self.vna_ctrl.configure_sweep
-        self.main_view.zva_ctrl.rf_off["command"] = lambda: self.vna_ctrl.zva.OUTPut.STATe.w(False)
-        self.main_view.zva_ctrl.rf_on["command"] = lambda: self.vna_ctrl.zva.OUTPut.STATe.w(True)
+        self.main_view.apply_sweep["command"] = \
+            lambda: self.run_job(self.vna_ctrl.switch_mode, "im", callback=lambda _: self.read_sweep_times(),
+                                 errback=self.show_settings_error)
+        self.main_view.zva_ctrl.rf_off["command"] = \
+            lambda: self.run_job(self.vna_ctrl.rf_output, False, priority=InstrumentWorker.URGENT)
+        self.main_view.zva_ctrl.rf_on["command"] = lambda: self.run_job(self.vna_ctrl.rf_output, True)
+        self.main_view.zva_ctrl.fit_time_budget["command"] = \
+            lambda: self.optimize_sweep(budget=self.model.time_budget.get())
+        self.main_view.zva_ctrl.fit_dynamic_range["command"] = \
+            lambda: self.optimize_sweep(dynamic_range=self.model.required_dynamic_range.get())
+        self.main_view.zva_ctrl.level_output["command"] = self.level_output
 
         self.main_view.cal_frame.create_cal_button["command"] = \
-            lambda: self.vna_ctrl.create_cal_channel(self.model.ch_cal.get())
+            lambda: self.run_job(self.vna_ctrl.switch_mode, "cal", errback=self.show_settings_error)
 
-        self.main_view.cal_frame.calgroup_select["postcommand"] = self.refresh_calpool
-        self.main_view.cal_frame.apply_cal_button["command"] = self.vna_ctrl.apply_calibration
+        self.main_view.cal_frame.calgroup_select["postcommand"] = self.show_calpool
+        self.main_view.cal_frame.refresh_calpool_button["command"] = self.refresh_calpool
+        self.main_view.cal_frame.apply_cal_button["command"] = \
+            lambda: self.run_job(self.vna_ctrl.apply_calibration, callback=self.show_calibration_result)
         self.main_view.cal_frame.delete_cal_button["command"] = self.delete_cal_channel
 
         for name in self.main_view.vars:
@@ -540,12 +1452,18 @@ class Controller:
             except AttributeError:
                 logging.debug("GUI variable %s has no match in data model", name)
 
-        self.model.if_bandwidth.add_observer(self.vna_ctrl.set_ifbw)
-        self.model.if_selectivity.add_observer(self.vna_ctrl.set_selectivity)
-        self.model.trigger_source.add_observer(self.vna_ctrl.set_trigger_source)
-        self.model.base_power.add_observer(self.vna_ctrl.set_power)
+        self.model.if_bandwidth.add_observer(self._instrument_observer(self.vna_ctrl.set_ifbw))
+        self.model.if_selectivity.add_observer(self._instrument_observer(self.vna_ctrl.set_selectivity))
+        self.model.trigger_source.add_observer(self._instrument_observer(self.vna_ctrl.set_trigger_source))
+        self.model.base_power.add_observer(self._instrument_observer(self.vna_ctrl.set_power))
+        self.model.tone_if_bandwidth.add_observer(self._instrument_observer(self.vna_ctrl.set_tone_ifbw))
+        self.model.changes.add_observer(self.apply_model_changes)
+        self.model.write_coalesce_ms.add_observer(lambda ms: setattr(self.dispatcher, "window_ms", ms))
         self.model.is_minimized.add_observer(self.minimize_main_window)
-        self.model.zva_is_connected.add_observer(self.monitor_zva_error_queue)
+        for name in ("if_bandwidth", "if_selectivity", "sweep_points", "meas_mode", "tone_if_bandwidth",
+                     "base_power"):
+            self.model.vars[name].add_observer(self.update_sweep_estimate)
+        self.update_sweep_estimate()
 
     def minimize_main_window(self, minimize=True):
         if minimize and not self.minimized:
@@ -562,71 +1480,164 @@ class Controller:
         self.model.is_minimized.set(minimize)
 
     def connect_vna(self):
-        if self._vna_thread is not None:
-            logging.info("VNA thread already running")
+        if self._connecting:
+            logging.info("Already connecting to the VNA")
             return
 
-        conn_status = queue.Queue()
-
-        def thread():
+        def connect():
             try:
                 self.vna_ctrl.connect_vna()
             except pyvisa.errors.VisaIOError:
                 logging.exception("Connection to ZVA failed")
-                conn_status.put_nowait((False, "Connection failed"))
-            else:
-                conn_status.put_nowait((True, "Connected to %s, %s" % (self.model.zva_adress.get(), self.vna_ctrl.zva.IDN.q())))
-            finally:
-                self._vna_thread = None
-
-        def conn_status_monitor():
-            try:
-                state, state_str = conn_status.get_nowait()
-            except queue.Empty:
-                self.tk_root.after(50, conn_status_monitor)
-            else:
-                self.model.connection_status.set(state_str)
-                self.model.zva_is_connected.set(state)
-                self.vna_ctrl.query_zva_settings()
-
-        self._vna_thread = threading.Thread(target=thread)
+                return False, "Connection failed"
+            except ValueError as e:  # An invalid simulator address
+                logging.error("Connection to ZVA failed: %s", e)
+                return False, "Connection failed: %s" % e
+            return True, "Connected to %s, %s" % (self.model.zva_adress.get(), self.vna_ctrl.zva.IDN.q())
+
+        def connected(status):
+            state, state_str = status
+            self._connecting = False
+            self.model.connection_status.set(state_str)
+            self.model.zva_is_connected.set(state)
+            if state:
+                self.run_job(self.vna_ctrl.query_zva_settings, callback=self.update_model_from_zva)
+                self.read_sweep_times()
+
+        def failed(e):
+            self._connecting = False
+            self.model.connection_status.set("Connection failed")
+            logging.error("Connection to ZVA failed", exc_info=(type(e), e, e.__traceback__))
+
+        self._connecting = True
         self.model.zva_is_connected.set(False)
         self.model.connection_status.set("Trying to connect to %s" % (self.model.zva_adress.get()))
-        self._vna_thread.start()
-        conn_status_monitor()
+        self.run_job(connect, callback=connected, errback=failed, name="connect_vna")
 
-    def monitor_zva_error_queue(self, start_monitoring):
-        if not start_monitoring:
+    def update_model_from_zva(self, settings):
+        """
+        Update the model with the settings read from the instrument, without writing them back to the instrument.
+        """
+        if not settings:
             return
-        errors = []
-        while True:
-            try:
-                errors.append(self.vna_ctrl.zva.error_queue.get(timeout=1e-4))
-            except queue.Empty:
-                break
-        if errors:
-            messagebox.showerror("Instrument error", "\n".join([e.err_str for e in errors]))
-        self.tk_root.after(50, self.monitor_zva_error_queue, self.model.zva_is_connected.get())
+        with self.model.transaction(source="instrument"):
+            for k, v in settings.items():
+                self.model.vars[k].set(v)
+
+    def show_instrument_errors(self, job_name, errors):
+        if self.vna_ctrl.visa_log is not None:
+            self.vna_ctrl.visa_log.dump_last(20)
+        messagebox.showerror("Instrument error", "Errors reported after %s:\n%s" % (
+            job_name, "\n".join([e.err_str for e in errors])))
+
+    def read_sweep_times(self):
+        self.run_job(self.vna_ctrl.read_sweep_times, callback=lambda _: self.update_sweep_estimate())
+
+    def _tone_power(self):
+        p = self.vna_ctrl.tone_power
+        return self.model.base_power.get() if p is None else p
+
+    def update_sweep_estimate(self, *_):
+        """
+        Show the estimated measurement time and dynamic range of the current settings.
+        """
+        m = self.model
+        sweep_model = self.vna_ctrl.sweep_model
+        t = sweep_model.measurement_time(m.sweep_points.get(), m.if_bandwidth.get(), m.if_selectivity.get(),
+                                         m.meas_mode.get(), m.tone_if_bandwidth.get())
+        dr = self._tone_power() - sweep_model.noise_floor(m.if_bandwidth.get())
+        m.sweep_estimate.set("%.3g s, %.0f dB dynamic range" % (t, dr))
+
+    def optimize_sweep(self, budget=None, dynamic_range=None):
+        """
+        Set the IF bandwidth, selectivity and number of points from a time budget or a required dynamic range.
+        """
+        m = self.model
+        est = optimize(self.vna_ctrl.sweep_model, m.sweep_points.get(), m.spacing_start.get(), self._tone_power(),
+                       budget=budget, dynamic_range=dynamic_range, meas_mode=m.meas_mode.get(),
+                       tone_ifbw=m.tone_if_bandwidth.get())
+        if est is None:
+            messagebox.showwarning("Sweep optimizer", "The %s can't be met with the current settings" % (
+                "time budget" if budget is not None else "dynamic range"))
+            return
+        with m.transaction(source="optimizer"):
+            m.if_bandwidth.set(est.ifbw)
+            m.if_selectivity.set(est.selectivity)
+            m.sweep_points.set(est.points)
+
+    def level_output(self):
+        m = self.model
+        self.run_job(self.vna_ctrl.level_output, m.output_level.get(), m.level_per_point.get(),
+                     callback=self.show_leveling_result, errback=self.show_leveling_error)
+
+    def show_leveling_result(self, result):
+        if result is None:
+            return
+        levels = "Lower tone %.2f dBm, upper tone %.2f dBm" % (numpy.median(result.tl_o), numpy.median(result.tu_o))
+        if result.converged:
+            messagebox.showinfo("Output leveling", levels)
+        else:
+            messagebox.showwarning("Output leveling", "Not converged after %d iterations\n%s" % (
+                result.iterations, levels))
+
+    def show_leveling_error(self, e):
+        if isinstance(e, ValueError):
+            messagebox.showerror("Output leveling", str(e))
+        else:
+            self.show_settings_error(e)
+
+    def show_settings_error(self, e):
+        if isinstance(e, FrequencyPlanError):
+            messagebox.showerror("Invalid settings", str(e))
+        else:
+            logging.error("Applying the settings failed", exc_info=(type(e), e, e.__traceback__))
 
     def show_config_dialog(self):
         ConfigController(self.model, self.main_view)
 
-    def refresh_calpool(self):
+    def show_diagnostics(self):
+        dialog = DiagnosticsDialog(self.main_view, self.vna_ctrl.visa_stats, self.tk_dispatcher.latency,
+                                   self.model.subscriber_counts)
+        self.main_view.wait_window(dialog)
+
+    def show_calpool(self):
+        """
+        Show the cached cal pool in the cal group combobox. The cal pool is only read from the instrument if there
+        is no cached list.
+        """
+        calpool = self.vna_ctrl.cached_calpool
+        if calpool is not None:
+            self.main_view.set_calpool(calpool)
+        elif self.vna_ctrl.is_connected:
+            self.refresh_calpool(refresh=False)
+        else:
+            self.main_view.set_calpool([])
+
+    def refresh_calpool(self, refresh=True):
         if self.vna_ctrl.is_connected:
-            self.main_view.set_calpool(self.vna_ctrl.zva.cal_manager.get_calpool_list())
+            self.run_job(self.vna_ctrl.calpool, refresh, callback=self.main_view.set_calpool, name="refresh_calpool")
         else:
             self.main_view.set_calpool([])
 
+    def show_calibration_result(self, result):
+        failed = [name for name, ok in result.items() if not ok]
+        if failed:
+            messagebox.showwarning("Calibration", "The cal group %s couldn't be loaded in channel %s" % (
+                self.model.calgroup.get(), ", ".join(failed)))
+        self.show_calpool()
+
     def delete_cal_channel(self):
-        if self.vna_ctrl.check_if_cal_in_calgroup() is False and not self.main_view.cal_frame.ask_verify_delete():
-            return
-        self.vna_ctrl.delete_cal_channel()
+        def checked(in_calgroup):
+            if in_calgroup is False and not self.main_view.cal_frame.ask_verify_delete():
+                return
+            self.run_job(self.vna_ctrl.delete_cal_channel)
+        self.run_job(self.vna_ctrl.check_if_cal_in_calgroup, callback=checked)
 
     def run(self):
-        self.vna_ctrl.configure_sweep()
-        self.vna_ctrl.create_traces()
-
         self.tk_root.mainloop()
+        self.worker.stop(timeout=5)
+        if self.vna_ctrl.visa_log is not None:
+            self.vna_ctrl.visa_log.close()
         with open("settings.json", "w") as fp:
             self.model.store_json(fp)
 
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Observer bookkeeping with weak references.
+
+@author: Lukas Sandström
+"""
+
+import inspect
+import weakref
+
+
+class Subscription(object):
+    """
+    Returned by ObserverRegistry.add(), cancel() removes the observer.
+    """
+    def __init__(self, registry, key):
+        self._registry = weakref.ref(registry)
+        self._key = key
+
+    def cancel(self):
+        registry = self._registry()
+        if registry is not None:
+            registry.discard(self._key)
+
+    @property
+    def active(self):
+        registry = self._registry()
+        return registry is not None and self._key in registry._refs
+
+
+class ObserverRegistry(object):
+    """
+    Holds the observers of an Observable.
+
+    Bound methods are held by weak references, so an observer doesn't keep its object alive. Other callables,
+    e.g. lambdas, are held by strong references, unless an owner is given. The observer is then removed when the
+    owner, e.g. a widget or a Tk variable, is garbage collected. Dead observers are removed when found.
+    """
+    def __init__(self):
+        self._refs = {}
+
+    @staticmethod
+    def _key(func):
+        if inspect.ismethod(func):
+            return id(func.__self__), func.__func__
+        return func
+
+    def add(self, func, owner=None):
+        """
+        :param func: The observer
+        :param owner: The observer is removed when owner is garbage collected
+        :rtype: Subscription
+        """
+        key = self._key(func)
+        if inspect.ismethod(func):
+            ref = weakref.WeakMethod(func, lambda r: self._refs.pop(key, None))
+        else:
+            ref = lambda: func
+        self._refs[key] = ref
+        if owner is not None:
+            weakref.finalize(owner, self.discard, key)
+        return Subscription(self, key)
+
+    def remove(self, func):
+        del self._refs[self._key(func)]
+
+    def discard(self, key):
+        self._refs.pop(key, None)
+
+    def observers(self):
+        """
+        :return: The live observers
+        :rtype: list
+        """
+        ret = []
+        for key, ref in list(self._refs.items()):
+            func = ref()
+            if func is None:
+                self._refs.pop(key, None)
+            else:
+                ret.append(func)
+        return ret
+
+    def __len__(self):
+        return len(self.observers())
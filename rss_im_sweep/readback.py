@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Readback of the channel settings with compound queries.
+
+The channel catalog is read first, and then the settings of all requested channels are read with a single
+semicolon joined query, so reading back any number of channels takes two round trips.
+
+@author: Lukas Sandström
+"""
+
+from collections import namedtuple
+
+ChannelSnapshot = namedtuple("ChannelSnapshot", [
+    "number", "name",
+    "start", "stop",  # The sweep range of the stimulus, Hz
+    "arb",  # (numerator, denominator, offset) of the ARB frequency conversion of the receivers
+    "points", "ifbw", "selectivity", "power", "trigger",
+    "calgroup",  # The name of the loaded cal group, or None
+])
+
+
+def _arb(s):
+    num, den, offset = s.split(",")[:3]
+    return int(float(num)), int(float(den)), float(offset)
+
+
+def _calgroup(s):
+    return s.strip("'\"") or None
+
+
+# (field, query, parser), in ChannelSnapshot order after the number and name
+snapshot_queries = (
+    ("start", "SENSe{n}:FREQuency:STARt?", float),
+    ("stop", "SENSe{n}:FREQuency:STOP?", float),
+    ("arb", "SENSe{n}:FREQuency:CONVersion:ARBitrary?", _arb),
+    ("points", "SENSe{n}:SWEep:POINts?", lambda s: int(float(s))),
+    ("ifbw", "SENSe{n}:BANDwidth:RESolution?", float),
+    ("selectivity", "SENSe{n}:BANDwidth:RESolution:SELect?", lambda s: s.strip().lower()),
+    ("power", "SOURce{n}:POWer:LEVel:IMMediate:AMPLitude?", float),
+    ("trigger", "TRIGger{n}:SEQuence:SOURce?", lambda s: s.strip().upper()),
+    ("calgroup", "MMEMory:LOAD:CORRection? {n}", _calgroup),
+)
+
+
+def parse_channel_catalog(response):
+    """
+    :param str response: The response to CONFigure:CHANnel:CATalog?, e.g. "'1,TL,2,TU'"
+    :return: {channel number: channel name}
+    :rtype: dict
+    """
+    items = response.strip().strip("'\"").split(",")
+    if items == [""]:
+        return {}
+    return {int(n): name for n, name in zip(items[::2], items[1::2])}
+
+
+def snapshot_query(numbers):
+    """
+    :param numbers: The channel numbers
+    :return: The compound query reading the settings of all the channels
+    :rtype: str
+    """
+    return ";:".join(q.format(n=n) for n in numbers for _, q, _ in snapshot_queries)
+
+
+def parse_snapshots(catalog, numbers, response):
+    """
+    Parse the response to snapshot_query(numbers).
+
+    :param dict catalog: {channel number: channel name}
+    :rtype: list of ChannelSnapshot
+    """
+    parts = response.strip().split(";")
+    n_fields = len(snapshot_queries)
+    if len(parts) != n_fields * len(numbers):
+        raise ValueError("Expected %d responses, got %d" % (n_fields * len(numbers), len(parts)))
+    ret = []
+    for i, n in enumerate(numbers):
+        values = [parse(p) for (_, _, parse), p in zip(snapshot_queries, parts[i * n_fields:(i + 1) * n_fields])]
+        ret.append(ChannelSnapshot(n, catalog.get(n), *values))
+    return ret
+
+
+def read_snapshots(instrument, names=None):
+    """
+    Read the settings of the channels of an RSSscpi instrument.
+
+    :param names: The names of the channels to read, defaults to all channels
+    :return: {channel name: ChannelSnapshot}, for the existing channels
+    :rtype: dict
+    """
+    with instrument._visa_lock:
+        catalog = parse_channel_catalog(str(instrument._query("CONFigure:CHANnel:CATalog?")))
+        numbers = [n for n, name in sorted(catalog.items()) if names is None or name in names]
+        if not numbers:
+            return {}
+        response = str(instrument._query(snapshot_query(numbers)))
+    return {s.name: s for s in parse_snapshots(catalog, numbers, response)}
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Binary readout of trace data.
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+real_formats = {"REAL,32": "<f4", "REAL,64": "<f8"}
+"""The FORMat:DATA settings supported by the readout, with FORMat:BORDer SWAPped (little endian)"""
+
+
+class TraceData(dict):
+    """
+    The trace data read from the instrument, as numpy arrays keyed by trace name.
+    The sweep axis, the tone spacing, is stored in the spacing attribute.
+    """
+    def __init__(self, traces=(), spacing=None):
+        super().__init__(traces)
+        self.spacing = spacing  # type: numpy.ndarray
+
+
+def parse_block_header(buf):
+    """
+    Parse the header of a SCPI block data transfer, #<n><length><data>
+
+    :param buf: bytes or memoryview
+    :return: The offset of the data and the data length, in bytes
+    :rtype: (int, int)
+    """
+    if bytes(buf[0:1]) != b"#":
+        raise ValueError("Invalid block data header: %r" % bytes(buf[0:5]))
+    n = int(bytes(buf[1:2]))
+    if n == 0:  # Indefinite length block, terminated by newline + END
+        return 2, len(bytes(buf).rstrip(b"\n")) - 2
+    return n + 2, int(bytes(buf[2:n + 2]))
+
+
+def block_to_array(buf, fmt="REAL,32", complex_=False):
+    """
+    Create a numpy array from a binary block, without copying the data.
+
+    :param bytes buf: The raw response from the instrument
+    :param str fmt: The FORMat:DATA setting used for the transfer
+    :param bool complex_: Interpret the data as (real, imag) pairs
+    :rtype: numpy.ndarray
+    """
+    offset, length = parse_block_header(buf)
+    dtype = numpy.dtype(real_formats[fmt])
+    if complex_:
+        dtype = numpy.dtype("<c%d" % (2 * dtype.itemsize))
+    if offset + length > len(buf):
+        raise ValueError("Truncated block data, %d of %d bytes received" % (len(buf) - offset, length))
+    return numpy.frombuffer(buf, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+
+
+def split_response(buf):
+    """
+    Split the response to a compound query, where each query may return ASCII data or a binary block.
+
+    :param bytes buf: The raw response
+    :return: A list with a str for each ASCII response, and a memoryview of the whole block for block responses
+    :rtype: list
+    """
+    view = memoryview(buf)
+    ret = []
+    pos = 0
+    end = len(buf) - 1 if buf[-1:] == b"\n" else len(buf)
+    while pos < end:
+        if buf[pos:pos + 1] == b"#":
+            offset, length = parse_block_header(view[pos:])
+            ret.append(view[pos:pos + offset + length])
+            pos += offset + length + 1  # Skip the ";" separator
+        else:
+            sep = buf.find(b";", pos, end)
+            if sep < 0:
+                sep = end
+            ret.append(buf[pos:sep].decode().strip())
+            pos = sep + 1
+    return ret
+
+
+def demux(data, lengths):
+    """
+    Split the data of several traces, read as one array, into one view per trace.
+
+    :param numpy.ndarray data:
+    :param list of int lengths: The number of points in each trace
+    :rtype: list of numpy.ndarray
+    """
+    if sum(lengths) != len(data):
+        raise ValueError("Expected %d points, got %d" % (sum(lengths), len(data)))
+    return numpy.split(data, numpy.cumsum(lengths)[:-1])
+
+
+def query_block(instrument, cmd_str):
+    """
+    Execute a query with a binary block response, and return the raw response. Any writes pending in an
+    active SCPIBatch are sent first.
+
+    :param RSSscpi.zva.ZVA instrument:
+    :param str cmd_str: The complete query
+    :rtype: bytes
+    """
+    res = instrument._visa_res
+
+    def write_read_raw(cmd):
+        term = res.read_termination
+        res.read_termination = None  # The binary data may contain the termination character
+        try:
+            res.write(cmd)
+            return res.read_raw()
+        finally:
+            res.read_termination = term
+
+    with instrument._visa_lock:
+        batch = getattr(instrument, "_scpi_batch", None)
+        if batch is not None:
+            batch.flush()
+        return instrument._call_visa(write_read_raw, cmd_str)
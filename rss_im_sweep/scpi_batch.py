@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Batching of SCPI traffic to an RSSscpi instrument.
+
+@author: Lukas Sandström
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+
+def join_commands(commands):
+    """
+    Join SCPI commands into one program message. All commands except the common (*XXX) commands
+    are given a leading colon, so that each command starts from the root of the command tree.
+
+    :param list of str commands:
+    :rtype: str
+    """
+    return ";".join(c if c[0] in "*:" else ":" + c for c in commands)
+
+
+class SCPIBatch(object):
+    """
+    Context manager which collects the writes sent to an instrument and sends them as semicolon
+    joined program messages. A query flushes the pending writes in the same message as the query,
+    so the ordering of the commands is preserved. On exit the remaining writes are sent together
+    with a single *OPC?;SYSTem:ERRor:ALL? synchronization.
+
+    The batch is hooked into Instrument._write() and Instrument._query(), so all the SCPI properties
+    and command nodes of RSSscpi can be used as usual inside the with block. Nested batches are
+    merged into the outermost batch.
+    """
+    def __init__(self, instrument, name="batch", max_len=4000, enabled=True):
+        """
+        :param RSSscpi.zva.ZVA instrument:
+        :param str name: Used when logging the batch statistics
+        :param int max_len: The maximum length of a program message, in characters
+        :param bool enabled: If False the batch is a no-op, and all commands are sent directly
+        """
+        self.instrument = instrument
+        self.name = name
+        self.max_len = max_len
+        self.enabled = enabled
+
+        self.commands = 0
+        """The number of writes and queries issued inside the batch"""
+        self.round_trips = 0
+        """The number of messages actually sent to the instrument"""
+        self.errors = []
+        """The instrument errors reported by the final synchronization"""
+
+        self._pending = []
+        self._pending_len = 0
+        self._saved = None
+
+    @property
+    def saved_round_trips(self):
+        return self.commands - self.round_trips
+
+    def __str__(self):
+        return "%s: %d commands in %d round trips, %d saved" % (
+            self.name, self.commands, self.round_trips, self.saved_round_trips)
+
+    @property
+    def active(self):
+        return self._saved is not None
+
+    def __enter__(self):
+        inst = self.instrument
+        if not self.enabled or inst is None or isinstance(getattr(inst, "_scpi_batch", None), SCPIBatch):
+            return self  # Disabled, or nested in an already active batch
+        self._saved = (inst.__dict__.get("_write"), inst.__dict__.get("_query"), inst._write, inst._query)
+        inst._write = self._write
+        inst._query = self._query
+        inst._scpi_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.active:
+            return
+        inst = self.instrument
+        try:
+            with inst._visa_lock:
+                if exc_type is None:
+                    self._sync()
+                else:
+                    self.flush()
+        finally:
+            self._restore()
+        logger.info("%s", self)
+
+    def _restore(self):
+        inst = self.instrument
+        for attr, value in zip(("_write", "_query"), self._saved[:2]):
+            if value is None:
+                del inst.__dict__[attr]
+            else:
+                setattr(inst, attr, value)
+        del inst._scpi_batch
+        self._saved = None
+
+    def _write(self, cmd_str):
+        self.commands += 1
+        if self._pending and self._pending_len + len(cmd_str) + 2 > self.max_len:
+            self.flush()
+        self._pending.append(cmd_str)
+        self._pending_len += len(cmd_str) + 2
+
+    def _query(self, cmd_str):
+        self.commands += 1
+        return self._send_query(cmd_str)
+
+    def _send_query(self, cmd_str):
+        """
+        Send the pending writes and the query in one message.
+        """
+        if self._pending_len + len(cmd_str) > self.max_len:
+            self.flush()
+        self._pending.append(cmd_str)
+        msg = join_commands(self._pending)
+        self._pending = []
+        self._pending_len = 0
+        self.round_trips += 1
+        return self._saved[3](msg)
+
+    def flush(self):
+        """
+        Send all pending writes to the instrument. The caller must hold the VISA lock.
+        """
+        if not self._pending:
+            return
+        msg = join_commands(self._pending)
+        self._pending = []
+        self._pending_len = 0
+        self.round_trips += 1
+        self._saved[2](msg)
+
+    def _sync(self):
+        """
+        Flush the pending writes, wait for the operations to complete, and read out the error queue.
+        """
+        res = str(self._send_query("*OPC?;:SYSTem:ERRor:ALL?"))
+        _opc, _, err = res.partition(";")
+        self.errors.extend(parse_errors(self.instrument, err))
+        self.instrument._errors_checked_at = self.instrument.command_cnt
+
+
+EAV = 0x04
+"""The error/event queue bit of the status byte"""
+
+
+def parse_errors(instrument, err):
+    """
+    Parse the response to SYSTem:ERRor:ALL?, and put the errors in the error queue of the instrument.
+
+    :rtype: list of RSSscpi.Instrument.Error
+    """
+    errors = []
+    for r in re.finditer(r'(-?\d+),"(.*?)"', err):
+        err_no = int(r.group(1))
+        if err_no == 0:
+            continue
+        e = instrument.Error(err_no, r.group(2).replace("\n", " "), None)
+        errors.append(e)
+        instrument.error_queue.put_nowait(e)
+        instrument.visa_logger.error("%d %s", err_no, e.err_str)
+    return errors
+
+
+def check_errors(instrument):
+    """
+    Read out the error queue of the instrument if the status byte indicates that it isn't empty. Nothing is sent
+    if no commands have been sent since the last check, or since the last synchronization of an SCPIBatch.
+    The errors are put in the error queue of the instrument. The caller must hold the VISA lock.
+
+    :rtype: list of RSSscpi.Instrument.Error
+    """
+    if getattr(instrument, "_errors_checked_at", None) == instrument.command_cnt:
+        return []
+    errors = []
+    res = instrument._visa_res
+    if res.read_stb() & EAV:
+        errors = parse_errors(instrument, str(res.query("SYSTem:ERRor:ALL?")))
+    instrument._errors_checked_at = instrument.command_cnt
+    return errors
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+The segmented measurement mode, which measures the tones and the IM3 products with two segmented sweeps instead of
+sweeping the four IM channels one after another.
+
+The TONE channel measures the lower tone in its first segment and the upper tone in its second segment, and the IM3
+channel measures the lower and upper IM3 products in the same way, see FrequencyPlan.segmented. The first segment of
+each channel sweeps the tone spacing downwards. The adaptive refinement splits each half into several segments, see
+FrequencyPlan.refined(). unfold_segments() converts the traces read from the two channels to the traces of the four
+channel mode, so that the rest of the program doesn't depend on the measurement mode.
+
+The source conversions are linear in the stimulus, so the tone ports swap places between the halves: in the second
+half the upper tone is generated by src_tl and the lower tone by src_tu, while the four channel mode always uses
+src_tu for the upper tone. The receiver follows src_tl in both halves. If the two ports don't deliver the same
+power, e.g. because of a power offset or a different cable loss, the second half sees other tone powers than the
+four channel mode, and the upper IM3 product is 2 P(src_tl) + P(src_tu) instead of 2 P(src_tu) + P(src_tl).
+unfold_segments() corrects for this with the a-waves of both halves, assuming a linear tone gain and an IM3 product
+which scales with the cube of the tone amplitudes, as below the compression point. Points where an a-wave is zero,
+e.g. in a sweep with RF off, are not corrected.
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+from rss_im_sweep.readout import TraceData
+
+segmented_traces = {"TONE_A_TL": "TONE", "TONE_A_TU": "TONE", "TONE_B": "TONE", "IM3_B": "IM3"}
+"""The traces created in the segmented mode, and the name of the channel they belong to"""
+
+
+def _halves(trace, points):
+    """
+    :return: The lower and upper half of a trace, both in increasing tone spacing order
+    """
+    if len(trace) != 2 * points:
+        raise ValueError("Expected %d points, got %d" % (2 * points, len(trace)))
+    return trace[points - 1::-1], trace[points:]
+
+
+def _amplitude_ratio(a, b):
+    """
+    :return: abs(a / b), and 1 where b is zero
+    """
+    b = numpy.abs(b)
+    return numpy.divide(numpy.abs(a), b, out=numpy.ones(len(b)), where=b > 0)
+
+
+def unfold_segments(data, points, ratios=False):
+    """
+    Convert the traces of the segmented mode to the traces of the four channel mode.
+
+    :param TraceData data: The segmented_traces, with the stimulus of the TONE channel as spacing
+    :param int points: The number of points in each half of the segments
+    :param bool ratios: Also calculate the IM3L_OR and IM3U_OR ratio traces
+    :rtype: TraceData
+    """
+    tl_i, a_upper = _halves(data["TONE_A_TL"], points)  # The upper tone is generated by src_tl in the second half
+    tu_i, a_lower = _halves(data["TONE_A_TU"], points)
+    tl_o, tu_o = _halves(data["TONE_B"], points)
+    im3l_o, im3u_o = _halves(data["IM3_B"], points)
+    # Scale the second half to the tone amplitudes of the first half, where the ports are as in the four channel mode
+    k_upper = _amplitude_ratio(tu_i, a_upper)
+    k_lower = _amplitude_ratio(tl_i, a_lower)
+    tu_o = tu_o * k_upper
+    im3u_o = im3u_o * k_upper ** 2 * k_lower
+    ret = TraceData((("TL_I", tl_i), ("TU_I", tu_i), ("TL_O", tl_o), ("TU_O", tu_o),
+                     ("IM3L_O", im3l_o), ("IM3U_O", im3u_o)))
+    if ratios:
+        ret["IM3L_OR"] = im3l_o / tl_o
+        ret["IM3U_OR"] = im3u_o / tu_o
+    if data.spacing is not None:
+        f_l, f_u = _halves(numpy.asarray(data.spacing), points)
+        ret.spacing = f_u - f_l  # The upper minus the lower tone
+    return ret
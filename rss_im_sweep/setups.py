@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of complete instrument setups, for fast switching between the measurement modes.
+
+A setup is stored on the instrument with MMEMory:STORe:STATe the first time a mode is configured, and recalled with
+MMEMory:LOAD:STATe the next time. The setups are keyed by a hash of the model variables which affect the setup,
+so a setup is only recalled if it was created with the current settings. The controller state, e.g. the
+settings applied to each channel, is saved together with each setup.
+
+@author: Lukas Sandström
+"""
+
+import copy
+import hashlib
+import json
+from collections import namedtuple
+
+SavedSetup = namedtuple("SavedSetup", ["key", "filename", "state"])
+
+
+def setup_key(mode, values):
+    """
+    :param str mode: The measurement mode
+    :param dict values: The model variables which affect the setup, {name: value}
+    :return: A short hash identifying the setup
+    :rtype: str
+    """
+    data = json.dumps([mode, sorted(values.items())], sort_keys=True, default=repr)
+    return hashlib.sha1(data.encode()).hexdigest()[:12]
+
+
+class SetupStore(object):
+    """
+    The setups stored on the instrument in this session, by mode.
+    """
+    directory = "C:\\Rohde&Schwarz\\Nwa\\RecallSets\\"
+
+    def __init__(self, prefix="rss_im_sweep"):
+        self.prefix = prefix
+        self._setups = {}  # type: {str: SavedSetup}
+        self.recalls = 0
+        self.stores = 0
+
+    def filename(self, mode, key):
+        return "%s%s_%s_%s.zvx" % (self.directory, self.prefix, mode, key)
+
+    def get(self, mode, key):
+        """
+        :return: The saved setup of the mode, if it was stored with the same key
+        :rtype: SavedSetup
+        """
+        setup = self._setups.get(mode)
+        if setup is None or setup.key != key:
+            return None
+        return setup
+
+    def add(self, mode, key, state):
+        """
+        Record that the setup of a mode has been stored on the instrument.
+
+        :param state: The controller state belonging to the setup, a deep copy is saved
+        :rtype: SavedSetup
+        """
+        setup = SavedSetup(key, self.filename(mode, key), copy.deepcopy(state))
+        self._setups[mode] = setup
+        self.stores += 1
+        return setup
+
+    def discard(self, mode=None):
+        """
+        Forget the setup of a mode, or of all modes.
+        """
+        if mode is None:
+            self._setups.clear()
+        else:
+            self._setups.pop(mode, None)
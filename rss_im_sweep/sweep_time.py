@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Estimation of the measurement time, and selection of the IF bandwidth, selectivity and number of points from a
+time budget or a required IM3 dynamic range.
+
+The time of a channel sweep is modelled as overhead + points * (selectivity factor / IFBW + settle), and a complete
+measurement as the sum of the channel sweeps plus the host overhead for triggering and readout. The settling time
+is fitted to the sweep times reported by the instrument, and the host overhead to the measured readout times.
+
+@author: Lukas Sandström
+"""
+
+import math
+from collections import namedtuple
+
+import numpy
+
+IFBW_VALUES = tuple(float(10 ** a * b) for a in range(7) for b in (1, 2, 5))
+"""The IF bandwidths considered by the optimizer, as in IFFreqSpinbox"""
+
+SELECTIVITY_FACTOR = {"norm": 1.0, "high": 1.6}
+"""The measurement time per point relative to 1 / IFBW, for each IF selectivity"""
+
+SELECTIVITY_OFFSET = {"norm": 30.0, "high": 10.0}
+"""The minimum distance from a tone to the measured IM3 product, in IF bandwidths, for each IF selectivity"""
+
+SweepEstimate = namedtuple("SweepEstimate", [
+    "ifbw", "selectivity", "points",
+    "time",  # The estimated measurement time, s
+    "dynamic_range",  # The output tone power relative to the noise floor, dB
+])
+
+
+class SweepTimeModel(object):
+    def __init__(self, overhead=5e-3, settle=60e-6, host_overhead=0.05, noise_density=-159.0):
+        """
+        :param float overhead: The fixed time of each channel sweep, s
+        :param float settle: The time per point which doesn't depend on the IF bandwidth, s
+        :param float host_overhead: The time to trigger the sweep and read out the traces, s
+        :param float noise_density: The receiver noise floor in 1 Hz bandwidth, dBm
+        """
+        self.overhead = overhead
+        self.settle = settle
+        self.host_overhead = host_overhead
+        self.noise_density = noise_density
+
+    def channel_time(self, points, ifbw, selectivity):
+        """
+        :return: The sweep time of a channel, s. Accepts arrays of IF bandwidths.
+        """
+        return self.overhead + points * (SELECTIVITY_FACTOR[selectivity.lower()] / ifbw + self.settle)
+
+    def _coefficients(self, ifbw, selectivity, meas_mode, tone_ifbw):
+        """
+        :return: (a, b) such that the measurement time is a + b * points
+        """
+        per_point = SELECTIVITY_FACTOR[selectivity.lower()] / ifbw + self.settle
+        if meas_mode == "segmented":  # Two channels with two segments each, the tones with their own IFBW
+            tone = SELECTIVITY_FACTOR[selectivity.lower()] / (tone_ifbw or ifbw) + self.settle
+            return 2 * self.overhead + self.host_overhead, 2 * (per_point + tone)
+        return 4 * self.overhead + self.host_overhead, 4 * per_point
+
+    def measurement_time(self, points, ifbw, selectivity, meas_mode="channels", tone_ifbw=None):
+        """
+        :param str meas_mode: "channels" or "segmented"
+        :param float tone_ifbw: The IF bandwidth of the tones in the segmented mode, defaults to ifbw
+        :return: The time of a complete measurement, including the host overhead, s
+        """
+        a, b = self._coefficients(ifbw, selectivity, meas_mode, tone_ifbw)
+        return a + b * points
+
+    def noise_floor(self, ifbw):
+        """
+        :return: The receiver noise floor, dBm
+        """
+        return self.noise_density + 10 * numpy.log10(ifbw)
+
+    def calibrate(self, reported, points, ifbw, selectivity):
+        """
+        Fit the settling time to the sweep time of a channel reported by the instrument.
+
+        :param float reported: The reported sweep time, s
+        """
+        per_point = (reported - self.overhead) / points - SELECTIVITY_FACTOR[selectivity.lower()] / ifbw
+        self.settle = max(0.0, per_point)
+
+    def observe(self, elapsed, sweep_time, weight=0.25):
+        """
+        Update the host overhead with the time of a measurement.
+
+        :param float elapsed: The measured time of the sweep and the readout, s
+        :param float sweep_time: The estimated sweep time of all channels, s
+        """
+        self.host_overhead += weight * (max(0.0, elapsed - sweep_time) - self.host_overhead)
+
+
+def _candidates(spacing_start):
+    """
+    :return: The (ifbw, selectivity) pairs which suppress the closest tone enough, in order of increasing ifbw
+    """
+    return [(ifbw, sel) for ifbw in IFBW_VALUES for sel in ("norm", "high")
+            if ifbw * SELECTIVITY_OFFSET[sel] <= spacing_start]
+
+
+def optimize(model, points, spacing_start, tone_power, budget=None, dynamic_range=None, min_points=11,
+             meas_mode="channels", tone_ifbw=None):
+    """
+    Choose the IF bandwidth, selectivity and number of points of the IM measurement.
+
+    With a dynamic range requirement, the fastest settings which reach it with the requested number of points are
+    chosen. With a time budget, the settings with the highest dynamic range which fit in the budget are chosen.
+    The number of points is only reduced, down to min_points, if the budget can't be met with the requested
+    number of points.
+
+    :param SweepTimeModel model:
+    :param int points: The requested number of points
+    :param float spacing_start: The smallest tone spacing, which limits the IF bandwidth, Hz
+    :param float tone_power: The tone power at the DUT output, dBm
+    :param float budget: The time budget of a measurement, s
+    :param float dynamic_range: The required dynamic range of the IM3 measurement, dB
+    :return: The chosen settings, or None if the requirement can't be met
+    :rtype: SweepEstimate
+    """
+    if (budget is None) == (dynamic_range is None):
+        raise ValueError("Specify either a time budget or a dynamic range")
+
+    def estimate(ifbw, sel, n):
+        return SweepEstimate(ifbw, sel, n, model.measurement_time(n, ifbw, sel, meas_mode, tone_ifbw),
+                             float(tone_power - model.noise_floor(ifbw)))
+
+    candidates = _candidates(spacing_start)
+    if dynamic_range is not None:
+        ok = [estimate(ifbw, sel, points) for ifbw, sel in candidates
+              if tone_power - model.noise_floor(ifbw) >= dynamic_range]
+        return min(ok, key=lambda e: e.time) if ok else None
+
+    max_points = {}
+    for ifbw, sel in candidates:
+        a, b = model._coefficients(ifbw, sel, meas_mode, tone_ifbw)
+        max_points[ifbw, sel] = min(points, math.floor((budget - a) / b))
+    if not max_points:
+        return None
+    n = max(max_points.values())
+    if n < min_points:
+        return None
+    ifbw, sel = min((k for k, v in max_points.items() if v >= n), key=lambda k: (k[0], SELECTIVITY_FACTOR[k[1]]))
+    return estimate(ifbw, sel, n)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Delivery of callbacks from background threads to the Tk thread.
+
+@author: Lukas Sandström
+"""
+
+import collections
+import logging
+import threading
+import timeit
+
+from rss_im_sweep.instrumentation import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class TkDispatcher(object):
+    """
+    Background threads post callbacks with post(), which are invoked in the Tk thread. The Tk thread is woken up
+    with one virtual event per batch of callbacks, so there is no polling while the application is idle.
+
+    If the Tcl interpreter isn't thread safe, the queue is polled with after() instead. Callbacks posted before
+    the mainloop is running are delivered when it starts.
+    """
+    event = "<<TkDispatcherWakeup>>"
+
+    def __init__(self, tk_root, fallback_poll_ms=50):
+        """
+        Must be created in the Tk thread.
+
+        :param tk.Tk tk_root:
+        :param int fallback_poll_ms: The poll interval, if the Tcl interpreter isn't threaded
+        """
+        self.tk_root = tk_root
+        self.fallback_poll_ms = fallback_poll_ms
+        self._tk_thread = threading.current_thread()
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        self._wake_pending = False
+
+        self.latency = LatencyHistogram()
+        """The time from the first post() of a batch until the batch is delivered, in seconds"""
+        self.wakeups = 0
+        self.delivered = 0
+
+        tk_root.bind(self.event, self._deliver)
+        self.polling = not self._tcl_is_threaded()
+        if self.polling:
+            logger.warning("The Tcl interpreter isn't threaded, polling every %d ms", fallback_poll_ms)
+            tk_root.after(fallback_poll_ms, self._poll)
+        else:
+            tk_root.after_idle(self._deliver)
+
+    def _tcl_is_threaded(self):
+        try:
+            return bool(self.tk_root.tk.call("set", "tcl_platform(threaded)"))
+        except Exception:
+            return False
+
+    def post(self, func, *args):
+        """
+        Invoke func(*args) in the Tk thread. Thread safe.
+        """
+        with self._lock:
+            self._queue.append((timeit.default_timer(), func, args))
+            if self._wake_pending or self.polling:
+                return
+            self._wake_pending = True
+        self._wake()
+
+    def _wake(self):
+        if threading.current_thread() is self._tk_thread:
+            self.tk_root.after_idle(self._deliver)
+            return
+        try:
+            self.tk_root.event_generate(self.event, when="tail")
+        except RuntimeError:
+            # The mainloop isn't running yet, the queue is emptied by the after_idle() callback from __init__
+            with self._lock:
+                self._wake_pending = False
+            logger.debug("Tk wakeup failed, the mainloop isn't running")
+
+    def _poll(self):
+        self._deliver()
+        self.tk_root.after(self.fallback_poll_ms, self._poll)
+
+    def _deliver(self, event=None):
+        with self._lock:
+            self._wake_pending = False
+            batch = list(self._queue)
+            self._queue.clear()
+        if not batch:
+            return
+        self.wakeups += 1
+        self.latency.add(timeit.default_timer() - batch[0][0])
+        for _, func, args in batch:
+            self.delivered += 1
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Exception in callback %r posted to the Tk thread", func)
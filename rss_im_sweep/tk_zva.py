@@ -232,6 +232,14 @@ class PowerSpinbox(ZVAIncrementSpinbox, PowerEntry):
     pass
 
 
+class TimeEntry(ZVAEntry):
+    prefixes = {"": (1, "s"), "k": (1, "s"), "m": (1e-3, "ms"), "g": (1, "s")}
+
+
+class DBEntry(ZVAEntry):
+    prefixes = {"": (1, "dB"), "k": (1, "dB"), "m": (1, "dB"), "g": (1, "dB")}
+
+
 class IntEntry(ttk.Entry):
     def __init__(self, master, intvar, *args, **kwargs):
         super().__init__(master, *args, **kwargs)
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Non-blocking logging of the VISA traffic.
+
+The records from the instrument's VISA logger are put in a queue, and written by a background thread to a
+size limited, rotating file, where the rotated files are gzip compressed. The last records are also kept in
+memory, so that the commands leading up to an instrument error can be dumped on demand.
+
+@author: Lukas Sandström
+"""
+
+import collections
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last capacity formatted records in memory.
+    """
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self._buffer = collections.deque(maxlen=capacity)
+        self._lock_ring = threading.Lock()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self._lock_ring:
+            self._buffer.append(line)
+
+    def last(self, n=None):
+        """
+        :return: The last n records, oldest first. All records in the buffer if n is None
+        :rtype: list of str
+        """
+        with self._lock_ring:
+            lines = list(self._buffer)
+        return lines if n is None else lines[-n:]
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    A RotatingFileHandler which gzip compresses the rotated files, e.g. main_visa_log.txt.1.gz
+    """
+    def __init__(self, filename, max_bytes=10 * 2**20, backup_count=5, **kwargs):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, **kwargs)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._compress
+
+    @staticmethod
+    def _compress(source, dest):
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+
+class VisaLog(object):
+    """
+    Attaches a QueueHandler to a logger, and writes the records to a rotating file and a ring buffer in a
+    QueueListener thread. The logger no longer propagates the records to the root logger, so the VISA traffic
+    doesn't pass through the console handlers and filters, until the log is closed.
+    """
+    fmt = "%(asctime)s %(threadName)s %(message)s"
+
+    def __init__(self, logger, filename=None, ring_size=1000, max_bytes=10 * 2**20, backup_count=5):
+        """
+        :param logging.Logger logger: The logger to capture, e.g. zva.visa_logger
+        :param str filename: The log file, or None to keep the records in memory only
+        :param int ring_size: The number of records to keep in memory
+        """
+        self.logger = logger
+        self.ring = RingBufferHandler(ring_size)
+        handlers = [self.ring]
+        self.file_handler = None
+        if filename is not None:
+            self.file_handler = CompressingRotatingFileHandler(filename, max_bytes, backup_count, encoding="utf-8")
+            handlers.append(self.file_handler)
+        formatter = logging.Formatter(self.fmt)
+        for h in handlers:
+            h.setFormatter(formatter)
+
+        self._queue = queue.SimpleQueue()
+        self.queue_handler = logging.handlers.QueueHandler(self._queue)
+        self.listener = logging.handlers.QueueListener(self._queue, *handlers)
+        self.listener.start()
+        logger.addHandler(self.queue_handler)
+        self._propagate = logger.propagate
+        logger.propagate = False
+
+    def last(self, n=None):
+        """
+        The last n log records. Records which are still in the queue are not included.
+
+        :rtype: list of str
+        """
+        return self.ring.last(n)
+
+    def dump_last(self, n=50, level=logging.ERROR, target=None):
+        """
+        Log the last n VISA records to the target logger, e.g. when an instrument error has been reported.
+        """
+        target = logging.getLogger(__name__) if target is None else target
+        target.log(level, "The last %d VISA log records:\n%s", n, "\n".join(self.last(n)))
+
+    def close(self):
+        self.logger.removeHandler(self.queue_handler)
+        self.logger.propagate = self._propagate
+        self.listener.stop()  # Writes the remaining records
+        if self.file_handler is not None:
+            self.file_handler.close()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Background execution of instrument jobs.
+
+@author: Lukas Sandström
+"""
+
+import itertools
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from rss_im_sweep.instrumentation import operation
+
+logger = logging.getLogger(__name__)
+
+
+class JobAborted(Exception):
+    """Raised by InstrumentWorker.check_abort() in a job which is pre-empted by an urgent job"""
+
+
+class Job(object):
+    def __init__(self, func, args, name, callback, errback, key=None):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.name = name
+        self.callback = callback
+        self.errback = errback
+        self.future = Future()
+        self.instrument_errors = []
+        """The instrument errors reported after the job was executed"""
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            with operation(self.name):
+                result = self.func(*self.args)
+        except BaseException as e:  # RSSscpi.Instrument.Error is a BaseException
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+    def deliver(self):
+        """
+        Invoke the callback or errback with the outcome of the job. Called in the Tk thread.
+        """
+        if self.future.cancelled():
+            return
+        e = self.future.exception()
+        if e is None:
+            if self.callback is not None:
+                self.callback(self.future.result())
+        elif self.errback is not None:
+            self.errback(e)
+        elif isinstance(e, JobAborted):
+            logger.info("Instrument job %s was aborted", self.name)
+        else:
+            logger.error("Instrument job %s failed", self.name, exc_info=(type(e), e, e.__traceback__))
+
+
+class InstrumentWorker(object):
+    """
+    A thread which owns the instrument session and executes the submitted jobs one at a time.
+    The outcome of each job is put in a queue, from which the callbacks are invoked by calling
+    deliver_results() in the Tk thread.
+
+    An urgent job, e.g. RF OFF, is executed before the queued jobs, but a running job isn't interrupted. Long jobs,
+    such as a grid measurement, must call check_abort() between the instrument steps, so that an urgent job only
+    has to wait for the current step.
+    """
+    URGENT = 0
+    NORMAL = 10
+
+    def __init__(self, name="Instrument worker", error_check=None, notify=None):
+        """
+        :param error_check: Called in the worker thread after each job, returns the instrument errors caused by
+                            the job, which are passed to error_handler
+        :param notify: Called in the worker thread when a job has completed, to wake up the Tk thread, which
+                       should then call deliver_results()
+        """
+        self.error_check = error_check
+        self.notify = notify
+        self.error_handler = None
+        """Invoked with the job name and the instrument errors of the job, from deliver_results()"""
+        self._jobs = queue.PriorityQueue()
+        self._seq = itertools.count()  # Keeps the FIFO order between jobs with the same priority
+        self._done = queue.Queue()
+        self.current_job = None  # type: Job
+        self._abort = threading.Event()
+        """Set when an urgent job is submitted while a job is running, cleared when the next job starts"""
+
+        self._lock = threading.Lock()
+        self._latest = {}  # type: {object: Job}
+        """Queued, not yet started, jobs submitted with submit_latest(), by key"""
+        self.superseded = 0
+        """The number of jobs dropped by submit_latest(), since a newer job with the same key was submitted"""
+
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, callback=None, errback=None, priority=NORMAL, name=None):
+        """
+        Queue func(*args) for execution in the worker thread.
+
+        :param func: The function to execute
+        :param callback: Invoked with the return value of func, in the Tk thread
+        :param errback: Invoked with the exception raised by func, in the Tk thread. The exception is logged if None.
+        :param int priority: Jobs with lower priority values are executed first, use URGENT for RF OFF and similar
+        :param str name: The name of the job, defaults to the name of func
+        :rtype: concurrent.futures.Future
+        """
+        return self._submit(Job(func, args, name, callback, errback), priority)
+
+    def submit_latest(self, key, func, *args, callback=None, errback=None, priority=NORMAL, name=None):
+        """
+        Like submit(), but if a job with the same key is still waiting in the queue, that job is updated
+        with the new func and args instead of queueing a new job. The future of the queued job is returned.
+
+        :param key: Identifies the setting written by the job, e.g. the model variable name
+        :rtype: concurrent.futures.Future
+        """
+        with self._lock:
+            job = self._latest.get(key)
+            if job is not None:
+                job.func = func
+                job.args = args
+                self.superseded += 1
+                return job.future
+            job = Job(func, args, name, callback, errback, key=key)
+            self._latest[key] = job
+        return self._submit(job, priority)
+
+    def _submit(self, job, priority):
+        if job.name is None:
+            job.name = getattr(job.func, "__name__", repr(job.func))
+        if priority <= self.URGENT and self.busy:
+            self._abort.set()
+        self._jobs.put((priority, next(self._seq), job))
+        return job.future
+
+    def check_abort(self):
+        """
+        Called by a long job in the worker thread between instrument steps.
+
+        :raises JobAborted: If an urgent job has been submitted since the job started
+        """
+        if self._abort.is_set():
+            raise JobAborted("Aborted by an urgent instrument job")
+
+    @property
+    def pending(self):
+        """The number of jobs waiting in the queue"""
+        return self._jobs.qsize()
+
+    @property
+    def busy(self):
+        return self.current_job is not None
+
+    def _run(self):
+        while True:
+            _, _, job = self._jobs.get()
+            if job is None:
+                break
+            if job.key is not None:
+                with self._lock:
+                    del self._latest[job.key]  # Later submissions with this key create a new job
+            self._abort.clear()
+            self.current_job = job
+            try:
+                job.run()
+                if self.error_check is not None:
+                    job.instrument_errors = self._check_errors()
+            finally:
+                self.current_job = None
+            self._done.put(job)
+            if self.notify is not None:
+                try:
+                    self.notify()
+                except Exception:  # E.g. the Tk window is already destroyed, keep the worker alive
+                    logger.exception("Notification of the completed instrument job %s failed", job.name)
+
+    def _check_errors(self):
+        try:
+            return self.error_check() or []
+        except Exception:
+            logger.exception("Reading the instrument errors failed")
+            return []
+
+    def deliver_results(self):
+        """
+        Invoke the callbacks of the completed jobs. This must be called from the Tk thread.
+        """
+        while True:
+            try:
+                job = self._done.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if job.instrument_errors and self.error_handler is not None:
+                    self.error_handler(job.name, job.instrument_errors)
+                job.deliver()
+            except Exception:
+                logger.exception("Exception in the callback of instrument job %s", job.name)
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker thread after the queued jobs have been executed.
+        """
+        self._jobs.put((self.NORMAL + 1, next(self._seq), None))
+        self._thread.join(timeout)
+
+
+class CoalescingDispatcher(object):
+    """
+    Collapses bursts of model changes to the newest value per setting, before they are sent to the instrument.
+    The first change of a setting starts a timer, and when it expires only the latest value is submitted to the
+    worker. Changes which arrive while the write is still queued in the worker update the queued job instead.
+    Must be used from the Tk thread.
+    """
+    def __init__(self, tk_root, worker, window_ms=50):
+        """
+        :param tk.Tk tk_root:
+        :param InstrumentWorker worker:
+        :param int window_ms: The time to collect changes before writing to the instrument, 0 to write immediately
+        """
+        self.tk_root = tk_root
+        self.worker = worker
+        self.window_ms = window_ms
+        self.posted = 0
+        """The number of values posted"""
+        self.dropped = 0
+        """The number of values dropped while waiting for the window to expire"""
+
+        self._pending = {}
+        self._timers = {}
+
+    def post(self, key, func, value):
+        """
+        Schedule func(value) for execution in the worker. Earlier values posted with the same key, which haven't
+        been written yet, are dropped.
+        """
+        self.posted += 1
+        if key in self._pending:
+            self.dropped += 1
+        self._pending[key] = (func, value)
+        if not self.window_ms:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self.tk_root.after(int(self.window_ms), self._flush, key)
+
+    def _flush(self, key):
+        self._timers.pop(key, None)
+        func, value = self._pending.pop(key)
+        self.worker.submit_latest(key, func, value, name=func.__name__)
+
+    @property
+    def superseded(self):
+        """The total number of dropped instrument writes"""
+        return self.dropped + self.worker.superseded
@@ -0,0 +1,887 @@
+# -*- coding: utf-8 -*-
+"""
+A simulated ZVA, for testing and profiling without an instrument.
+
+SimulatedZVA implements the parts of the pyvisa resource interface used by RSSscpi, and interprets the subset
+of the ZVA SCPI command set used by ZVAIMController: channels, ARB frequency conversion, segmented sweeps,
+traces, the cal pool, the error queue and ASCII/binary trace data. The measured data is generated from a
+two-tone model of an amplifier, with a memory effect resonance in the IM3 response.
+
+The simulator can also be served on a TCP socket, see serve_tcp(), and accessed as a raw socket instrument.
+
+@author: Lukas Sandström
+"""
+
+import copy
+import inspect
+import logging
+import re
+import socketserver
+import threading
+import time
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def short_mnemonic(token):
+    """
+    Convert a SCPI mnemonic to its short form. Mixed case mnemonics, as used by RSSscpi, are reduced to the upper
+    case letters. All upper case long forms are shortened by the SCPI rule.
+    """
+    if any(c.islower() for c in token):
+        return "".join(c for c in token if c.isupper())
+    t = token.upper()
+    if len(t) > 4:
+        t = t[:3] if t[3] in "AEIOU" else t[:4]
+    return t
+
+
+def split_outside_quotes(s, sep):
+    ret = []
+    quote = None
+    start = 0
+    for i, c in enumerate(s):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == sep:
+            ret.append(s[start:i])
+            start = i + 1
+    ret.append(s[start:])
+    return ret
+
+
+def unquote(s):
+    s = s.strip()
+    if len(s) >= 2 and s[0] in "'\"" and s[0] == s[-1]:
+        return s[1:-1]
+    return s
+
+
+def to_bool(s):
+    return str(s).strip().upper() in ("1", "ON", "TRUE")
+
+
+class SimError(Exception):
+    def __init__(self, err_no, err_str):
+        super().__init__(err_no, err_str)
+        self.err_no = err_no
+        self.err_str = err_str
+
+
+class SimTrace(object):
+    def __init__(self, name, channel, param):
+        self.name = name
+        self.channel = channel
+        self.param = param
+        self.math = None
+        self.diagram = None
+
+
+class SimChannel(object):
+    def __init__(self, n):
+        self.n = n
+        self.name = "Ch%d" % n
+        self.start = 10e6
+        self.stop = 24e9
+        self.points = 201
+        self.sweep_type = "LIN"
+        self.ifbw = 10e3
+        self.selectivity = "NORM"
+        self.power = -10.0
+        self.trigger = "IMM"
+        self.arb = None  # (numerator, denominator, offset) of the receiver frequency conversion
+        self.sband = "POS"
+        self.conversion = "FUND"
+        self.awreceiver = True
+        self.src_arb = {}  # port: (numerator, denominator, offset)
+        self.perm_power = {}
+        self.power_offset = {}  # port: dB
+        self.segments = []  # [(start, stop, points, power, ifbw, LO sideband)]
+        self.segment_power = False
+        self.segment_ifbw = False
+        self.calgroup = ""
+        self.active_trace = None
+
+    def segment_stimulus(self):
+        if not self.segments:
+            return numpy.array([self.start])
+        return numpy.concatenate([numpy.linspace(s[0], s[1], int(s[2])) for s in self.segments])
+
+    def stimulus(self):
+        if self.sweep_type == "SEGM":
+            return self.segment_stimulus()
+        if self.points == 1:
+            return numpy.array([self.start])
+        return numpy.linspace(self.start, self.stop, int(self.points))
+
+    def point_ifbw(self):
+        if self.sweep_type == "SEGM" and self.segments and self.segment_ifbw:
+            return numpy.concatenate([numpy.full(int(s[2]), s[4]) for s in self.segments])
+        return numpy.full(len(self.stimulus()), self.ifbw)
+
+    def point_power(self):
+        if self.sweep_type == "SEGM" and self.segments and self.segment_power:
+            return numpy.concatenate([numpy.full(int(s[2]), s[3]) for s in self.segments])
+        return numpy.full(len(self.stimulus()), self.power)
+
+    def receiver_freq(self, stim):
+        if self.arb is None:
+            return stim
+        num, den, off = self.arb
+        return num / den * stim + off
+
+    def source_freq(self, port, stim):
+        if port in self.src_arb:
+            num, den, off = self.src_arb[port]
+            return num / den * stim + off
+        return self.receiver_freq(stim)
+
+
+class SimulatedZVA(object):
+    """
+    A stand-in for the pyvisa resource of a ZVA. Use connect_simulated() to get an RSSscpi ZVA instance.
+    """
+    idn = "Rohde-Schwarz,ZVA24-4Port,1145110054100000,3.60 (simulated)"
+    roots = {"SENS", "SOUR", "CALC", "CONF", "DISP", "INIT", "TRIG", "FORM", "MMEM", "SYST", "INST", "OUTP",
+             "HCOP", "STAT"}
+    optional_nodes = {"IMM", "LEV", "AMPL", "SEQ", "RES"}
+
+    def __init__(self, latency=0.0, time_scale=1.0, min_freq=10e6, max_freq=24e9, dut_out=2, src_ports=(1, 3),
+                 gain_db=10.0, oip3_dbm=30.0, noise_figure_db=15.0, calpool=("RSS_im_sweep.cal",), seed=0):
+        """
+        :param float latency: The round trip time added to each write and query, in seconds
+        :param float time_scale: The simulated sweep time is multiplied by this factor, 0 disables the sweep delay
+        :param float min_freq: The frequency range of the instrument
+        :param float max_freq:
+        :param int dut_out: The port connected to the DUT output
+        :param src_ports: The ports generating the lower and upper tones, when not set by ARB conversion
+        :param float gain_db: The DUT gain
+        :param float oip3_dbm: The DUT OIP3, away from the memory effect resonance
+        :param float noise_figure_db: The receiver noise figure
+        :param calpool: The names of the cal groups in the simulated cal pool
+        """
+        self.latency = latency
+        self.time_scale = time_scale
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.dut_out = dut_out
+        self.src_ports = src_ports
+        self.n_ports = 4
+        self.gain_db = gain_db
+        self.oip3_dbm = oip3_dbm
+        self.noise_figure_db = noise_figure_db
+        self.resonance = (12e6, 0.4e6, 8.0)  # Spacing, width and depth in dB of the IM3 memory effect resonance
+        self._rng = numpy.random.default_rng(seed)
+
+        # pyvisa resource attributes
+        self.resource_name = "SIM::ZVA::INSTR"
+        self.timeout = 2000
+        self.read_termination = "\n"
+        self.write_termination = "\n"
+
+        self.round_trips = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.unknown_headers = set()
+        """Headers not recognized by the simulator, which were handled by the generic value store"""
+
+        self._lock = threading.RLock()
+        self._output = b""
+        self._path = []
+        self.calpool = list(calpool)
+        self.state_files = {}
+        self._reset()
+
+    # -- pyvisa resource interface --
+
+    def write(self, message, termination=None, encoding=None):
+        self._roundtrip(len(message))
+        with self._lock:
+            self._execute(message.strip())
+        return len(message), 0
+
+    def read_raw(self, size=None):
+        with self._lock:
+            data = self._output
+            self._output = b""
+        self.bytes_read += len(data)
+        return data
+
+    def read(self, termination=None, encoding=None):
+        data = self.read_raw().decode("latin-1")
+        if self.read_termination and data.endswith(self.read_termination):
+            data = data[:-len(self.read_termination)]
+        return data
+
+    def query(self, message, delay=None):
+        self.write(message)
+        return self.read()
+
+    def read_stb(self):
+        self._roundtrip(0)
+        with self._lock:
+            return (4 if self.errors else 0) | (32 if self.errors else 0)
+
+    def install_handler(self, *args, **kwargs):
+        return None
+
+    def uninstall_handler(self, *args, **kwargs):
+        pass
+
+    def enable_event(self, *args, **kwargs):
+        pass
+
+    def disable_event(self, *args, **kwargs):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._output = b""
+
+    def close(self):
+        pass
+
+    def _roundtrip(self, n_bytes):
+        self.round_trips += 1
+        self.bytes_written += n_bytes
+        if self.latency:
+            time.sleep(self.latency)
+
+    # -- Instrument state --
+
+    def _reset(self):
+        self.channels = {1: SimChannel(1)}
+        self.traces = {"Trc1": SimTrace("Trc1", 1, "S21")}
+        self.diagrams = {1: True}
+        self.active_channel = 1
+        self.errors = []
+        self.values = {"SYST:LANG": "SCPI"}
+        self.data_format = "ASC"
+        self.byte_order = "SWAP"
+        self.continuous = True
+        self.rf_on = True
+        self._sweep_done_at = 0.0
+
+    def _channel(self, n, create=True):
+        n = 1 if n is None else n
+        if n not in self.channels:
+            if not create:
+                raise SimError(-114, "Header suffix out of range;channel %d doesn't exist" % n)
+            self.channels[n] = SimChannel(n)
+        return self.channels[n]
+
+    def push_error(self, err_no, err_str):
+        self.errors.append((err_no, err_str))
+
+    # -- Command parsing --
+
+    def _execute(self, message):
+        responses = []
+        self._path = []
+        for unit in split_outside_quotes(message, ";"):
+            unit = unit.strip()
+            if not unit:
+                continue
+            try:
+                r = self._execute_unit(unit)
+            except SimError as e:
+                self.push_error(e.err_no, e.err_str + ";" + unit)
+                r = None
+            except (ValueError, IndexError, KeyError) as e:
+                self.push_error(-224, "Illegal parameter value;%s (%s)" % (unit, e))
+                r = None
+            if r is not None:
+                responses.append(r)
+        if responses:
+            parts = [r if isinstance(r, bytes) else str(r).encode("latin-1") for r in responses]
+            self._output = b";".join(parts) + b"\n"
+
+    def _parse_header(self, header):
+        """
+        :return: The normalized header key, and the numeric suffix of each node, by node mnemonic
+        """
+        if header.startswith(":"):
+            tokens = header[1:].split(":")
+            path = []
+        else:
+            tokens = header.split(":")
+            path = list(self._path)
+        nodes = list(path)
+        for t in tokens:
+            m = re.match(r"^([A-Za-z_]+)(\d*)$", t)
+            if not m:
+                raise SimError(-113, "Undefined header")
+            nodes.append((short_mnemonic(m.group(1)), int(m.group(2)) if m.group(2) else None))
+        self._path = nodes[:-1]
+        nodes = [x for x in nodes if x[0] not in self.optional_nodes]
+        if nodes and nodes[0][0] not in self.roots:
+            nodes.insert(0, ("SENS", None))
+        nodes = [("BAND", n) if m == "BWID" else (m, n) for m, n in nodes]
+        key = ":".join(m for m, n in nodes)
+        if key in ("FORM:DATA", "OUTP:STAT", "INIT:ALL:STAT"):
+            key = key.rsplit(":", 1)[0]
+        return key, dict(nodes)
+
+    def _execute_unit(self, unit):
+        parts = unit.split(None, 1)
+        header = parts[0]
+        args = [unquote(a) for a in split_outside_quotes(parts[1], ",")] if len(parts) > 1 else []
+        query = header.endswith("?")
+        if query:
+            header = header[:-1]
+        if header.startswith("*"):
+            return self._common(header.upper(), query, args)
+        key, sfx = self._parse_header(header)
+        handler = self._handlers.get(key)
+        if handler is None:
+            return self._generic(key, sfx, query, args)
+        return handler(self, sfx, query, args)
+
+    def _generic(self, key, sfx, query, args):
+        if key.endswith(":CAT") and "CORR" in key:
+            return "'%s'" % ",".join(self.calpool)
+        self.unknown_headers.add(key)
+        store_key = key + str(sorted((k, v) for k, v in sfx.items() if v is not None))
+        if query:
+            return self.values.get(store_key, self.values.get(key, "0"))
+        self.values[store_key] = ",".join(args)
+        return None
+
+    def _common(self, header, query, args):
+        if header == "*IDN" and query:
+            return self.idn
+        if header == "*OPC" and query:
+            self._wait_sweep()
+            return "1"
+        if header == "*RST":
+            self._reset()
+        elif header == "*CLS":
+            self.errors = []
+        elif header in ("*ESR", "*STB") and query:
+            return str(self.read_stb())
+        elif header == "*WAI":
+            self._wait_sweep()
+        elif query:
+            return "0"
+        return None
+
+    # -- Sweep timing --
+
+    def sweep_time(self, ch):
+        """
+        The simulated sweep time of a channel, in seconds.
+        """
+        sel = 1.6 if ch.selectivity.upper().startswith("HIGH") else 1.0
+        settle = 20e-6 if ch.arb is None else 60e-6  # The ARB channels retune the LO for each point
+        return 5e-3 + float(numpy.sum(sel / ch.point_ifbw() + settle))
+
+    def _start_sweep(self, channels):
+        t = sum(self.sweep_time(self.channels[n]) for n in channels if n in self.channels)
+        self._sweep_done_at = time.monotonic() + t * self.time_scale
+
+    def _wait_sweep(self):
+        remaining = self._sweep_done_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    # -- Frequency validation --
+
+    def _check_freq(self, ch):
+        stim = ch.stimulus()
+        freqs = [ch.receiver_freq(stim)] + [ch.source_freq(p, stim) for p in ch.src_arb]
+        for f in freqs:
+            if numpy.min(f) < self.min_freq or numpy.max(f) > self.max_freq:
+                return False
+        return True
+
+    def _set_freq(self, ch, attr, value):
+        old = getattr(ch, attr), ch.start, ch.stop
+        setattr(ch, attr, value)
+        if ch.start > ch.stop:  # Like the ZVA, move the other end of the sweep
+            if attr == "start":
+                ch.stop = ch.start
+            else:
+                ch.start = ch.stop
+        if not self._check_freq(ch):
+            setattr(ch, attr, old[0])
+            ch.start, ch.stop = old[1], old[2]
+            raise SimError(-222, "Data out of range;frequency out of range")
+
+    # -- Handlers --
+
+    def _h_conf_chan_stat(self, sfx, query, args):
+        n = sfx.get("CHAN") or 1
+        if query:
+            return "1" if n in self.channels else "0"
+        if to_bool(args[0]):
+            self._channel(n)
+        elif n in self.channels:
+            del self.channels[n]
+            for name in [k for k, t in self.traces.items() if t.channel == n]:
+                del self.traces[name]
+
+    def _h_conf_chan_name(self, sfx, query, args):
+        ch = self._channel(sfx.get("CHAN"), create=False)
+        if query:
+            return "'%s'" % ch.name
+        ch.name = args[0]
+
+    def _h_conf_chan_cat(self, sfx, query, args):
+        return "'%s'" % ",".join("%d,%s" % (n, c.name) for n, c in sorted(self.channels.items()))
+
+    def _h_conf_trac_cat(self, sfx, query, args):
+        return "'%s'" % ",".join("%d,%s" % (i + 1, name) for i, name in enumerate(self.traces))
+
+    def _h_inst_nsel(self, sfx, query, args):
+        if query:
+            return str(self.active_channel)
+        self.active_channel = int(float(args[0]))
+        self._channel(self.active_channel)
+
+    def _freq_handler(attr):
+        def handler(self, sfx, query, args):
+            ch = self._channel(sfx.get("SENS"))
+            if query:
+                return repr(float(getattr(ch, attr)))
+            self._set_freq(ch, attr, float(args[0]))
+        return handler
+
+    def _h_sens_freq_conv_arb(self, sfx, query, args):
+        ch = self._channel(sfx.get("SENS"))
+        if query:
+            num, den, off = ch.arb or (1, 1, 0)
+            return "%d,%d,%r,SWE" % (num, den, float(off))
+        old = ch.arb
+        ch.arb = (int(float(args[0])), int(float(args[1])), float(args[2]))
+        if not self._check_freq(ch):
+            ch.arb = old
+            raise SimError(-222, "Data out of range;frequency out of range")
+
+    def _h_sens_freq_conv(self, sfx, query, args):
+        ch = self._channel(sfx.get("SENS"))
+        if query:
+            return ch.conversion
+        ch.conversion = args[0].upper()[:4]
+        if ch.conversion == "FUND":
+            ch.arb = None
+            ch.src_arb = {}
+            ch.start = min(max(ch.start, self.min_freq), self.max_freq)  # Clamp the sweep to the instrument range
+            ch.stop = min(max(ch.stop, ch.start), self.max_freq)
+
+    def _h_sour_freq_conv_arb_ifr(self, sfx, query, args):
+        ch = self._channel(sfx.get("SOUR"))
+        port = sfx.get("FREQ") or 1
+        if query:
+            num, den, off = ch.src_arb.get(port, (1, 1, 0))
+            return "%d,%d,%r,SWE" % (num, den, float(off))
+        old = ch.src_arb.get(port)
+        ch.src_arb[port] = (int(float(args[0])), int(float(args[1])), float(args[2]))
+        if not self._check_freq(ch):
+            if old is None:
+                del ch.src_arb[port]
+            else:
+                ch.src_arb[port] = old
+            raise SimError(-222, "Data out of range;source frequency out of range")
+
+    def _attr_handler(node, attr, conv=str, fmt=str):
+        def handler(self, sfx, query, args):
+            ch = self._channel(sfx.get(node))
+            if query:
+                return fmt(getattr(ch, attr))
+            setattr(ch, attr, conv(args[0]))
+        return handler
+
+    def _h_sour_pow(self, sfx, query, args):
+        ch = self._channel(sfx.get("SOUR"))
+        if query:
+            return repr(float(ch.power))
+        ch.power = float(args[0])
+
+    def _h_sour_pow_offs(self, sfx, query, args):
+        ch = self._channel(sfx.get("SOUR"))
+        port = sfx.get("POW") or 1
+        if query:
+            return "%r,CPAD" % ch.power_offset.get(port, 0.0)
+        ch.power_offset[port] = float(args[0])
+
+    def _h_sour_pow_perm_stat(self, sfx, query, args):
+        ch = self._channel(sfx.get("SOUR"))
+        port = sfx.get("POW") or 1
+        if query:
+            return "1" if ch.perm_power.get(port) else "0"
+        ch.perm_power[port] = to_bool(args[0])
+
+    def _h_sens_swe_time(self, sfx, query, args):
+        return repr(self.sweep_time(self._channel(sfx.get("SENS"), create=False)))
+
+    def _h_sens_segm_ins(self, sfx, query, args):
+        # <start>, <stop>, <points>, <power>, <time>, <unused>, <ifbw>, <LO sideband>
+        ch = self._channel(sfx.get("SENS"))
+        seg = sfx.get("SEGM") or len(ch.segments) + 1
+        power = float(args[3]) if len(args) > 3 else ch.power
+        ifbw = float(args[6]) if len(args) > 6 else ch.ifbw
+        sband = args[7].upper()[:3] if len(args) > 7 else ch.sband
+        ch.segments.insert(seg - 1, (float(args[0]), float(args[1]), int(float(args[2])), power, ifbw, sband))
+
+    def _h_sens_segm_add(self, sfx, query, args):
+        self._channel(sfx.get("SENS")).segments.append((1e9, 1e9, 1, -10.0, 10e3, "POS"))
+
+    def _h_sens_segm_del_all(self, sfx, query, args):
+        self._channel(sfx.get("SENS")).segments = []
+
+    def _h_sens_segm_coun(self, sfx, query, args):
+        return str(len(self._channel(sfx.get("SENS")).segments))
+
+    def _h_sens_segm_pow_cont(self, sfx, query, args):
+        ch = self._channel(sfx.get("SENS"))
+        if query:
+            return "1" if ch.segment_power else "0"
+        ch.segment_power = to_bool(args[0])
+
+    def _h_sens_segm_band_cont(self, sfx, query, args):
+        ch = self._channel(sfx.get("SENS"))
+        if query:
+            return "1" if ch.segment_ifbw else "0"
+        ch.segment_ifbw = to_bool(args[0])
+
+    def _h_calc_par_sdef(self, sfx, query, args):
+        n = sfx.get("CALC") or 1
+        self._channel(n)
+        name = args[0]
+        if name in self.traces:
+            raise SimError(-221, "Settings conflict;trace %s already exists" % name)
+        self.traces[name] = SimTrace(name, n, args[1] if len(args) > 1 else "S21")
+        self._channel(n).active_trace = name
+
+    def _h_calc_par_del(self, sfx, query, args):
+        if args[0] not in self.traces:
+            raise SimError(-222, "Data out of range;no trace %s" % args[0])
+        del self.traces[args[0]]
+
+    def _h_calc_par_del_all(self, sfx, query, args):
+        self.traces = {}
+
+    def _h_calc_par_sel(self, sfx, query, args):
+        ch = self._channel(sfx.get("CALC"))
+        if query:
+            return "'%s'" % ch.active_trace
+        if args[0] not in self.traces:
+            raise SimError(-222, "Data out of range;no trace %s" % args[0])
+        ch.active_trace = args[0]
+
+    def _h_calc_math_sdef(self, sfx, query, args):
+        ch = self._channel(sfx.get("CALC"))
+        tr = self.traces[ch.active_trace]
+        if query:
+            return "'%s'" % (tr.math or "")
+        tr.math = args[0]
+
+    def _h_init_cont(self, sfx, query, args):
+        if query:
+            return "1" if self.continuous else "0"
+        self.continuous = to_bool(args[0])
+
+    def _h_init(self, sfx, query, args):
+        n = sfx.get("INIT")
+        self._start_sweep([n] if n else [self.active_channel])
+
+    def _h_init_all(self, sfx, query, args):
+        self._start_sweep(list(self.channels))
+
+    def _h_form(self, sfx, query, args):
+        if query:
+            return self.data_format
+        fmt = ",".join(a.strip().upper() for a in args)
+        if fmt.startswith("ASC"):
+            self.data_format = "ASC"
+        elif fmt in ("REAL,32", "REAL,64"):
+            self.data_format = fmt
+        else:
+            raise SimError(-224, "Illegal parameter value")
+
+    def _h_form_bord(self, sfx, query, args):
+        if query:
+            return self.byte_order
+        self.byte_order = args[0].upper()[:4]
+
+    def _h_calc_data_trac(self, sfx, query, args):
+        if args[0] not in self.traces:
+            raise SimError(-222, "Data out of range;no trace %s" % args[0])
+        return self._format_data(self.trace_data(args[0]), complex_=True)
+
+    def _h_calc_data_dall(self, sfx, query, args):
+        data = [self.trace_data(name) for name in self.traces]
+        return self._format_data(numpy.concatenate(data) if data else numpy.zeros(0, complex), complex_=True)
+
+    def _h_calc_data_stim(self, sfx, query, args):
+        return self._format_data(self._channel(sfx.get("CALC"), create=False).stimulus())
+
+    def _h_mmem_load_corr(self, sfx, query, args):
+        if query:
+            return "'%s'" % self._channel(int(float(args[0])), create=False).calgroup
+        name = args[-1]
+        if name not in self.calpool:
+            raise SimError(-256, "File name not found;%s" % name)
+        channels = [int(float(args[0]))] if len(args) > 1 else list(self.channels)
+        for n in channels:
+            self._channel(n, create=False).calgroup = name
+
+    def _h_mmem_stor_corr(self, sfx, query, args):
+        name = args[-1]
+        if name not in self.calpool:
+            self.calpool.append(name)
+
+    _state_attrs = ("channels", "traces", "diagrams", "active_channel", "continuous")
+
+    def _h_mmem_stor_stat(self, sfx, query, args):
+        self.state_files[args[-1]] = copy.deepcopy({k: getattr(self, k) for k in self._state_attrs})
+
+    def _h_mmem_load_stat(self, sfx, query, args):
+        if args[-1] not in self.state_files:
+            raise SimError(-256, "File name not found;%s" % args[-1])
+        for k, v in copy.deepcopy(self.state_files[args[-1]]).items():
+            setattr(self, k, v)
+
+    def _h_syst_err_all(self, sfx, query, args):
+        errors = self.errors or [(0, "No error")]
+        self.errors = []
+        return ",".join('%d,"%s"' % e for e in errors)
+
+    def _h_syst_err(self, sfx, query, args):
+        if not self.errors:
+            return '0,"No error"'
+        return '%d,"%s"' % self.errors.pop(0)
+
+    def _h_syst_freq(self, sfx, query, args):
+        return repr(self.min_freq if args and args[0].upper().startswith("MIN") else self.max_freq)
+
+    def _h_inst_port_coun(self, sfx, query, args):
+        return str(self.n_ports)
+
+    def _h_outp(self, sfx, query, args):
+        if query:
+            return "1" if self.rf_on else "0"
+        self.rf_on = to_bool(args[0])
+
+    def _h_disp_wind_stat(self, sfx, query, args):
+        n = sfx.get("WIND") or 1
+        if query:
+            return "1" if self.diagrams.get(n) else "0"
+        self.diagrams[n] = to_bool(args[0])
+
+    def _h_disp_wind_trac_efe(self, sfx, query, args):
+        if args[0] not in self.traces:
+            raise SimError(-222, "Data out of range;no trace %s" % args[0])
+        self.traces[args[0]].diagram = sfx.get("WIND") or 1
+
+    _handlers = {
+        "CONF:CHAN:STAT": _h_conf_chan_stat,
+        "CONF:CHAN:NAME": _h_conf_chan_name,
+        "CONF:CHAN:CAT": _h_conf_chan_cat,
+        "CONF:TRAC:CAT": _h_conf_trac_cat,
+        "INST:NSEL": _h_inst_nsel,
+        "INST:PORT:COUN": _h_inst_port_coun,
+        "SENS:FREQ:STAR": _freq_handler("start"),
+        "SENS:FREQ:STOP": _freq_handler("stop"),
+        "SENS:FREQ:CONV:ARB": _h_sens_freq_conv_arb,
+        "SENS:FREQ:CONV": _h_sens_freq_conv,
+        "SENS:FREQ:CONV:AWR:STAT": _attr_handler("SENS", "awreceiver", to_bool, lambda x: "1" if x else "0"),
+        "SENS:FREQ:SBAN": _attr_handler("SENS", "sband", lambda x: x.upper()[:3]),
+        "SENS:SWE:POIN": _attr_handler("SENS", "points", lambda x: int(float(x))),
+        "SENS:SWE:TYPE": _attr_handler("SENS", "sweep_type", lambda x: x.upper()[:4]),
+        "SENS:SWE:TIME": _h_sens_swe_time,
+        "SENS:BAND": _attr_handler("SENS", "ifbw", float, lambda x: repr(float(x))),
+        "SENS:BAND:SEL": _attr_handler("SENS", "selectivity", lambda x: x.upper()[:4]),
+        "SENS:SEGM:INS": _h_sens_segm_ins,
+        "SENS:SEGM:ADD": _h_sens_segm_add,
+        "SENS:SEGM:DEL:ALL": _h_sens_segm_del_all,
+        "SENS:SEGM:CLE": _h_sens_segm_del_all,
+        "SENS:SEGM:COUN": _h_sens_segm_coun,
+        "SENS:SEGM:POW:CONT": _h_sens_segm_pow_cont,
+        "SENS:SEGM:BAND:CONT": _h_sens_segm_band_cont,
+        "SOUR:POW": _h_sour_pow,
+        "SOUR:POW:OFFS": _h_sour_pow_offs,
+        "SOUR:POW:PERM:STAT": _h_sour_pow_perm_stat,
+        "SOUR:FREQ:CONV:ARB:IFR": _h_sour_freq_conv_arb_ifr,
+        "TRIG:SOUR": _attr_handler("TRIG", "trigger", lambda x: x.upper()[:4]),
+        "CALC:PAR:SDEF": _h_calc_par_sdef,
+        "CALC:PAR:DEL": _h_calc_par_del,
+        "CALC:PAR:DEL:ALL": _h_calc_par_del_all,
+        "CALC:PAR:SEL": _h_calc_par_sel,
+        "CALC:MATH:SDEF": _h_calc_math_sdef,
+        "CALC:DATA:TRAC": _h_calc_data_trac,
+        "CALC:DATA:DALL": _h_calc_data_dall,
+        "CALC:DATA:STIM": _h_calc_data_stim,
+        "INIT:CONT": _h_init_cont,
+        "INIT": _h_init,
+        "INIT:ALL": _h_init_all,
+        "FORM": _h_form,
+        "FORM:BORD": _h_form_bord,
+        "MMEM:LOAD:CORR": _h_mmem_load_corr,
+        "MMEM:STOR:CORR": _h_mmem_stor_corr,
+        "MMEM:STOR:STAT": _h_mmem_stor_stat,
+        "MMEM:LOAD:STAT": _h_mmem_load_stat,
+        "SYST:ERR:ALL": _h_syst_err_all,
+        "SYST:ERR": _h_syst_err,
+        "SYST:FREQ": _h_syst_freq,
+        "OUTP": _h_outp,
+        "DISP:WIND:STAT": _h_disp_wind_stat,
+        "DISP:WIND:TRAC:EFE": _h_disp_wind_trac_efe,
+    }
+
+    # -- Measurement data --
+
+    def _format_data(self, data, complex_=False):
+        if complex_:
+            data = numpy.column_stack([data.real, data.imag]).ravel()
+        if self.data_format == "ASC":
+            return ",".join("%.9g" % x for x in data)
+        dtype = ">" if self.byte_order == "NORM" else "<"
+        dtype += "f4" if self.data_format == "REAL,32" else "f8"
+        raw = data.astype(dtype).tobytes()
+        length = str(len(raw)).encode()
+        return b"#" + str(len(length)).encode() + length + raw
+
+    def oip3(self, spacing):
+        """
+        The OIP3 of the simulated DUT, lower and upper, as a function of the tone spacing.
+        """
+        f0, width, depth = self.resonance
+        dip = depth * numpy.exp(-((spacing - f0) / width) ** 2)
+        return self.oip3_dbm - dip, self.oip3_dbm - 0.5 * dip
+
+    def _wave(self, p_dbm, freq):
+        return numpy.sqrt(10 ** ((p_dbm - 30) / 10)) * numpy.exp(-2j * numpy.pi * freq * 1e-9)
+
+    def _tones(self, ch, stim):
+        """
+        The frequencies and input powers of the lower and upper tones, and the ports generating them.
+        """
+        power = ch.point_power()
+        ports = [p for p, arb in sorted(ch.src_arb.items()) if arb[0] != 0]
+        if len(ports) >= 2:
+            f = [ch.source_freq(p, stim) for p in ports[:2]]
+        else:
+            ports = list(self.src_ports)
+            cf = ch.arb[2] if ch.arb is not None else 1e9
+            f = [cf - stim / 2, cf + stim / 2]
+        p = [power + ch.power_offset.get(port, 0.0) for port in ports[:2]]
+        swap = f[0] > f[1]
+        f_l = numpy.where(swap, f[1], f[0])
+        f_u = numpy.where(swap, f[0], f[1])
+        p_l = numpy.where(swap, p[1], p[0])
+        p_u = numpy.where(swap, p[0], p[1])
+        return (f_l, p_l, ports[0]), (f_u, p_u, ports[1]), swap
+
+    def trace_data(self, name):
+        tr = self.traces[name]
+        ch = self.channels[tr.channel]
+        if tr.math:
+            m = re.match(r"^\s*(\w+)\s*/\s*(\w+)\s*$", tr.math)
+            if m and m.group(1) in self.traces and m.group(2) in self.traces:
+                return self.trace_data(m.group(1)) / self.trace_data(m.group(2))
+        stim = ch.stimulus()
+        noise_dbm = -174 + self.noise_figure_db + 10 * numpy.log10(ch.point_ifbw())
+        sigma = numpy.sqrt(10 ** ((noise_dbm - 30) / 10) / 2)
+        n = len(stim)
+        data = sigma * (self._rng.standard_normal(n) + 1j * self._rng.standard_normal(n))
+        if not self.rf_on:
+            return data
+
+        (f_l, p_l, port_l), (f_u, p_u, port_u), swap = self._tones(ch, stim)
+        m = re.search(r"([AaBb])(\d)", tr.param)
+        kind, port = (m.group(1).upper(), int(m.group(2))) if m else ("B", self.dut_out)
+        if kind == "A":
+            if port == port_l:
+                data += self._wave(numpy.where(swap, p_u, p_l), ch.source_freq(port, stim))
+            elif port == port_u:
+                data += self._wave(numpy.where(swap, p_l, p_u), ch.source_freq(port, stim))
+            return data
+        if port != self.dut_out:
+            return data
+
+        f_rx = ch.receiver_freq(stim)
+        spacing = f_u - f_l
+        o_l = p_l + self.gain_db
+        o_u = p_u + self.gain_db
+        oip3_l, oip3_u = self.oip3(spacing)
+        products = ((f_l, o_l), (f_u, o_u),
+                    (2 * f_l - f_u, 2 * o_l + o_u - 2 * oip3_l),
+                    (2 * f_u - f_l, 2 * o_u + o_l - 2 * oip3_u))
+        for f, p in products:
+            hit = numpy.abs(f_rx - f) < 1.0
+            data = numpy.where(hit, data + self._wave(p, f_rx), data)
+        return data
+
+
+def connect_simulated(**kwargs):
+    """
+    Create an RSSscpi ZVA instance connected to a simulated instrument.
+    The keyword arguments are passed to SimulatedZVA.
+
+    :rtype: RSSscpi.zva.ZVA
+    """
+    import RSSscpi.zva
+    zva = RSSscpi.zva.ZVA(SimulatedZVA(**kwargs))
+    zva.init()
+    return zva
+
+
+def parse_sim_address(address):
+    """
+    Parse a simulator address, "sim" or "sim:latency=0.002,time_scale=0", into SimulatedZVA keyword arguments.
+
+    :return: The keyword arguments, or None if the address isn't a simulator address
+    :rtype: dict
+    :raises ValueError: If an option isn't a numeric SimulatedZVA argument
+    """
+    name, _, opts = address.partition(":")
+    if name.strip().lower() != "sim":
+        return None
+    params = inspect.signature(SimulatedZVA).parameters
+    kwargs = {}
+    for opt in filter(None, opts.split(",")):
+        k, _, v = opt.partition("=")
+        k = k.strip()
+        if k not in params or not isinstance(params[k].default, (int, float)):
+            raise ValueError("Unknown simulator option '%s'" % k)
+        try:
+            kwargs[k] = type(params[k].default)(float(v))  # e.g. dut_out and seed are int
+        except ValueError:
+            raise ValueError("Invalid value '%s' of simulator option '%s'" % (v.strip(), k)) from None
+    return kwargs
+
+
+class _SCPIHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        sim = self.server.sim
+        for line in self.rfile:
+            line = line.decode("latin-1").strip()
+            if not line:
+                continue
+            sim.write(line)
+            out = sim.read_raw()
+            if out:
+                self.wfile.write(out)
+
+
+def serve_tcp(port=5025, host="127.0.0.1", **kwargs):
+    """
+    Serve a simulated ZVA on a TCP socket, e.g. for access with the VISA resource TCPIP::127.0.0.1::5025::SOCKET.
+    Blocks until interrupted.
+    """
+    server = socketserver.ThreadingTCPServer((host, port), _SCPIHandler)
+    server.sim = SimulatedZVA(**kwargs)
+    logger.info("Serving a simulated ZVA on %s:%d", host, port)
+    with server:
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve_tcp()
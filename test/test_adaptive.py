@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+from rss_im_sweep.adaptive import allocate_points, merge_traces, refinement_regions, refinement_scores
+from rss_im_sweep.freq_plan import FrequencyPlan
+from rss_im_sweep.readout import TraceData
+from rss_im_sweep.segmented import unfold_segments
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+def test_refinement():
+    spacing = numpy.linspace(1e6, 30e6, 59)
+    dip = 8 * numpy.exp(-((spacing - 12e6) / 0.8e6) ** 2)
+    scores = refinement_scores(-40 + dip, -40 + 0.5 * dip)
+    regions = refinement_regions(spacing, scores)
+    assert len(regions) == 1
+    start, stop = regions[0]
+    assert start < 12e6 < stop
+    assert stop - start < 5e6
+    assert refinement_regions(spacing, numpy.zeros(59)) == []
+
+    ranges = allocate_points(regions + [(20e6, 20.5e6)], 100)
+    assert ranges[0][2] > ranges[1][2] >= 3
+
+    coarse = TraceData({"IM3L_O": numpy.zeros(59)}, spacing=spacing)
+    fine = numpy.linspace(start, stop, ranges[0][2])
+    ret = merge_traces(coarse, TraceData({"IM3L_O": numpy.ones(len(fine))}, spacing=fine))
+    assert numpy.all(numpy.diff(ret.spacing) > 0)
+    assert len(ret.spacing) == 59 + len(fine) - numpy.isin(fine, spacing).sum()
+    assert numpy.all(ret["IM3L_O"][(ret.spacing >= start) & (ret.spacing <= stop)] == 1)
+
+
+def test_refined_segments_sim():
+    plan = FrequencyPlan(1e9, 1e6, 30e6, 30)
+    ranges = ((5e6, 8e6, 7), (11e6, 14e6, 13))
+    sim = SimulatedZVA(time_scale=0)
+    for n, name in ((1, "TONE"), (2, "IM3")):
+        state = plan.refined(ranges)[name]
+        sim.write(":CONF:CHAN%d:STAT ON" % n)
+        for i, (start, stop, points) in enumerate(state.segments):
+            sim.write(":SENS%d:SEGM%d:INS %r, %r, %d, -10, AUTO, 0, 1000" % (n, i + 1, start, stop, points))
+        sim.write(":SENS%d:SWE:TYPE SEGM;:SENS%d:FREQ:CONV:ARB 1, 1, 0, SWE" % (n, n))
+        for port, arb in state.src_arb:
+            sim.write(":SOUR%d:FREQ%d:CONV:ARB:IFR %d, %d, %r, SWE" % ((n, port) + arb))
+    sim.write(":CALC1:PAR:SDEF 'TONE_A_TL', 'A1';:CALC1:PAR:SDEF 'TONE_A_TU', 'A3';:CALC1:PAR:SDEF 'TONE_B', 'B2'")
+    sim.write(":CALC2:PAR:SDEF 'IM3_B', 'B2'")
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
+
+    data = TraceData(((name, sim.trace_data(name)) for name in ("TONE_A_TL", "TONE_A_TU", "TONE_B", "IM3_B")),
+                     spacing=sim.channels[1].stimulus())
+    ret = unfold_segments(data, 20)
+    expected = numpy.concatenate([numpy.linspace(*r) for r in ranges])
+    assert numpy.allclose(ret.spacing, expected)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+from rss_im_sweep.analysis import analyse_traces, im3_analysis, power_dbm, stack_traces
+
+
+def wave(dbm, n=11):
+    return numpy.full(n, numpy.sqrt(10 ** ((dbm - 30) / 10)), dtype=complex)
+
+
+def test_power_dbm():
+    assert numpy.allclose(power_dbm(wave(-10)), -10)
+
+
+def test_equal_tones():
+    # 10 dB gain, -10 dBm output tones, IM3 at -50 dBm -> OIP3 = -10 + 40/2 = 10 dBm
+    r = im3_analysis(wave(-20), wave(-20), wave(-10), wave(-10), wave(-50), wave(-50))
+    assert numpy.allclose(r.im3l_dbc, -40)
+    assert numpy.allclose(r.oip3_l, 10)
+    assert numpy.allclose(r.oip3_u, 10)
+    assert numpy.allclose(r.iip3_l, 0)
+    assert numpy.allclose(r.asymmetry, 0)
+    assert numpy.allclose(r.tone_imbalance_o, 0)
+
+
+def test_unequal_tones_and_stacks():
+    # P_IM3L = 2 P_L + P_U - 2 OIP3, with OIP3 = 20 dBm
+    sweeps = []
+    for p_l, p_u in ((-10, -12), (-5, -6)):
+        sweeps.append({"TL_I": wave(p_l - 10), "TU_I": wave(p_u - 10), "TL_O": wave(p_l), "TU_O": wave(p_u),
+                       "IM3L_O": wave(2 * p_l + p_u - 40), "IM3U_O": wave(2 * p_u + p_l - 40)})
+    r = analyse_traces(stack_traces(sweeps))
+    assert r.oip3_l.shape == (2, 11)
+    assert numpy.allclose(r.oip3_l, 20)
+    assert numpy.allclose(r.oip3_u, 20)
+    assert numpy.allclose(r.tone_imbalance_o[0], -2)
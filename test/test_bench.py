@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+from rss_im_sweep.bench import find_regressions
+
+
+def test_find_regressions():
+    baseline = {"a": {"time": 0.1, "round_trips": 5, "bytes": 100},
+                "b": {"time": 0.1, "round_trips": 5, "bytes": 100}}
+    results = {"a": {"time": 0.12, "round_trips": 5, "bytes": 100},
+               "b": {"time": 0.2, "round_trips": 6, "bytes": 100},
+               "c": {"time": 1.0, "round_trips": 50, "bytes": 1000}}
+    r = find_regressions(results, baseline)
+    assert len(r) == 2
+    assert all(x.startswith("b: ") for x in r)
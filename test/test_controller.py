@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of ZVAIMController against the simulated ZVA.
+
+@author: Lukas Sandström
+"""
+
+import re
+
+import pytest
+
+pytest.importorskip("RSSscpi.zva")
+
+from rss_im_sweep import main
+from rss_im_sweep.analysis import power_dbm
+from rss_im_sweep.visa_log import VisaLog
+from rss_im_sweep.zva_sim import short_mnemonic
+
+
+@pytest.fixture
+def ctrl(monkeypatch):
+    monkeypatch.setattr(main, "VisaLog", lambda logger, filename=None: VisaLog(logger))  # No log file
+    model = main.Model()
+    model.zva_adress.set("sim:time_scale=0")
+    ctrl = main.ZVAIMController(model)
+    ctrl.connect_vna()
+    yield ctrl
+    ctrl.visa_log.close()
+
+
+def simulator(ctrl):
+    """
+    :rtype: rss_im_sweep.zva_sim.SimulatedZVA
+    """
+    return ctrl.zva._visa_res._resource  # Inside the InstrumentedResource
+
+
+def header_key(unit):
+    """
+    The short form header of a program message unit, without the numeric suffixes, e.g. "SENS:SWE:POIN" or
+    "MMEM:LOAD:CORR?"
+    """
+    header = unit.split(None, 1)[0]
+    query = "?" if header.endswith("?") else ""
+    return ":".join(short_mnemonic(re.sub(r"\d+$", "", t)) for t in header.rstrip("?").lstrip(":").split(":")) + query
+
+
+def record_writes(ctrl):
+    """
+    Record the commands received by the simulator, except queries and common commands.
+
+    :return: The list the headers are appended to, see header_key()
+    :rtype: list
+    """
+    sim = simulator(ctrl)
+    writes = []
+    execute = sim._execute_unit
+
+    def execute_unit(unit):
+        key = header_key(unit)
+        if not key.endswith("?") and not key.startswith("*"):
+            writes.append(key)
+        return execute(unit)
+    sim._execute_unit = execute_unit
+    return writes
+
+
+def test_configure_sweep_writes_only_changed_settings(ctrl):
+    ctrl.configure_sweep()
+    writes = record_writes(ctrl)
+    assert ctrl.configure_sweep().commands == 0
+    assert writes == []
+
+    ctrl.model.sweep_points.set(51)
+    ctrl.configure_sweep()
+    assert writes == ["SENS:SWE:POIN"] * 4
+    sim = simulator(ctrl)
+    assert all(sim.channels[ctrl.ch[name].n].points == 51 for name in ctrl.channel_names())
+
+
+def test_configure_sweep_rebuilds_when_topology_changes(ctrl):
+    ctrl.configure_sweep()
+    writes = record_writes(ctrl)
+    ctrl.model.src_tu.set(4)
+    ctrl.configure_sweep()
+    assert "CALC:PAR:DEL:ALL" in writes and "CALC:PAR:SDEF" in writes
+    assert ctrl._applied_topology == ctrl._topology()
+
+    del writes[:]
+    ctrl.model.ch_im3u.set(6)
+    ctrl.configure_sweep()
+    assert "CALC:PAR:DEL:ALL" in writes
+    assert simulator(ctrl).traces["IM3U_O"].channel == 6
+
+
+def test_failed_configure_sweep_forces_rebuild(ctrl):
+    ctrl.configure_sweep()
+
+    def fail(ch, field, value):
+        raise RuntimeError("VISA timeout")
+    ctrl._write_setting = fail
+    ctrl.model.sweep_points.set(51)
+    with pytest.raises(RuntimeError):
+        ctrl.configure_sweep()
+    assert ctrl._applied_topology is None
+
+    del ctrl._write_setting
+    writes = record_writes(ctrl)
+    ctrl.configure_sweep()
+    assert "CALC:PAR:DEL:ALL" in writes
+    assert ctrl._applied_topology == ctrl._topology()
+
+
+def test_apply_calibration(ctrl):
+    ctrl.switch_mode("cal")
+    sim = simulator(ctrl)
+    names = ctrl.channel_names() + ["cal"]
+    assert ctrl.apply_calibration() == dict.fromkeys(names, True)
+    assert all(sim.channels[ctrl.ch[name].n].calgroup == "RSS_im_sweep.cal" for name in names)
+
+
+def test_apply_calibration_reads_back_the_loaded_cal_group(ctrl):
+    ctrl.configure_sweep()
+    sim = simulator(ctrl)
+    sim.calpool.append("new.cal")
+    ctrl.model.calgroup.set("new.cal")
+    ctrl.calpool(refresh=True)
+    im3u = ctrl.ch["IM3U"].n
+    execute = sim._execute_unit
+
+    def execute_unit(unit):  # The cal group isn't loaded into the IM3U channel
+        if header_key(unit) == "MMEM:LOAD:CORR" and re.match(r"\s*%d\s*,", unit.split(None, 1)[1]):
+            return None
+        return execute(unit)
+    sim._execute_unit = execute_unit
+
+    round_trips = sim.round_trips
+    assert ctrl.apply_calibration() == {"TL": True, "TU": True, "IM3L": True, "IM3U": False}
+    assert sim.round_trips - round_trips == 2
+    assert sim.channels[im3u].calgroup == ""
+    assert ctrl._applied["TL"]["calgroup"] == "new.cal"
+    assert ctrl.configure_sweep().commands == 0  # The readback updated the applied settings
+
+    ctrl.model.calgroup.set("missing.cal")
+    assert ctrl.apply_calibration() == dict.fromkeys(ctrl.channel_names(), False)
+
+
+def test_switch_mode_recalls_stored_setups(ctrl):
+    sim = simulator(ctrl)
+    ctrl.switch_mode("im")
+    ctrl.switch_mode("cal")
+    assert (ctrl.setups.stores, ctrl.setups.recalls) == (2, 0)
+    assert len(sim.state_files) == 2
+
+    writes = record_writes(ctrl)
+    ctrl.switch_mode("im")
+    assert writes == ["MMEM:LOAD:STAT"]
+    assert ctrl.mode == "im" and not ctrl._cal_channel_on
+    assert ctrl.ch["cal"].n not in sim.channels
+    assert ctrl.configure_sweep().commands == 0  # The applied settings are recalled with the setup
+
+    del writes[:]
+    ctrl.switch_mode("cal")
+    assert writes == ["MMEM:LOAD:STAT"]
+    assert ctrl.mode == "cal" and ctrl._cal_channel_on
+    assert ctrl.setups.recalls == 2
+
+
+def test_switch_mode_rebuilds_when_the_setup_changes(ctrl):
+    sim = simulator(ctrl)
+    ctrl.switch_mode("im")
+    ctrl.switch_mode("cal")
+    writes = record_writes(ctrl)
+
+    ctrl.model.if_bandwidth.set(2e3)  # A new setup key, the stored setups don't match
+    ctrl.switch_mode("im")
+    assert "CALC:PAR:DEL:ALL" in writes and "MMEM:STOR:STAT" in writes
+    assert "MMEM:LOAD:STAT" not in writes
+    assert (ctrl.setups.stores, ctrl.setups.recalls) == (3, 0)
+    assert sim.channels[ctrl.ch["IM3U"].n].ifbw == 2e3
+
+    ctrl.switch_mode("cal")
+    sim.state_files.clear()  # The recall fails, e.g. the file was deleted on the instrument
+    del writes[:]
+    ctrl.switch_mode("im")
+    assert writes[0] == "MMEM:LOAD:STAT"
+    assert "CALC:PAR:DEL:ALL" in writes
+    assert ctrl.mode == "im" and ctrl.setups.recalls == 0
+    assert ctrl.configure_sweep().commands == 0
+
+
+def test_segmented_mode_matches_four_channel_mode(ctrl):
+    ctrl.configure_sweep()
+    channels = ctrl.read_traces()
+
+    ctrl.model.meas_mode.set("segmented")
+    ctrl.configure_sweep()
+    assert ctrl.segmented
+    sim = simulator(ctrl)
+    plan = ctrl.frequency_plan()
+    for name in ("TONE", "IM3"):
+        ch = sim.channels[ctrl.ch[name].n]
+        state = plan.segmented[name]
+        assert ch.sweep_type == "SEGM" and ch.arb == (1, 1, 0)
+        assert len(ch.segments) == len(state.segments)
+        for seg, expected in zip(ch.segments, state.segments):
+            assert seg[:3] == pytest.approx(expected)
+        half = len(state.segments) // 2  # The lower tone or IM3 product, then the upper one
+        assert [seg[5] for seg in ch.segments] == ["NEG"] * half + ["POS"] * half
+        assert sorted(ch.src_arb) == [port for port, _ in state.src_arb]
+        for port, arb in state.src_arb:
+            assert ch.src_arb[port] == pytest.approx(arb)
+
+    segmented = ctrl.read_traces()
+    assert list(segmented) == list(channels)
+    assert segmented.spacing == pytest.approx(channels.spacing)
+    for name in ("TL_O", "IM3U_O"):
+        assert power_dbm(segmented[name]) == pytest.approx(power_dbm(channels[name]), abs=0.1)
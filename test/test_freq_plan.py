@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from rss_im_sweep.freq_plan import FrequencyPlan, FrequencyPlanError, FreqState, write_order
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+def apply_steps(sim, steps):
+    for field, value in steps:
+        if field == "start":
+            sim.write(":SENS1:FREQ:STAR %r" % value)
+        elif field == "stop":
+            sim.write(":SENS1:FREQ:STOP %r" % value)
+        elif field == "arb":
+            sim.write(":SENS1:FREQ:CONV:ARB %d, %d, %r, SWE" % value)
+        else:
+            port, arb = value
+            sim.write(":SOUR1:FREQ%d:CONV:ARB:IFR %d, %d, %r, SWE" % ((port,) + arb))
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
+    return sim.channels[1]
+
+
+def test_plan():
+    plan = FrequencyPlan(1e9, 1e6, 30e6, 30)
+    assert numpy.allclose(plan.tones[1] - plan.tones[0], plan.spacing)
+    assert numpy.allclose(plan.receiver["IM3U"], plan.im3[1])
+    assert dict(plan.src_arb)[4] == (0, 1, 1e9)
+    plan.validate(10e6, 24e9, image_tolerance=10e3)
+    with pytest.raises(FrequencyPlanError):
+        FrequencyPlan(10e6, 1e6, 30e6, 30).validate(10e6, 24e9)
+    with pytest.raises(FrequencyPlanError):
+        FrequencyPlan(1e9, 1e6, 30e6, 30, src_tl=1, src_tu=1)
+
+
+def test_write_order():
+    plan = FrequencyPlan(1e9, 1e6, 30e6, 30)
+    sim = SimulatedZVA()
+    sim.write(":CONF:CHAN1:STAT ON")
+    tl = plan.states["TL"]
+    steps = write_order(FreqState(10e6, 24e9, None, ()), tl, 10e6, 24e9)
+    assert len(steps) == 3 + len(tl.src_arb)  # No placeholder range needed
+    ch = apply_steps(sim, steps)
+    assert (ch.start, ch.stop, ch.arb) == (1e6, 30e6, (-1, 2, 1e9))
+
+    # A new center frequency, and a spacing below the instrument range, from an unknown fundamental sweep
+    target = FrequencyPlan(2e9, 1e6, 5e6, 30).states["TU"]
+    sim.write(":SENS1:FREQ:CONV FUND")
+    ch = apply_steps(sim, write_order(None, target, 10e6, 24e9))
+    assert (ch.start, ch.stop, ch.arb) == (1e6, 5e6, (1, 2, 2e9))
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from rss_im_sweep import grid
+from rss_im_sweep.grid import GridScheduler, GridStore, grid_order, power_groups
+from rss_im_sweep.readout import TraceData
+
+
+def test_grid_order():
+    order = grid_order([(1e6, 10e6, 101), (10e6, 30e6, 201)], [-20, -15, -10])
+    assert order == [(0, [0, 1, 2]), (1, [2, 1, 0])]
+    assert power_groups([0, 1, 2, 3, 4], 20000) == [[0, 1, 2], [3, 4]]
+    assert power_groups([0, 1, 2], 101, segment_power=False) == [[0], [1], [2]]
+
+
+def test_grid_store(tmp_path):
+    definition = {"blocks": [(1e6, 10e6, 11)], "powers": [-20, -10]}
+    store = GridStore(str(tmp_path), definition)
+    data = TraceData({"IM3L_O": numpy.arange(11) + 1j}, spacing=numpy.linspace(1e6, 10e6, 11))
+    store.save(0, 1, data, -10)
+
+    store = GridStore(str(tmp_path), definition)  # Resume
+    assert store.is_done(0, 1) and not store.is_done(0, 0)
+    stacked, powers = store.load_block(0)
+    assert list(powers) == [-10]
+    assert stacked["IM3L_O"].shape == (1, 11)
+    assert numpy.allclose(stacked["IM3L_O"][0], data["IM3L_O"])
+    assert numpy.allclose(stacked.spacing, data.spacing)
+
+    with pytest.raises(ValueError):
+        GridStore(str(tmp_path), {"blocks": [(1e6, 10e6, 11)], "powers": [-20]})
+
+
+class FakeController(object):
+    """Records the sweep settings, and returns the tone power and spacing of each point as traces"""
+    def __init__(self, fail_after=None):
+        self.overrides = {}
+        self.model = {"spacing_start": 1e6, "spacing_stop": 30e6, "sweep_points": 101, "base_power": -10.0,
+                      "meas_mode": "channels"}
+        self.configured = []
+        self.segments = None
+        self.reads = 0
+        self.fail_after = fail_after
+
+    def setting(self, name):
+        return self.overrides.get(name, self.model[name])
+
+    def configure_sweep(self):
+        self.configured.append(dict(self.overrides))
+        self.segments = None
+
+    def set_segments(self, ranges):
+        self.segments = ranges
+
+    def read_traces(self):
+        if self.fail_after is not None and self.reads >= self.fail_after:
+            raise RuntimeError("Sweep failed")
+        self.reads += 1
+        segments = self.segments or [(self.setting("spacing_start"), self.setting("spacing_stop"),
+                                      self.setting("sweep_points"), self.setting("base_power"))]
+        spacing = numpy.concatenate([numpy.linspace(*s[:3]) for s in segments])
+        power = numpy.concatenate([numpy.full(s[2], s[3]) for s in segments])
+        return TraceData({"TL_O": power + 0j}, spacing=spacing)
+
+
+BLOCKS = [(1e6, 10e6, 10), (10e6, 30e6, 20)]
+POWERS = [-20, -15, -10]
+
+
+def check_store(store):
+    for b, (start, stop, points) in enumerate(BLOCKS):
+        stacked, powers = store.load_block(b)
+        assert list(powers) == POWERS
+        assert numpy.allclose(stacked["TL_O"].real, numpy.array(POWERS)[:, None])
+        assert numpy.allclose(stacked.spacing, numpy.linspace(start, stop, points))
+
+
+def test_scheduler_segment_power(tmp_path, monkeypatch):
+    monkeypatch.setattr(grid, "MAX_POINTS", 25)  # Two powers per sweep in block 0, one in block 1
+    ctrl = FakeController()
+    store = GridStore(str(tmp_path), {"blocks": BLOCKS, "powers": POWERS})
+    done = []
+    GridScheduler(ctrl, store, BLOCKS, POWERS).run(progress=lambda b, p: done.append((b, p)))
+    assert ctrl.reads == 2 + 3
+    assert done == [(0, 0), (0, 1), (0, 2), (1, 2), (1, 1), (1, 0)]
+    check_store(store)
+    assert ctrl.overrides == {} and ctrl.configured[-1] == {}  # The model settings are applied again
+
+
+def test_scheduler_resume(tmp_path):
+    ctrl = FakeController(fail_after=1)
+    definition = {"blocks": BLOCKS, "powers": POWERS}
+    with pytest.raises(RuntimeError):
+        GridScheduler(ctrl, GridStore(str(tmp_path), definition), BLOCKS, POWERS, segment_power=False).run()
+    assert ctrl.overrides == {} and ctrl.configured[-1] == {}
+    assert ctrl.configured[1]["base_power"] == -20  # The power is stepped with configure_sweep()
+
+    ctrl = FakeController()
+    store = GridStore(str(tmp_path), definition)
+    scheduler = GridScheduler(ctrl, store, BLOCKS, POWERS, segment_power=False)
+    assert scheduler.remaining() == 5
+    scheduler.run()
+    assert ctrl.reads == 5  # The completed slice isn't measured again
+    assert scheduler.remaining() == 0
+    check_store(store)
+    assert ctrl.overrides == {}
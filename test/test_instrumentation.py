@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import io
+import json
+
+from rss_im_sweep.instrumentation import UNATTRIBUTED, InstrumentedResource, LatencyHistogram, VisaStats, operation
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+def test_histogram():
+    h = LatencyHistogram()
+    for t in (0.5e-3, 0.5e-3, 0.5e-3, 20e-3):
+        h.add(t)
+    assert h.n == 4
+    assert h.max == 20e-3
+    assert 0.5e-3 <= h.percentile(50) < 1e-3
+    assert h.percentile(100) >= 20e-3
+
+
+def test_attribution():
+    stats = VisaStats()
+    res = InstrumentedResource(SimulatedZVA(), stats)
+    res.timeout = 5000
+    assert res._resource.timeout == 5000
+    with operation("configure_sweep"):
+        with operation("inner"):
+            res.write(":SENS1:SWE:POIN 11")
+        assert res.query("*IDN?").startswith("Rohde")
+    res.write("*CLS")
+
+    rows = {r[0]: r for r in stats.summary()}
+    assert rows["configure_sweep"][1] == 2
+    assert rows[UNATTRIBUTED][1] == 1
+    d = json.loads(json.dumps(stats.as_dict()))
+    assert d["configure_sweep"]["calls"]["query"]["n"] == 1
+    stats.dump_json(io.StringIO())
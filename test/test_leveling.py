@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+
+from rss_im_sweep.leveling import SecantLeveler, level_tones, split_tone_powers
+
+
+def compressing_dut(x, gain=10.0, p1db=5.0):
+    """A DUT with soft compression, output power in dBm"""
+    return x + gain - 10 * numpy.log10(1 + 10 ** ((x + gain - p1db) / 10))
+
+
+def test_secant_leveler():
+    gain = numpy.array([10.0, 9.0, 12.0])  # Per point, e.g. a gain ripple over the tone spacing
+    leveler = SecantLeveler(2.0, tolerance=0.05, max_iterations=8)
+    x = numpy.full(3, -10.0)
+    while True:
+        y = compressing_dut(x, gain)
+        if leveler.is_done(y):
+            break
+        x = leveler.update(x, y)
+    assert numpy.all(numpy.abs(y - 2.0) <= 0.05)
+    assert leveler.iterations <= 5
+
+    leveler = SecantLeveler(20.0, max_iterations=3)  # Beyond the saturated output power
+    x = -10.0
+    while not leveler.is_done(compressing_dut(x)):
+        x = leveler.update(x, compressing_dut(x))
+    assert leveler.iterations == 3
+
+
+def test_split_tone_powers():
+    c, o_l, o_u = split_tone_powers(numpy.array([-10.0, -9.0]), numpy.array([-9.0, -8.0]))
+    assert list(c) == [-9.5, -8.5]
+    assert (o_l, o_u) == (-0.5, 0.5)
+
+
+def test_level_tones_with_unequal_port_gain():
+    ripple = numpy.array([0.0, -1.0, 0.5, 0.2])  # Common to both tones, e.g. the DUT gain over the tone spacing
+    measured = []
+
+    def measure(x_l, x_u):  # The upper tone port has 4 dB less gain to the DUT output
+        measured.append((x_l, x_u))
+        return compressing_dut(x_l, 10.0 + ripple), compressing_dut(x_u, 6.0 + ripple)
+
+    x_l, x_u, y_l, y_u = level_tones(measure, -10.0, -10.0, SecantLeveler(0.0, tolerance=0.05, max_iterations=8))
+    assert abs(numpy.median(y_l)) <= 0.05 and abs(numpy.median(y_u)) <= 0.05
+    assert abs(x_u - x_l - 4) < 0.5  # The port with 4 dB less gain is driven 4 dB harder
+    assert measured[1][1] - measured[1][0] > 3  # Each port is updated from the output of its own tone
+
+    x_l, x_u, y_l, y_u = level_tones(measure, numpy.full(4, -10.0), numpy.full(4, -10.0),
+                                     SecantLeveler(-5.0, tolerance=0.05, max_iterations=8), per_point=True)
+    assert numpy.all(numpy.abs((y_l + y_u) / 2 + 5) <= 0.05)  # Only the mean of the tones is leveled per point
+    assert numpy.allclose(x_u - x_l, (x_u - x_l)[0])  # One offset per port
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import gc
+
+from rss_im_sweep.observers import ObserverRegistry
+
+
+class Widget(object):
+    def __init__(self):
+        self.values = []
+
+    def update(self, value):
+        self.values.append(value)
+
+
+def notify(reg, value):
+    for o in reg.observers():
+        o(value)
+
+
+def test_bound_methods_are_weak():
+    reg = ObserverRegistry()
+    w = Widget()
+    reg.add(w.update)
+    notify(reg, 1)
+    assert w.values == [1]
+    del w
+    gc.collect()
+    assert len(reg) == 0
+
+
+def test_owner_and_subscription():
+    reg = ObserverRegistry()
+    got = []
+    for _ in range(100):  # Like a softkey entry recreated each time a menu is opened
+        owner = Widget()
+        reg.add(lambda v: got.append(v), owner=owner)
+        del owner
+    gc.collect()
+    assert len(reg) == 0
+
+    sub = reg.add(got.append)
+    assert sub.active and len(reg) == 1
+    sub.cancel()
+    assert not sub.active and len(reg) == 0
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import threading
+
+from rss_im_sweep.readback import parse_channel_catalog, read_snapshots
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+class SimInstrument(object):
+    """The parts of RSSscpi.Instrument used by read_snapshots()"""
+    def __init__(self, sim):
+        self._visa_lock = threading.Lock()
+        self._visa_res = sim
+
+    def _query(self, cmd_str):
+        return self._visa_res.query(cmd_str)
+
+
+def test_parse_channel_catalog():
+    assert parse_channel_catalog("'1,TL,3,IM3L'") == {1: "TL", 3: "IM3L"}
+    assert parse_channel_catalog("''") == {}
+
+
+def test_read_snapshots():
+    sim = SimulatedZVA()
+    sim.write(":CONF:CHAN1:NAME 'TL';:CONF:CHAN3:STAT ON;:CONF:CHAN3:NAME 'IM3L'")
+    sim.write(":SENS1:FREQ:STOP 30e6;:SENS1:FREQ:CONV:ARB -1, 2, 1e9, SWE;:SENS1:FREQ:STAR 1e6")
+    sim.write(":SENS1:BAND 100;:SENS1:BAND:SEL HIGH;:SOUR1:POW -5;:MMEM:LOAD:CORR 1, 'RSS_im_sweep.cal'")
+    sim.round_trips = 0
+    snaps = read_snapshots(SimInstrument(sim), ["TL", "IM3L"])
+    assert sim.round_trips == 2
+    tl = snaps["TL"]
+    assert tl.number == 1
+    assert (tl.start, tl.stop, tl.arb) == (1e6, 30e6, (-1, 2, 1e9))
+    assert (tl.ifbw, tl.selectivity, tl.power, tl.trigger) == (100, "high", -5, "IMM")
+    assert tl.calgroup == "RSS_im_sweep.cal"
+    assert snaps["IM3L"].number == 3 and snaps["IM3L"].calgroup is None
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
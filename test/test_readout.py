@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from rss_im_sweep.readout import block_to_array, demux, parse_block_header, split_response
+
+
+def mk_block(data):
+    raw = data.tobytes()
+    length = str(len(raw))
+    return b"#" + str(len(length)).encode() + length.encode() + raw + b"\n"
+
+
+def test_parse_block_header():
+    assert parse_block_header(b"#3100" + b"x" * 100) == (5, 100)
+    assert parse_block_header(b"#0abcd\n") == (2, 4)
+    with pytest.raises(ValueError):
+        parse_block_header(b"1.0,2.0")
+
+
+def test_block_to_array_complex():
+    x = (numpy.arange(20001) * (1 + 2j)).astype("<c8")
+    y = block_to_array(mk_block(x), "REAL,32", complex_=True)
+    assert y.dtype == numpy.complex64
+    assert numpy.array_equal(x, y)
+
+
+def test_block_to_array_real64():
+    x = numpy.linspace(1e6, 30e6, 101).astype("<f8")
+    assert numpy.array_equal(block_to_array(mk_block(x), "REAL,64"), x)
+
+
+def test_block_to_array_truncated():
+    x = numpy.ones(10, dtype="<f4")
+    with pytest.raises(ValueError):
+        block_to_array(mk_block(x)[:-10], "REAL,32")
+
+
+def test_split_response_and_demux():
+    a = numpy.arange(6, dtype="<c8")
+    b = numpy.array([1.0, 2.0], dtype="<f4")
+    buf = b"'1,TL_I,2,TL_O';" + mk_block(a)[:-1] + b";" + mk_block(b)
+    parts = split_response(buf)
+    assert parts[0] == "'1,TL_I,2,TL_O'"
+    x = block_to_array(parts[1], complex_=True)
+    assert numpy.array_equal(x, a)
+    assert numpy.array_equal(block_to_array(parts[2]), b)
+    tl_i, tl_o = demux(x, [2, 4])
+    assert numpy.array_equal(tl_o, a[2:])
+    with pytest.raises(ValueError):
+        demux(x, [2, 2])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import logging
+import queue
+import threading
+
+from rss_im_sweep.scpi_batch import SCPIBatch, check_errors, join_commands
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+class FakeError(Exception):
+    def __init__(self, err_no=0, err_str="", stack=None):
+        super().__init__(err_no, err_str)
+        self.err_no = err_no
+        self.err_str = err_str
+
+
+class FakeInstrument(object):
+    """Mimics the write/query path of RSSscpi.Instrument"""
+    Error = FakeError
+
+    def __init__(self, err_reply='0,"No error"'):
+        self._visa_lock = threading.Lock()
+        self.error_queue = queue.Queue()
+        self.visa_logger = logging.getLogger("fake.VISA")
+        self.sent = []
+        self.err_reply = err_reply
+        self.command_cnt = 0
+
+    def _write(self, cmd_str):
+        self.command_cnt += 1
+        self.sent.append(cmd_str)
+
+    def _query(self, cmd_str):
+        self.command_cnt += 1
+        self.sent.append(cmd_str)
+        if cmd_str.endswith("SYSTem:ERRor:ALL?"):
+            return "1;" + self.err_reply
+        return "42"
+
+    def write(self, cmd_str):
+        with self._visa_lock:
+            self._write(cmd_str)
+
+    def query(self, cmd_str):
+        with self._visa_lock:
+            return self._query(cmd_str)
+
+
+def test_join_commands():
+    assert join_commands(["SENS1:FREQ:STAR 1", "*OPC?", ":SENS2:FREQ:STOP 2"]) == \
+        ":SENS1:FREQ:STAR 1;*OPC?;:SENS2:FREQ:STOP 2"
+
+
+def test_batch_merges_writes_and_queries():
+    inst = FakeInstrument()
+    with SCPIBatch(inst) as batch:
+        inst.write("A 1")
+        inst.write("B 2")
+        assert inst.sent == []
+        assert inst.query("C?") == "42"
+        inst.write("D 3")
+    assert inst.sent == [":A 1;:B 2;:C?", ":D 3;*OPC?;:SYSTem:ERRor:ALL?"]
+    assert batch.commands == 4
+    assert batch.round_trips == 2
+    assert batch.saved_round_trips == 2
+    assert "_write" not in inst.__dict__ and "_query" not in inst.__dict__
+
+
+def test_batch_max_len_and_nesting():
+    inst = FakeInstrument()
+    with SCPIBatch(inst, max_len=12):
+        with SCPIBatch(inst) as inner:
+            for n in range(4):
+                inst.write("X %d" % n)
+        assert not inner.active
+    assert len(inst.sent) == 3
+    assert inst.sent[0] == ":X 0;:X 1"
+
+
+def test_batch_errors():
+    inst = FakeInstrument(err_reply='-222,"Data out of range",-113,"Undefined header"')
+    with SCPIBatch(inst) as batch:
+        inst.write("A 1")
+    assert [e.err_no for e in batch.errors] == [-222, -113]
+    assert inst.error_queue.qsize() == 2
+
+
+def test_batch_disabled():
+    inst = FakeInstrument()
+    with SCPIBatch(inst, enabled=False):
+        inst.write("A 1")
+        inst.write("B 1")
+    assert inst.sent == ["A 1", "B 1"]
+
+
+def test_check_errors():
+    inst = FakeInstrument()
+    inst._visa_res = sim = SimulatedZVA()
+    inst.write("A 1")
+    assert check_errors(inst) == []
+    sim.write(":SENS1:FREQ:STAR 1e12")
+    assert check_errors(inst) == []  # No commands sent through the instrument since the last check
+    inst.write("A 2")
+    sim.round_trips = 0
+    errors = check_errors(inst)
+    assert [e.err_no for e in errors] == [-222]
+    assert inst.error_queue.get_nowait() is errors[0]
+    assert sim.round_trips == 2  # The status byte and SYST:ERR:ALL?
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from rss_im_sweep.analysis import power_dbm
+from rss_im_sweep.freq_plan import FrequencyPlan
+from rss_im_sweep.readout import TraceData
+from rss_im_sweep.segmented import unfold_segments
+from rss_im_sweep.zva_sim import SimulatedZVA
+
+
+def test_unfold_segments():
+    x = numpy.arange(1.0, 7.0)
+    a = numpy.ones(6)
+    data = TraceData({"TONE_A_TL": a, "TONE_A_TU": a, "TONE_B": x, "IM3_B": 2 * x},
+                     spacing=numpy.array([97, 98, 99, 101, 102, 103.0]))
+    ret = unfold_segments(data, 3, ratios=True)
+    assert list(ret["TL_O"]) == [3, 2, 1]
+    assert list(ret["TU_O"]) == [4, 5, 6]
+    assert list(ret["IM3U_OR"]) == [2, 2, 2]
+    assert list(ret.spacing) == [2, 4, 6]
+
+    # src_tl 6 dB stronger than src_tu: the second half is scaled to the tone amplitudes of the first half
+    data["TONE_A_TL"] = 2 * a
+    ret = unfold_segments(data, 3)
+    assert list(ret["TU_O"]) == [2, 2.5, 3]
+    assert list(ret["IM3U_O"]) == [4, 5, 6]  # 2 P(src_tu) + P(src_tl) instead of 2 P(src_tl) + P(src_tu)
+
+    data["TONE_A_TL"] = numpy.zeros(6)  # RF off
+    ret = unfold_segments(data, 3)
+    assert list(ret["TU_O"]) == [4, 5, 6]
+
+
+@pytest.mark.parametrize("offset", [0.0, 3.0])
+def test_segmented_sim(offset):
+    """The unfolded traces match the four channel mode, also when src_tu is stronger than src_tl"""
+    plan = FrequencyPlan(1e9, 1e6, 30e6, 30)
+    sim = SimulatedZVA(time_scale=0)
+    sim.write(":OUTP ON")
+    for n, name in ((1, "TONE"), (2, "IM3")):
+        state = plan.segmented[name]
+        sim.write(":CONF:CHAN%d:STAT ON" % n)
+        sim.write(":SOUR%d:POW3:OFFS %r, CPAD" % (n, offset))
+        for i, (start, stop, points) in enumerate(state.segments):
+            sim.write(":SENS%d:SEGM%d:INS %r, %r, %d, -10, AUTO, 0, 1000" % (n, i + 1, start, stop, points))
+        sim.write(":SENS%d:SWE:TYPE SEGM;:SENS%d:FREQ:CONV:ARB 1, 1, 0, SWE" % (n, n))
+        for port, arb in state.src_arb:
+            sim.write(":SOUR%d:FREQ%d:CONV:ARB:IFR %d, %d, %r, SWE" % ((n, port) + arb))
+    sim.write(":CALC1:PAR:SDEF 'TONE_A_TL', 'A1';:CALC1:PAR:SDEF 'TONE_A_TU', 'A3';:CALC1:PAR:SDEF 'TONE_B', 'B2'")
+    sim.write(":CALC2:PAR:SDEF 'IM3_B', 'B2'")
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
+
+    data = TraceData(((name, sim.trace_data(name)) for name in ("TONE_A_TL", "TONE_A_TU", "TONE_B", "IM3_B")),
+                     spacing=sim.channels[1].stimulus())
+    ret = unfold_segments(data, 30)
+    assert numpy.allclose(ret.spacing, plan.spacing)
+    o_l = -10 + sim.gain_db  # src_tl, port 1
+    o_u = -10 + offset + sim.gain_db  # src_tu, port 3
+    assert numpy.allclose(power_dbm(ret["TL_O"]), o_l, atol=0.1)
+    assert numpy.allclose(power_dbm(ret["TU_O"]), o_u, atol=0.1)
+    assert numpy.allclose(power_dbm(ret["TU_I"]), -10 + offset, atol=0.1)
+    away = numpy.abs(plan.spacing - sim.resonance[0]) > 3e6  # Away from the memory effect resonance
+    assert numpy.allclose(power_dbm(ret["IM3L_O"])[away], 2 * o_l + o_u - 2 * sim.oip3_dbm, atol=0.5)
+    assert numpy.allclose(power_dbm(ret["IM3U_O"])[away], 2 * o_u + o_l - 2 * sim.oip3_dbm, atol=0.5)
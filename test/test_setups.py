@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+from rss_im_sweep.setups import SetupStore, setup_key
+
+
+def test_setup_key():
+    a = setup_key("im", {"center_freq": 1e9, "sweep_points": 101})
+    assert a == setup_key("im", {"sweep_points": 101, "center_freq": 1e9})
+    assert a != setup_key("cal", {"center_freq": 1e9, "sweep_points": 101})
+    assert a != setup_key("im", {"center_freq": 1e9, "sweep_points": 201})
+
+
+def test_setup_store():
+    store = SetupStore()
+    state = {"applied": {"TL": {"points": 101}}}
+    setup = store.add("im", "abc", state)
+    state["applied"]["TL"]["points"] = 201  # The saved state is a copy
+    assert store.get("im", "abc").state["applied"]["TL"]["points"] == 101
+    assert store.get("im", "def") is None
+    assert setup.filename.endswith("rss_im_sweep_im_abc.zvx")
+    store.discard("im")
+    assert store.get("im", "abc") is None
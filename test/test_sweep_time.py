@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import pytest
+
+from rss_im_sweep.sweep_time import SELECTIVITY_OFFSET, SweepTimeModel, optimize
+
+
+def test_measurement_time():
+    model = SweepTimeModel(overhead=0, settle=0, host_overhead=0)
+    assert model.measurement_time(100, 1e3, "norm") == pytest.approx(0.4)
+    assert model.measurement_time(100, 1e3, "high") == pytest.approx(0.64)
+    # The tones with a wider IF bandwidth in the segmented mode
+    assert model.measurement_time(100, 1e3, "norm", "segmented", 10e3) == pytest.approx(0.22)
+
+    model.calibrate(0.2 + 100 * 1e-3, 100, 1e3, "norm")
+    assert model.settle == pytest.approx(2e-3)
+    model.observe(1.0, 0.5, weight=1)
+    assert model.host_overhead == pytest.approx(0.5)
+
+
+def test_optimize():
+    model = SweepTimeModel()
+    est = optimize(model, 101, 1e6, -10, dynamic_range=100)
+    assert est.points == 101
+    assert est.dynamic_range >= 100
+    assert est.time == pytest.approx(model.measurement_time(101, est.ifbw, est.selectivity))
+    # The widest IF bandwidth is limited by the tone spacing
+    assert est.ifbw * SELECTIVITY_OFFSET[est.selectivity] <= 1e6
+
+    est = optimize(model, 101, 1e6, -10, budget=1.0)
+    assert est.time <= 1.0
+    assert est.points == 101
+    est = optimize(model, 10001, 1e6, -10, budget=1.0)
+    assert 11 <= est.points < 10001
+    assert est.time <= 1.0
+
+    assert optimize(model, 101, 1e6, -10, dynamic_range=200) is None
+    assert optimize(model, 101, 1e6, -10, budget=0.01) is None
+    with pytest.raises(ValueError):
+        optimize(model, 101, 1e6, -10)
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import threading
+
+from rss_im_sweep.tk_bridge import TkDispatcher
+
+
+class FakeTcl(object):
+    def __init__(self, threaded):
+        self.threaded = threaded
+
+    def call(self, *args):
+        return "1" if self.threaded else ""
+
+
+class FakeTk(object):
+    """Records the bindings, virtual events and idle callbacks, which are run by process()"""
+    def __init__(self, threaded=True):
+        self.tk = FakeTcl(threaded)
+        self.bindings = {}
+        self.events = []
+        self.idle = []
+        self.timers = []
+
+    def bind(self, event, func):
+        self.bindings[event] = func
+
+    def event_generate(self, event, when=None):
+        self.events.append(event)
+
+    def after_idle(self, func):
+        self.idle.append(func)
+
+    def after(self, ms, func):
+        self.timers.append(func)
+
+    def process(self):
+        while self.events or self.idle:
+            if self.events:
+                self.bindings[self.events.pop(0)](None)
+            else:
+                self.idle.pop(0)()
+
+
+def test_one_wakeup_per_batch():
+    root = FakeTk()
+    d = TkDispatcher(root)
+    root.process()
+    got = []
+
+    def worker():
+        for i in range(10):
+            d.post(got.append, i)
+    t = threading.Thread(target=worker)
+    t.start()
+    t.join()
+
+    assert len(root.events) == 1
+    root.process()
+    assert got == list(range(10))
+    assert d.wakeups == 1 and d.delivered == 10
+    assert d.latency.n == 1
+
+    d.post(got.append, 10)  # From the Tk thread
+    assert root.events == [] and len(root.idle) == 1
+    root.process()
+    assert got[-1] == 10
+
+
+def test_polling_fallback():
+    root = FakeTk(threaded=False)
+    d = TkDispatcher(root)
+    got = []
+    d.post(got.append, 1)
+    assert root.events == [] and root.idle == []
+    root.timers.pop()()
+    assert got == [1]
+    assert len(root.timers) == 1
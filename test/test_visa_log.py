@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import glob
+import gzip
+import logging
+
+from rss_im_sweep.visa_log import VisaLog
+
+
+def test_visa_log(tmp_path):
+    logger = logging.getLogger("test_visa_log.VISA")
+    logger.setLevel(logging.INFO)
+    filename = str(tmp_path / "visa_log.txt")
+    log = VisaLog(logger, filename, ring_size=10, max_bytes=2000, backup_count=2)
+    try:
+        assert not logger.propagate
+        for i in range(200):
+            logger.info("SENS1:SWE:POIN %d", i)
+    finally:
+        log.close()
+    assert logger.propagate
+    last = log.last(3)
+    assert len(last) == 3
+    assert last[-1].endswith("SENS1:SWE:POIN 199")
+    assert len(log.last()) == 10
+    rotated = sorted(glob.glob(filename + ".*.gz"))
+    assert len(rotated) == 2
+    with gzip.open(rotated[0], "rt") as fp:
+        assert "SENS1:SWE:POIN" in fp.read()
+
+
+def test_close_restores_propagation():
+    logger = logging.getLogger("test_visa_log.reconnect.VISA")
+    for propagate in (True, False):
+        logger.propagate = propagate
+        VisaLog(logger).close()
+        assert logger.propagate is propagate
+        assert not logger.handlers
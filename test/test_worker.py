@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import threading
+import time
+
+from rss_im_sweep.worker import CoalescingDispatcher, InstrumentWorker, JobAborted
+
+
+def test_worker_runs_jobs_in_order_and_delivers_results():
+    w = InstrumentWorker()
+    gate = threading.Event()
+    order = []
+    results = []
+    errors = []
+
+    w.submit(gate.wait)  # Block the worker until all jobs are queued
+    w.submit(order.append, "normal", callback=results.append)
+    w.submit(order.append, "urgent", priority=InstrumentWorker.URGENT)
+    f = w.submit(lambda: 1 / 0, errback=errors.append)
+    gate.set()
+    w.stop(timeout=5)
+
+    assert order == ["urgent", "normal"]
+    assert isinstance(f.exception(), ZeroDivisionError)
+    assert results == [] and errors == []  # Nothing is delivered until deliver_results() is called
+    w.deliver_results()
+    assert results == [None]
+    assert len(errors) == 1
+
+
+def test_submit_latest_replaces_queued_job():
+    w = InstrumentWorker()
+    gate = threading.Event()
+    written = []
+
+    w.submit(gate.wait)
+    futures = [w.submit_latest("power", written.append, p) for p in range(5)]
+    gate.set()
+    w.stop(timeout=5)
+
+    assert written == [4]
+    assert all(f is futures[0] for f in futures)
+    assert w.superseded == 4
+
+
+def test_errors_are_attributed_to_the_job():
+    pending = []
+    notified = []
+    w = InstrumentWorker(error_check=lambda: pending and [pending.pop()], notify=lambda: notified.append(1))
+    reported = []
+    w.error_handler = lambda name, errors: reported.append((name, errors))
+
+    w.submit(pending.append, "-222 Data out of range", name="set_ifbw")
+    w.submit(lambda: None, name="rf_output")
+    w.stop(timeout=5)
+    assert len(notified) == 2
+    w.deliver_results()
+    assert reported == [("set_ifbw", ["-222 Data out of range"])]
+
+
+def test_failing_notify_does_not_stop_the_worker():
+    def notify():
+        raise RuntimeError("main thread is not in main loop")
+    w = InstrumentWorker(notify=notify)
+    first = w.submit(lambda: 1)
+    second = w.submit(lambda: 2)
+    assert first.result(timeout=5) == 1
+    assert second.result(timeout=5) == 2
+    w.stop(timeout=5)
+
+
+def test_urgent_job_aborts_long_job():
+    w = InstrumentWorker()
+    started = threading.Event()
+    steps = []
+
+    def long_job(n=500):
+        started.set()
+        for i in range(n):  # Up to 5 s, in steps of 10 ms
+            w.check_abort()
+            steps.append(i)
+            time.sleep(0.01)
+
+    f = w.submit(long_job)
+    started.wait(5)
+    t0 = time.monotonic()
+    urgent = w.submit(time.monotonic, priority=InstrumentWorker.URGENT)
+    assert urgent.result(timeout=5) - t0 < 0.5  # Waits for one step, not the whole job
+    assert isinstance(f.exception(), JobAborted)
+    assert len(steps) < 500
+
+    after = w.submit(long_job, 5)  # The abort only applies to the job which was running
+    w.stop(timeout=10)
+    assert after.exception() is None
+
+
+class FakeTk(object):
+    def __init__(self):
+        self.timers = {}
+        self._ids = 0
+
+    def after(self, ms, func, *args):
+        self._ids += 1
+        self.timers["after#%d" % self._ids] = (ms, func, args)
+        return "after#%d" % self._ids
+
+    def after_cancel(self, timer_id):
+        self.timers.pop(timer_id, None)
+
+    def fire(self):
+        timers, self.timers = self.timers, {}
+        for _, func, args in timers.values():
+            func(*args)
+
+
+class FakeWorker(object):
+    superseded = 0
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit_latest(self, key, func, *args, name=None):
+        self.submitted.append((key, func(*args)))
+
+
+def test_dispatcher_coalesces_within_window():
+    tk = FakeTk()
+    worker = FakeWorker()
+    d = CoalescingDispatcher(tk, worker, window_ms=50)
+    for ifbw in (1e3, 2e3, 5e3):
+        d.post("ifbw", lambda x: x, ifbw)
+    d.post("power", lambda x: x, -10)
+    assert worker.submitted == []  # Nothing is written before the window expires
+    assert [ms for ms, _, _ in tk.timers.values()] == [50, 50]  # One timer per setting
+
+    tk.fire()
+    assert sorted(worker.submitted) == [("ifbw", 5e3), ("power", -10)]
+    assert (d.posted, d.dropped, d.superseded) == (4, 2, 2)
+
+    d.post("ifbw", lambda x: x, 10e3)  # A new window
+    assert len(tk.timers) == 1
+    tk.fire()
+    assert worker.submitted[-1] == ("ifbw", 10e3)
+    assert len(worker.submitted) == 3
+
+
+def test_dispatcher_without_window():
+    tk = FakeTk()
+    worker = FakeWorker()
+    d = CoalescingDispatcher(tk, worker, window_ms=0)
+    d.post("ifbw", lambda x: x, 1e3)
+    d.post("ifbw", lambda x: x, 2e3)
+    assert tk.timers == {}
+    assert worker.submitted == [("ifbw", 1e3), ("ifbw", 2e3)]
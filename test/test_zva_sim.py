@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+
+@author: Lukas Sandström
+"""
+
+import numpy
+import pytest
+
+from rss_im_sweep.analysis import power_dbm
+from rss_im_sweep.readout import block_to_array, split_response
+from rss_im_sweep.zva_sim import SimulatedZVA, parse_sim_address, short_mnemonic
+
+
+def test_short_mnemonic():
+    assert short_mnemonic("FREQuency") == "FREQ"
+    assert short_mnemonic("IFRequency") == "IFR"
+    assert short_mnemonic("SWEEP") == "SWE"
+    assert short_mnemonic("CALCULATE") == "CALC"
+    assert short_mnemonic("ALL") == "ALL"
+
+
+def test_parse_sim_address():
+    assert parse_sim_address("192.168.56.102") is None
+    assert parse_sim_address("sim") == {}
+    assert parse_sim_address("sim:latency=0.002,time_scale=0") == {"latency": 0.002, "time_scale": 0.0}
+    assert parse_sim_address("SIM:dut_out=4") == {"dut_out": 4}
+    assert parse_sim_address("simulator.lan") is None  # A VISA resource, not the simulator
+    assert parse_sim_address("sim1::INSTR") is None
+    for bad in ("sim:latency=fast", "sim:colour=1", "sim:calpool=1"):
+        with pytest.raises(ValueError):
+            parse_sim_address(bad)
+
+
+def test_errors_and_relative_headers():
+    sim = SimulatedZVA(time_scale=0)
+    assert sim.query("*IDN?").startswith("Rohde-Schwarz,ZVA")
+    # An ARB conversion putting the receiver out of range is rejected
+    sim.write(":SENSe1:FREQuency:CONVersion:ARBitrary -1, 2, 1e9, SWEep")
+    assert sim.read_stb() & 4
+    assert sim.query(":SYSTem:ERRor:ALL?").startswith("-222")
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
+    sim.write(":SENS1:FREQ:STAR 10e6;STOP 30e6")
+    assert float(sim.query(":SENS1:FREQ:STOP?")) == 30e6
+
+
+def test_im_readout():
+    sim = SimulatedZVA(time_scale=0)
+    cf = 1e9
+    sim.write(":SENS1:FREQ:STAR 10e6;:SENS1:FREQ:STOP 30e6;:SENS1:SWE:POIN 21")
+    sim.write(":CALC1:PAR:SDEF 'TL_O', 'B2D1SAM'")
+    sim.write(":SENS1:FREQ:CONV:ARB -1, 2, %r, SWE" % cf)
+    sim.write(":SOUR1:POW -10;:FORMat:DATA REAL,32;:FORM:BORD SWAP")
+    assert sim.query(":SYST:ERR:ALL?") == '0,"No error"'
+    sim.write(":CONF:TRAC:CAT?;:CALC:DATA:DALL? SDAT")
+    parts = split_response(sim.read_raw())
+    assert parts[0] == "'1,Trc1,2,TL_O'"
+    data = block_to_array(parts[1], complex_=True)
+    assert len(data) == 2 * 21
+    # TL_O is the lower tone with 10 dB gain
+    assert numpy.allclose(power_dbm(data[21:]), 0, atol=0.01)
+    assert sim.round_trips == 6